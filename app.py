@@ -1,14 +1,34 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, send_file
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Text, ForeignKey, func
+from flask import Blueprint, Flask, Response, g, has_request_context, jsonify, render_template, request, redirect, url_for, session, flash, send_file, stream_with_context
+from flask.sessions import SecureCookieSessionInterface, SessionInterface, SessionMixin
+from itsdangerous import BadSignature
+from sqlalchemy import create_engine, event, Boolean, Column, Integer, String, Float, DateTime, Text, ForeignKey, Index, UniqueConstraint, case, func, inspect, select, text, true, tuple_, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import joinedload, sessionmaker, relationship
+from werkzeug.datastructures import CallbackDict
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import check_password_hash, generate_password_hash
 from datetime import datetime, timedelta
 import pytz
 hk_tz = pytz.timezone('Asia/Hong_Kong')
 def now_hk():
     return datetime.now(hk_tz)
 from functools import wraps
+import click
+from bisect import bisect_left
+from collections import OrderedDict, deque
+import base64
+import hashlib
+import hmac
+import json
+import logging
 import os
+import secrets
+import sqlite3
+import threading
+import time
+import uuid
 
 Base = declarative_base()
 
@@ -17,7 +37,7 @@ class Employee(Base):
     __tablename__ = 'employees'
     id = Column(Integer, primary_key=True)
     username = Column(String(50), unique=True, nullable=False)
-    password = Column(String(255), nullable=False)  # 簡單儲存，生產環境應 hash
+    password = Column(String(255), nullable=False)  # werkzeug hash (pbkdf2)，舊資料既明文由 init_db 升級
     name = Column(String(100), nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     
@@ -28,6 +48,7 @@ class Member(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String(100), nullable=False)
     phone = Column(String(20), unique=True, nullable=False)
+    phone_key = Column(String(20))  # normalize_phone(phone)，比對用
     tier = Column(String(20), default='普通會員')  # 普通會員, 黑鑽會員
     balance = Column(Float, default=0)  # 儲值金額
     benefits_total = Column(Integer, default=0)   # 總權益次數
@@ -39,13 +60,25 @@ class Member(Base):
     # 日期
     effective_date = Column(DateTime, default=datetime.utcnow)  # 生效日期
     expiry_date = Column(DateTime)  # 到期日期
-    # 使用記錄
+    # 使用記錄 (次數只計 *_period 嗰個週期，週期過咗就當 0)
     dessert_coffee_used = Column(Integer, default=0)  # 甜品咖啡已用次數
     omakase_used = Column(Integer, default=0)  # 廚師發辦已用次數
+    dessert_coffee_period = Column(String(10))  # e.g. 2026-W42
+    omakase_period = Column(String(10))  # e.g. 2026
     created_at = Column(DateTime, default=datetime.utcnow)
     created_by_employee_id = Column(Integer, ForeignKey('employees.id'))
+    customer_id = Column(Integer, ForeignKey('customers.id'))  # 對應既顧客資料 (訪問、消費、喜好)
     
     employee = relationship("Employee", back_populates="members")
+    customer = relationship("Customer", back_populates="member")
+    
+    __table_args__ = (
+        Index('ix_members_expiry_date', 'expiry_date'),
+        Index('ix_members_effective_date', 'effective_date'),
+        Index('ix_members_customer_id', 'customer_id', unique=True),
+        Index('ix_members_name_id', 'name', 'id'),  # ?sort=name 既 keyset 分頁
+        Index('uq_members_phone_key', 'phone_key', unique=True),  # 舊資料重複既由回填留 NULL
+    )
     
     @property
     def benefits_remaining(self):
@@ -58,32 +91,38 @@ class Member(Base):
             return datetime.utcnow() < self.expiry_date
         return True
     
+    def benefit_used(self, benefit):
+        """本週期已用次數 (記錄屬於舊週期就當 0)"""
+        config = BENEFITS[benefit]
+        if getattr(self, config['period_column']) != benefit_period(benefit):
+            return 0
+        return getattr(self, config['used_column']) or 0
+    
+    def benefit_remaining(self, benefit):
+        limit = BENEFITS[benefit]['tiers'].get(self.tier, 0)
+        return max(0, limit - self.benefit_used(benefit))
+    
     def get_weekly_remaining(self):
         """每週剩餘甜品咖啡次數"""
-        if self.tier in ['普通會員', '黑鑽會員']:
-            return max(0, 1 - self.dessert_coffee_used)
-        return 0
+        return self.benefit_remaining('dessert_coffee')
     
     def get_yearly_remaining(self):
         """年度剩餘廚師發辦次數"""
-        if self.tier == '黑鑽會員':
-            return max(0, 2 - self.omakase_used)
-        return 0
-        if self.tier == '黑鑽會員':
-            return max(0, 2 - self.yearly_omakase)
-        return 0
+        return self.benefit_remaining('omakase')
 
 class Settings(Base):
     __tablename__ = 'settings'
     id = Column(Integer, primary_key=True)
     restaurant_name = Column(String(100), default='我的餐廳')
     dark_mode = Column(Integer, default=0)  # 0 = light, 1 = dark
+    version = Column(Integer, default=0)  # 每次修改 +1，俾其他 worker 知道要重新讀取
 
 class Customer(Base):
     __tablename__ = 'customers'
     id = Column(Integer, primary_key=True)
     name = Column(String(100), nullable=False)
     phone = Column(String(20), unique=True, nullable=False)
+    phone_key = Column(String(20))  # normalize_phone(phone)，比對用
     email = Column(String(100))
     birthday = Column(DateTime)
     tags = Column(String(500))  # 標籤，用逗號分隔
@@ -97,6 +136,14 @@ class Customer(Base):
     points = Column(Integer, default=0)  # 積分 (已停用)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    member = relationship("Member", back_populates="customer", uselist=False)
+    
+    __table_args__ = (
+        Index('ix_customers_total_spent', 'total_spent'),
+        Index('ix_customers_name_id', 'name', 'id'),  # ?sort=name 既 keyset 分頁
+        Index('uq_customers_phone_key', 'phone_key', unique=True),  # 舊資料重複既由回填留 NULL
+    )
 
 class VisitRecord(Base):
     __tablename__ = 'visit_records'
@@ -108,7 +155,12 @@ class VisitRecord(Base):
     server = Column(String(100))
     party_size = Column(Integer, default=1)
     note = Column(Text)
+    transaction_id = Column(Integer, ForeignKey('transactions.id'))  # 會員結帳自動記既訪問；營業額已經計入 checkout
     created_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('ix_visit_records_customer_date', 'customer_id', 'visit_date'),
+    )
 
 class Interaction(Base):
     __tablename__ = 'interactions'
@@ -118,6 +170,10 @@ class Interaction(Base):
     note = Column(Text)
     created_at = Column(DateTime, default=datetime.utcnow)
     created_by_employee_id = Column(Integer, ForeignKey('employees.id'))
+    
+    __table_args__ = (
+        Index('ix_interactions_customer_created', 'customer_id', 'created_at'),
+    )
 
 class Reservation(Base):
     __tablename__ = 'reservations'
@@ -125,14 +181,31 @@ class Reservation(Base):
     customer_id = Column(Integer, ForeignKey('customers.id'), nullable=True)
     name = Column(String(100), nullable=False)
     phone = Column(String(20), nullable=False)
+    phone_key = Column(String(20))  # normalize_phone(phone)，比對用
     email = Column(String(100))
     date = Column(DateTime, nullable=False)
     party_size = Column(Integer, default=1)
-    table_number = Column(String(20))
+    table_number = Column(String(20))  # 座位名，併枱用 + 連接，例如 A1+A2
+    duration = Column(Integer)  # 用餐時間 (分鐘)；空白用 RESERVATION_DURATION
     status = Column(String(20), default='confirmed')  # confirmed, seated, completed, no_show, cancelled
     note = Column(Text)
     created_at = Column(DateTime, default=datetime.utcnow)
     created_by_employee_id = Column(Integer, ForeignKey('employees.id'))
+    
+    __table_args__ = (
+        Index('ix_reservations_date_status', 'date', 'status'),
+        Index('ix_reservations_phone_key', 'phone_key'),
+    )
+
+class DiningTable(Base):
+    """座位 (枱) 資料"""
+    __tablename__ = 'tables'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(20), unique=True, nullable=False)  # A1, B2
+    capacity = Column(Integer, nullable=False, default=2)
+    area = Column(String(50), default='')  # 大廳, 包廂
+    combinable = Column(Boolean, default=False)  # 可以同同區既枱併埋
+    active = Column(Boolean, default=True)
 
 class Transaction(Base):
     __tablename__ = 'transactions'
@@ -146,37 +219,1440 @@ class Transaction(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     created_by_employee_id = Column(Integer, ForeignKey('employees.id'))
     note = Column(Text)
+    idempotency_key = Column(String(64))  # 收銀機每次開結帳頁產生，防止重複提交扣兩次
+    
+    __table_args__ = (
+        Index('ix_transactions_member_created', 'member_id', 'created_at'),
+        Index('ix_transactions_created_at', 'created_at'),
+        Index('uq_transactions_idempotency_key', 'idempotency_key', unique=True),
+    )
+
+class DailyRevenue(Base):
+    """每日營業額匯總 (香港日期)，結帳同訪問記錄寫入時即時累加"""
+    __tablename__ = 'daily_revenue'
+    id = Column(Integer, primary_key=True)
+    day = Column(String(10), nullable=False)  # YYYY-MM-DD (香港時區)
+    tier = Column(String(20), nullable=False)  # 會員等級；訪問記錄用 '顧客'
+    source = Column(String(20), nullable=False)  # checkout, visit
+    count = Column(Integer, default=0)
+    original_total = Column(Float, default=0)
+    discount_total = Column(Float, default=0)
+    final_total = Column(Float, default=0)
+    balance_total = Column(Float, default=0)  # 由儲值扣款
+    cash_total = Column(Float, default=0)
+    
+    __table_args__ = (
+        UniqueConstraint('day', 'tier', 'source', name='uq_daily_revenue_day_tier_source'),
+    )
+
+class BenefitUsage(Base):
+    """權益使用記錄 (只會新增)：每個週期每個名額 (slot) 一行"""
+    __tablename__ = 'benefit_usage'
+    id = Column(Integer, primary_key=True)
+    member_id = Column(Integer, ForeignKey('members.id'), nullable=False)
+    benefit = Column(String(30), nullable=False)  # general, dessert_coffee, omakase
+    period = Column(String(10), nullable=False)  # 2026-W42 / 2026；通用權益用 '-'
+    slot = Column(Integer, nullable=False)  # 第幾次 (1..上限)
+    employee_id = Column(Integer, ForeignKey('employees.id'))
+    created_at = Column(DateTime, default=datetime.utcnow)
+    voided_at = Column(DateTime)  # 管理員手動重置時標記，唔會刪除
+    
+    __table_args__ = (
+        # 只限未作廢既記錄，重置之後同一個名額可以再用
+        Index('uq_benefit_usage_slot', 'member_id', 'benefit', 'period', 'slot',
+              unique=True, sqlite_where=text('voided_at IS NULL')),
+        Index('ix_benefit_usage_period', 'benefit', 'period'),
+    )
+
+class BenefitReset(Base):
+    """每個權益最後一次批量重置既週期，補跑時用嚟避免重複重置"""
+    __tablename__ = 'benefit_resets'
+    id = Column(Integer, primary_key=True)
+    benefit = Column(String(30), nullable=False)
+    period = Column(String(10), nullable=False)
+    rows = Column(Integer, default=0)  # 重置咗幾多個會員
+    reset_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        UniqueConstraint('benefit', 'period', name='uq_benefit_resets_benefit_period'),
+    )
+
+class ApiToken(Base):
+    """JSON API 用既 token (只存 sha256)"""
+    __tablename__ = 'api_tokens'
+    id = Column(Integer, primary_key=True)
+    token_hash = Column(String(64), unique=True, nullable=False)
+    employee_id = Column(Integer, ForeignKey('employees.id'), nullable=False)
+    name = Column(String(100))  # 用途，例如 POS-1
+    created_at = Column(DateTime, default=datetime.utcnow)
+    revoked_at = Column(DateTime)
+
+class EmployeeSession(Base):
+    """伺服器端登入 session；cookie 只放隨機 token，資料庫只存 sha256"""
+    __tablename__ = 'employee_sessions'
+    id = Column(String(64), primary_key=True)  # token 既 sha256
+    employee_id = Column(Integer, ForeignKey('employees.id'))
+    data = Column(Text, nullable=False)  # JSON
+    version = Column(Integer, default=1, nullable=False)  # 每次寫入 +1，同 cookie 入面既版本比對
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False)
+    
+    __table_args__ = (
+        Index('ix_employee_sessions_expires_at', 'expires_at'),
+    )
+
+class SearchTerm(Base):
+    """姓名/電話搜尋索引：每個值存晒所有後綴，子字串搜尋就變成用索引既前綴範圍查詢"""
+    __tablename__ = 'search_terms'
+    id = Column(Integer, primary_key=True)
+    entity = Column(String(20), nullable=False)  # member, customer, reservation
+    entity_id = Column(Integer, nullable=False)
+    field = Column(String(10), nullable=False)  # name, phone
+    term = Column(String(100), nullable=False)  # 由 pos 開始既後綴
+    pos = Column(Integer, nullable=False)  # 後綴喺原值既位置，0 = 整個值
+    length = Column(Integer, nullable=False)  # 原值長度
+    
+    __table_args__ = (
+        Index('ix_search_terms_lookup', 'entity', 'field', 'term'),
+        Index('ix_search_terms_entity', 'entity', 'entity_id'),
+    )
+
+class LiveEvent(Base):
+    """前台即時更新既事件 (SSE)；id 即係 Last-Event-ID，定期清走舊記錄"""
+    __tablename__ = 'live_events'
+    id = Column(Integer, primary_key=True)
+    type = Column(String(40), nullable=False)  # reservation.created, reservation.updated, reservation.deleted, checkout.completed
+    payload = Column(Text, nullable=False)  # JSON
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    # AUTOINCREMENT：清走舊記錄之後 id 都唔會重用，斷線重連先唔會錯過事件
+    __table_args__ = {'sqlite_autoincrement': True}
+
+# ============ Benefit Periods ============
+# 權益: 週期 (week / year, 香港時間)、各等級每週期次數、對應欄位
+BENEFITS = {
+    'dessert_coffee': {
+        'name': '甜品咖啡',
+        'period': 'week',
+        'tiers': {'普通會員': 1, '黑鑽會員': 1},
+        'used_column': 'dessert_coffee_used',
+        'period_column': 'dessert_coffee_period',
+    },
+    'omakase': {
+        'name': '廚師發辦',
+        'period': 'year',
+        'tiers': {'黑鑽會員': 2},
+        'used_column': 'omakase_used',
+        'period_column': 'omakase_period',
+    },
+}
+
+def benefit_period(benefit, when=None):
+    """權益目前所屬週期: 週 -> 2026-W42 (ISO 週，星期一開始)，年 -> 2026"""
+    when = when or now_hk()
+    if BENEFITS[benefit]['period'] == 'week':
+        year, week, _ = when.isocalendar()
+        return f'{year}-W{week:02d}'
+    return str(when.year)
 
 # ============ Database Setup ============
-engine = create_engine('sqlite:///restaurant.db', echo=False)
+# 多個 worker / thread 同時寫入：WAL 令讀寫互不阻塞，busy_timeout 令寫鎖排隊等候而唔係即刻報 locked
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 15000))
+
+def _count_rows(n):
+    if n and has_request_context() and 'request_start' in g:
+        g.query_rows += n
+
+class CountingCursor(sqlite3.Cursor):
+    """fetch 時計返回行數 (metrics 用)，SELECT 既 rowcount 永遠係 -1"""
+    
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            _count_rows(1)
+        return row
+    
+    def fetchmany(self, *args, **kwargs):
+        rows = super().fetchmany(*args, **kwargs)
+        _count_rows(len(rows))
+        return rows
+    
+    def fetchall(self):
+        rows = super().fetchall()
+        _count_rows(len(rows))
+        return rows
+
+class CountingConnection(sqlite3.Connection):
+    def cursor(self, factory=CountingCursor):
+        return super().cursor(factory)
+
+engine = create_engine(
+    'sqlite:///restaurant.db',
+    echo=False,
+    pool_size=int(os.environ.get('DB_POOL_SIZE', 10)),
+    max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+    connect_args={'timeout': SQLITE_BUSY_TIMEOUT_MS / 1000, 'check_same_thread': False,
+                  'factory': CountingConnection},
+)
+
+@event.listens_for(engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """每條新連線都設定一次 PRAGMA"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA cache_size=-16000')  # 約 16MB page cache
+    cursor.close()
+
+# 電話 canonical key (E.164)：會員 / 顧客 / 預訂既比對同重複檢查都用 phone_key，phone 保留輸入時既格式顯示
+PHONE_DEFAULT_COUNTRY = os.environ.get('PHONE_DEFAULT_COUNTRY', '852')  # 冇國碼既號碼當本地號碼
+PHONE_LOCAL_LENGTH = 8  # 本地號碼位數 (香港 8 位)
+
+class PhoneError(ValueError):
+    """電話判斷唔到國碼 (超過本地位數又冇 + / 00)，要用戶補返國碼"""
+
+def parse_phone(value):
+    """'9123 4567' / '+852 9123-4567' / '0085291234567' -> '+85291234567'；冇數字返回 None
+
+    香港以外既號碼一定要用 + 或者 00 帶國碼；13800138000 呢類判斷唔到國碼既會 raise PhoneError，
+    唔會估一個國碼出嚟 (當 +1 就變咗北美號碼)
+    """
+    raw = str(value or '').strip()
+    digits = ''.join(ch for ch in raw if ch.isdigit())
+    if not digits:
+        return None
+    if raw.startswith('+'):
+        return '+' + digits
+    if digits.startswith('00'):
+        return '+' + digits[2:]
+    if len(digits) == PHONE_LOCAL_LENGTH:
+        return '+' + PHONE_DEFAULT_COUNTRY + digits
+    if len(digits) == len(PHONE_DEFAULT_COUNTRY) + PHONE_LOCAL_LENGTH and digits.startswith(PHONE_DEFAULT_COUNTRY):
+        return '+' + digits  # 本地國碼冇加 +，例如 85291234567
+    if len(digits) > PHONE_LOCAL_LENGTH:
+        raise PhoneError(f'電話 {raw} 要用 + 或 00 加國碼 (例如 +86 138 0013 8000)')
+    return digits  # 太短 (分機、測試資料)，淨係保留數字
+
+def normalize_phone(value):
+    """parse_phone 既寬鬆版 (SQL 函數、搜尋、回填用)：判斷唔到國碼返回 None，唔會 raise"""
+    try:
+        return parse_phone(value)
+    except PhoneError:
+        return None
+
+@event.listens_for(engine, 'connect')
+def register_sqlite_functions(dbapi_connection, connection_record):
+    """raw SQL (回填、批量配對) 用同一個 normalize_phone"""
+    dbapi_connection.create_function('normalize_phone', 1, normalize_phone, deterministic=True)
+
 Base.metadata.create_all(engine)
 Session = sessionmaker(bind=engine)
 
+# create_all 唔會改舊表，新欄位要喺度補上: (表, 欄位, DDL)
+MIGRATION_COLUMNS = [
+    ('settings', 'version', 'INTEGER DEFAULT 0'),
+    ('transactions', 'idempotency_key', 'VARCHAR(64)'),
+    ('members', 'dessert_coffee_period', 'VARCHAR(10)'),
+    ('members', 'omakase_period', 'VARCHAR(10)'),
+    ('reservations', 'duration', 'INTEGER'),
+    ('members', 'customer_id', 'INTEGER REFERENCES customers(id)'),
+    ('visit_records', 'transaction_id', 'INTEGER REFERENCES transactions(id)'),
+    ('members', 'phone_key', 'VARCHAR(20)'),
+    ('customers', 'phone_key', 'VARCHAR(20)'),
+    ('reservations', 'phone_key', 'VARCHAR(20)'),
+]
+
+# 新欄位加完之後要補既資料: (表, 欄位) -> (SQL, 參數)
+# 舊既已用次數當係今個週期用既，唔好一升級就清零
+MIGRATION_BACKFILLS = {
+    ('members', 'dessert_coffee_period'): lambda: (
+        'UPDATE members SET dessert_coffee_period = :period', {'period': benefit_period('dessert_coffee')}),
+    ('members', 'omakase_period'): lambda: (
+        'UPDATE members SET omakase_period = :period', {'period': benefit_period('omakase')}),
+}
+
+# 舊資料庫手動建過既索引，已被上面模型既複合索引 / unique 約束取代
+MIGRATION_DROP_INDEXES = [
+    'idx_members_phone',
+    'idx_customers_phone',
+    'idx_reservations_date',
+    'idx_reservations_phone',
+    'idx_reservations_status',
+    'ix_reservations_phone',  # 改用 ix_reservations_phone_key
+    'ix_members_phone_key',  # 改用 unique 既 uq_members_phone_key
+    'ix_customers_phone_key',  # 改用 unique 既 uq_customers_phone_key
+]
+
+# 建 unique 索引之前要先清走既重複資料: 索引名 -> SQL
+# phone_key 重複 (舊版冇 unique) 既只保留 id 最細嗰行，其他留 NULL，由 flask backfill-phone-keys 列出人手處理
+_RELEASE_DUPLICATE_PHONE_KEYS = '''
+    UPDATE {table} SET phone_key = NULL
+    WHERE phone_key IS NOT NULL
+      AND id NOT IN (SELECT MIN(id) FROM {table} WHERE phone_key IS NOT NULL GROUP BY phone_key)
+'''
+MIGRATION_INDEX_PREPARE = {
+    'uq_members_phone_key': _RELEASE_DUPLICATE_PHONE_KEYS.format(table='members'),
+    'uq_customers_phone_key': _RELEASE_DUPLICATE_PHONE_KEYS.format(table='customers'),
+}
+
+def migrate_db():
+    """為舊資料庫補上缺少的欄位同索引"""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table, column, ddl in MIGRATION_COLUMNS:
+            existing = [c['name'] for c in inspector.get_columns(table)]
+            if column not in existing:
+                conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+                if (table, column) in MIGRATION_BACKFILLS:
+                    sql, params = MIGRATION_BACKFILLS[(table, column)]()
+                    conn.execute(text(sql), params)
+        
+        for name in MIGRATION_DROP_INDEXES:
+            conn.execute(text(f'DROP INDEX IF EXISTS {name}'))
+        
+        # 舊表唔會自動建索引，缺少既逐個補建
+        created = False
+        for table in Base.metadata.sorted_tables:
+            existing = {i['name'] for i in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    if index.name in MIGRATION_INDEX_PREPARE:
+                        conn.execute(text(MIGRATION_INDEX_PREPARE[index.name]))
+                    index.create(conn)
+                    created = True
+        
+        # 建咗新索引就更新統計，等 query planner 揀啱索引
+        if created:
+            conn.execute(text('ANALYZE'))
+
+migrate_db()
+
+# ============ Phone Keys ============
+PHONE_KEY_TABLES = ('members', 'customers', 'reservations')
+PHONE_KEY_UNIQUE = ('members', 'customers')  # 一個電話只可以登記一次
+PHONE_KEY_BATCH = 5000
+
+def _set_phone_key(target, value, oldvalue, initiator):
+    target.phone_key = normalize_phone(value)
+
+# ORM 寫入 phone 時自動更新 phone_key；raw SQL 寫入要自己填 (或者用 SQL 函數 normalize_phone)
+for _model in (Member, Customer, Reservation):
+    event.listen(_model.phone, 'set', _set_phone_key)
+
+def backfill_phone_keys(force=False):
+    """分批計 phone_key (每批一個 transaction)，返回 {表: 更新行數}
+    
+    會員 / 顧客既 phone_key 係 unique：同一個 key 已經有人用就 OR IGNORE 跳過，留 NULL 等人手合併；
+    判斷唔到國碼既電話 normalize_phone 返回 NULL。兩種都由 unresolved_phone_keys 列出。
+    force=True 連已有既都重算 (改咗 PHONE_DEFAULT_COUNTRY 之後用)，重算後撞 key 既清做 NULL
+    """
+    pending = '' if force else 'AND phone_key IS NULL'
+    report = {}
+    for table in PHONE_KEY_TABLES:
+        with engine.connect() as conn:
+            max_id = conn.execute(text(f'SELECT COALESCE(MAX(id), 0) FROM {table}')).scalar()
+        report[table] = 0
+        for lo in range(1, max_id + 1, PHONE_KEY_BATCH):
+            params = {'lo': lo, 'hi': lo + PHONE_KEY_BATCH - 1}
+            with engine.begin() as conn:
+                report[table] += conn.execute(text(f"""
+                    UPDATE OR IGNORE {table} SET phone_key = normalize_phone(phone)
+                    WHERE id BETWEEN :lo AND :hi {pending}
+                """), params).rowcount
+                if force:
+                    conn.execute(text(f"""
+                        UPDATE {table} SET phone_key = NULL
+                        WHERE id BETWEEN :lo AND :hi AND phone_key IS NOT normalize_phone(phone)
+                    """), params)
+    return report
+
+def find_by_phone(db, model, phone, exclude_id=None):
+    """用 phone_key 搵同一個電話既記錄 (唔理輸入格式)；判斷唔到國碼 raise PhoneError"""
+    phone_key = parse_phone(phone)
+    if phone_key is None:
+        return None
+    query = db.query(model).filter(model.phone_key == phone_key)
+    if exclude_id is not None:
+        query = query.filter(model.id != exclude_id)
+    return query.first()
+
+def unresolved_phone_keys(table):
+    """有電話但冇 phone_key 既行，返回 [(id, phone, 撞咗既 phone_key / None = 判斷唔到國碼)]"""
+    with engine.connect() as conn:
+        return conn.execute(text(f"""
+            SELECT id, phone, normalize_phone(phone) FROM {table}
+            WHERE phone_key IS NULL AND TRIM(COALESCE(phone, '')) != '' ORDER BY id
+        """)).all()
+
+def ensure_phone_keys():
+    """舊資料庫第一次啟動時補 phone_key (已知撞 key 既行唔會令每次啟動都重跑)"""
+    with engine.connect() as conn:
+        for table in PHONE_KEY_TABLES:
+            taken = (f'AND NOT EXISTS (SELECT 1 FROM {table} o WHERE o.phone_key = normalize_phone(t.phone))'
+                     if table in PHONE_KEY_UNIQUE else '')
+            if conn.execute(text(f"""
+                SELECT 1 FROM {table} t WHERE phone_key IS NULL AND normalize_phone(phone) IS NOT NULL {taken} LIMIT 1
+            """)).first():
+                break
+        else:
+            return
+    backfill_phone_keys()
+
+ensure_phone_keys()
+
+# ============ Search Index ============
+SEARCH_RESULT_LIMIT = int(os.environ.get('SEARCH_RESULT_LIMIT', 50))
+SEARCH_NAME_MAX_LENGTH = 32  # 太長既名只索引頭 32 個字
+SEARCH_ENTITIES = {'member': Member, 'customer': Customer, 'reservation': Reservation}
+_SEARCH_ENTITY_OF = {model: entity for entity, model in SEARCH_ENTITIES.items()}
+
+def normalize_search_name(value):
+    return ' '.join((value or '').lower().split())[:SEARCH_NAME_MAX_LENGTH]
+
+def normalize_search_phone(value):
+    return ''.join(ch for ch in (value or '') if ch.isdigit())
+
+def parse_search(search):
+    """判斷搜尋字串係電話 (全數字) 定姓名，返回 (field, key)"""
+    stripped = search.replace(' ', '').replace('-', '').replace('+', '')
+    if stripped.isdigit():
+        return 'phone', stripped
+    return 'name', normalize_search_name(search)
+
+def search_term_rows(entity, obj):
+    rows = []
+    for field, value in (('name', normalize_search_name(obj.name)),
+                         ('phone', normalize_search_phone(obj.phone))):
+        for pos in range(len(value)):
+            rows.append({'entity': entity, 'entity_id': obj.id, 'field': field,
+                         'term': value[pos:], 'pos': pos, 'length': len(value)})
+    return rows
+
+def _write_search_terms(conn, entity, objs, deleted_ids=()):
+    ids = [o.id for o in objs] + list(deleted_ids)
+    if ids:
+        conn.execute(SearchTerm.__table__.delete().where(
+            SearchTerm.entity == entity, SearchTerm.entity_id.in_(ids)))
+    rows = [row for o in objs for row in search_term_rows(entity, o)]
+    if rows:
+        conn.execute(SearchTerm.__table__.insert(), rows)
+
+def _search_fields_changed(obj):
+    attrs = inspect(obj).attrs
+    return attrs.name.history.has_changes() or attrs.phone.history.has_changes()
+
+@event.listens_for(Session, 'after_flush')
+def sync_search_terms(db, flush_context):
+    """新增/修改/刪除會員、顧客、預訂時同步搜尋索引"""
+    changed = {}
+    deleted = {}
+    for obj in list(db.new) + list(db.dirty):
+        entity = _SEARCH_ENTITY_OF.get(type(obj))
+        if entity and (obj in db.new or _search_fields_changed(obj)):
+            changed.setdefault(entity, []).append(obj)
+    for obj in db.deleted:
+        entity = _SEARCH_ENTITY_OF.get(type(obj))
+        if entity:
+            deleted.setdefault(entity, []).append(obj.id)
+    
+    conn = db.connection()
+    for entity in set(changed) | set(deleted):
+        _write_search_terms(conn, entity, changed.get(entity, []), deleted.get(entity, []))
+
+def exact_phone_query(db, entity, search):
+    """搜尋字串係完整電話 (最少 PHONE_LOCAL_LENGTH 位) 就用 phone_key 索引精確配對；
+    唔係完整電話或者冇結果返回 None (照用後綴索引搵)"""
+    field, key = parse_search(search)
+    phone_key = normalize_phone(search) if field == 'phone' and len(key) >= PHONE_LOCAL_LENGTH else None
+    if phone_key is None:
+        return None
+    model = SEARCH_ENTITIES[entity]
+    query = db.query(model.id).filter(model.phone_key == phone_key)
+    return query if query.first() is not None else None
+
+def search_ids_query(db, entity, search):
+    """返回符合搜尋既 id 子查詢 (完整電話用 phone_key，其他用 ix_search_terms_lookup 索引)"""
+    exact = exact_phone_query(db, entity, search)
+    if exact is not None:
+        return exact
+    field, key = parse_search(search)
+    return db.query(SearchTerm.entity_id).filter(
+        SearchTerm.entity == entity,
+        SearchTerm.field == field,
+        SearchTerm.term >= key,
+        SearchTerm.term < key + '\U0010ffff',
+    )
+
+def search_ranked(db, entity, search, limit=None):
+    """按相關度返回 entity_id list: 完全相同 > 尾數/結尾相同 > 開頭相同 > 其他"""
+    exact = exact_phone_query(db, entity, search)
+    if exact is not None:
+        model = SEARCH_ENTITIES[entity]
+        return [row.id for row in exact.order_by(model.id).limit(limit or SEARCH_RESULT_LIMIT)]
+    field, key = parse_search(search)
+    rank = func.min(case(
+        ((SearchTerm.pos == 0) & (SearchTerm.length == len(key)), 0),
+        (func.length(SearchTerm.term) == len(key), 1),
+        (SearchTerm.pos == 0, 2),
+        else_=3,
+    ))
+    rows = search_ids_query(db, entity, search).add_columns(rank.label('rank')).group_by(
+        SearchTerm.entity_id
+    ).order_by('rank', SearchTerm.entity_id).limit(limit or SEARCH_RESULT_LIMIT).all()
+    return [row.entity_id for row in rows]
+
+def rebuild_search_index(db=None):
+    """全量重建搜尋索引，返回寫入既行數"""
+    own_session = db is None
+    db = db or Session()
+    conn = db.connection()
+    conn.execute(SearchTerm.__table__.delete())
+    total = 0
+    for entity, model in SEARCH_ENTITIES.items():
+        batch = []
+        for obj in db.query(model.id, model.name, model.phone).yield_per(1000):
+            batch.extend(search_term_rows(entity, obj))
+            if len(batch) >= 5000:
+                conn.execute(SearchTerm.__table__.insert(), batch)
+                total += len(batch)
+                batch = []
+        if batch:
+            conn.execute(SearchTerm.__table__.insert(), batch)
+            total += len(batch)
+    db.commit()
+    if own_session:
+        db.close()
+    return total
+
+def ensure_search_index():
+    """舊資料庫第一次啟動時補建搜尋索引"""
+    db = Session()
+    try:
+        if db.query(SearchTerm.id).first() is None and any(
+                db.query(model.id).first() is not None for model in SEARCH_ENTITIES.values()):
+            rebuild_search_index(db)
+    finally:
+        db.close()
+
+ensure_search_index()
+
+SECRET_KEY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.secret_key')
+
+def load_secret_key():
+    """SECRET_KEY 環境變數優先；冇就用 .secret_key 檔 (第一次啟動自動產生，所有 worker 共用同一個)"""
+    if os.environ.get('SECRET_KEY'):
+        return os.environ['SECRET_KEY']
+    if not os.path.exists(SECRET_KEY_FILE):
+        # 先寫暫存檔再 link，幾個 worker 同時啟動都只會有一個成功，其他讀返佢既
+        tmp = f'{SECRET_KEY_FILE}.{os.getpid()}'
+        with open(tmp, 'w') as f:
+            f.write(secrets.token_hex(32))
+        os.chmod(tmp, 0o600)
+        try:
+            os.link(tmp, SECRET_KEY_FILE)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp)
+    with open(SECRET_KEY_FILE) as f:
+        return f.read().strip()
+
 app = Flask(__name__)
-app.secret_key = 'restaurant-secret-key-change-in-production'
+app.secret_key = load_secret_key()
+
+# 部署喺 Railway 反向代理後面：remote_addr 要由 X-Forwarded-For 攞返真 client IP，登入限制先唔會變成全部人共用一個 bucket。
+# 冇代理 (直接對外) 就設 TRUSTED_PROXY_COUNT=0，否則 client 可以自己砌 X-Forwarded-For 扮唔同 IP
+TRUSTED_PROXY_COUNT = int(os.environ.get('TRUSTED_PROXY_COUNT', 1))
+if TRUSTED_PROXY_COUNT:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT, x_proto=TRUSTED_PROXY_COUNT)
 
 # Prevent caching
 @app.after_request
 def add_header(response):
+    # API 回應自己設定 Cache-Control (ETag 重新驗證)，唔好覆蓋
+    if 'Cache-Control' in response.headers:
+        return response
     response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
     response.headers['Pragma'] = 'no-cache'
     response.headers['Expires'] = '0'
     return response
 
+# ============ Settings Cache ============
+# 每個進程保留一份設定快照；每隔 SETTINGS_CHECK_INTERVAL 秒先比對 version，
+# 有變先重新讀取，所以其他 worker 改咗設定最多延遲幾秒就會見到
+SETTINGS_CHECK_INTERVAL = 5
+_settings_cache = {'data': None, 'version': None, 'checked_at': 0.0}
+_settings_lock = threading.Lock()
+
+def _load_settings(db):
+    settings_obj = db.query(Settings).order_by(Settings.id).first()
+    if not settings_obj:
+        return {'restaurant_name': '我的餐廳', 'dark_mode': 0, 'version': 0}
+    return {
+        'restaurant_name': settings_obj.restaurant_name,
+        'dark_mode': settings_obj.dark_mode or 0,
+        'version': settings_obj.version or 0,
+    }
+
+def get_settings():
+    """取得設定快照 (dict)，大部分情況只係查字典"""
+    cache = _settings_cache
+    now = time.monotonic()
+    if cache['data'] is not None and now - cache['checked_at'] < SETTINGS_CHECK_INTERVAL:
+        return cache['data']
+    
+    with _settings_lock:
+        if cache['data'] is not None and now - cache['checked_at'] < SETTINGS_CHECK_INTERVAL:
+            return cache['data']
+        db = get_db_session()
+        try:
+            if cache['data'] is not None:
+                version = db.query(Settings.version).order_by(Settings.id).limit(1).scalar() or 0
+                if version == cache['version']:
+                    cache['checked_at'] = now
+                    return cache['data']
+            data = _load_settings(db)
+        finally:
+            db.close()
+        cache.update(data=data, version=data['version'], checked_at=now)
+        return data
+
+def invalidate_settings():
+    """設定改咗之後清除本進程快取"""
+    with _settings_lock:
+        _settings_cache['data'] = None
+
+# ============ 員工 Session ============
+# session 資料放 employee_sessions，cookie 只係 "token.版本"。每個 worker 有 LRU 快取 token -> 資料，
+# cookie 版本同快取一樣就唔使查資料庫 (login_required 只係查字典)；其他 worker 寫過既 session，
+# 瀏覽器會帶住新版本既 cookie，快取自然 miss 再讀資料庫。
+# 未登入 (冇 employee_id) 既 session 唔寫資料庫，只放簽名 cookie ("anon." 開頭)，亂試登入唔會塞爆 employee_sessions
+SESSION_LIFETIME = timedelta(hours=int(os.environ.get('SESSION_LIFETIME_HOURS', 12)))  # 冇寫入都會喺一半時自動續期
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', 1000))
+SESSION_CACHE_TTL = 60  # 秒；喺其他 worker 登出 / 刪除既 session 最多延遲咁耐失效
+ANONYMOUS_SESSION_PREFIX = 'anon.'
+_session_cache = OrderedDict()  # token hash -> (版本, JSON, 到期時間, 快取時間)
+_session_lock = threading.Lock()
+
+def hash_session_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def _cache_session(token_hash, version, data_json, expires_at):
+    with _session_lock:
+        _session_cache[token_hash] = (version, data_json, expires_at, time.monotonic())
+        _session_cache.move_to_end(token_hash)
+        while len(_session_cache) > SESSION_CACHE_SIZE:
+            _session_cache.popitem(last=False)
+
+def load_session(cookie):
+    """cookie "token.版本" -> (token, 版本, 資料, 到期時間)；無效或者過期返回 None"""
+    token, _, version = (cookie or '').rpartition('.')
+    if not token or not version.isdigit():
+        return None
+    token_hash = hash_session_token(token)
+    now = datetime.utcnow()
+    with _session_lock:
+        hit = _session_cache.get(token_hash)
+        if hit and hit[0] == int(version) and hit[2] > now and time.monotonic() - hit[3] < SESSION_CACHE_TTL:
+            _session_cache.move_to_end(token_hash)
+            return token, hit[0], json.loads(hit[1]), hit[2]
+    
+    db = get_db_session()
+    try:
+        row = db.query(EmployeeSession.version, EmployeeSession.data, EmployeeSession.expires_at).filter(
+            EmployeeSession.id == token_hash, EmployeeSession.expires_at > now).first()
+    finally:
+        db.close()
+    if not row:
+        return None
+    _cache_session(token_hash, row.version, row.data, row.expires_at)
+    return token, row.version, json.loads(row.data), row.expires_at
+
+def store_session(token, data):
+    """寫入 session (token 係 None 就開新既)，返回 (token, 新版本)"""
+    data_json = json.dumps(data, ensure_ascii=False, default=str)
+    now = datetime.utcnow()
+    expires_at = now + SESSION_LIFETIME
+    version = None
+    db = get_db_session()
+    try:
+        if token:
+            version = db.execute(update(EmployeeSession).where(EmployeeSession.id == hash_session_token(token)).values(
+                data=data_json, employee_id=data.get('employee_id'), expires_at=expires_at,
+                version=EmployeeSession.version + 1,
+            ).returning(EmployeeSession.version)).scalar()
+        if version is None:
+            # 新 session (或者舊既已經被清走)：順手清埋過期既
+            token, version = secrets.token_urlsafe(32), 1
+            db.query(EmployeeSession).filter(EmployeeSession.expires_at <= now).delete()
+            db.add(EmployeeSession(id=hash_session_token(token), employee_id=data.get('employee_id'),
+                                   data=data_json, version=version, expires_at=expires_at))
+        db.commit()
+    finally:
+        db.close()
+    _cache_session(hash_session_token(token), version, data_json, expires_at)
+    return token, version
+
+def delete_session(token):
+    token_hash = hash_session_token(token)
+    with _session_lock:
+        _session_cache.pop(token_hash, None)
+    db = get_db_session()
+    try:
+        db.query(EmployeeSession).filter_by(id=token_hash).delete()
+        db.commit()
+    finally:
+        db.close()
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, token=None, version=0, expires_at=None):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.token = token
+        self.version = version
+        self.expires_at = expires_at
+        self.modified = False
+        self.rotate = False
+    
+    def regenerate(self):
+        """登入時換新 token，防 session fixation"""
+        self.rotate = True
+        self.modified = True
+
+class DatabaseSessionInterface(SessionInterface):
+    anonymous = SecureCookieSessionInterface()  # 借用 Flask 預設既簽名 serializer
+    
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app)) or ''
+        if cookie.startswith(ANONYMOUS_SESSION_PREFIX):
+            try:
+                data = self.anonymous.get_signing_serializer(app).loads(
+                    cookie[len(ANONYMOUS_SESSION_PREFIX):], max_age=int(SESSION_LIFETIME.total_seconds()))
+            except BadSignature:
+                data = None
+            return ServerSession(data)
+        loaded = load_session(cookie)
+        if loaded is None:
+            return ServerSession()
+        token, version, data, expires_at = loaded
+        return ServerSession(data, token, version, expires_at)
+    
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add('Cookie')
+        
+        # 過咗一半壽命就續期，唔使每個請求都寫
+        renew = session.token and session.expires_at and session.expires_at - datetime.utcnow() < SESSION_LIFETIME / 2
+        if not (session.modified or renew):
+            return
+        authenticated = 'employee_id' in session
+        if session.token and (session.rotate or not authenticated):
+            delete_session(session.token)
+        if not session:
+            response.delete_cookie(name, domain=domain, path=path)
+            return
+        
+        if authenticated:
+            token, version = store_session(None if session.rotate else session.token, dict(session))
+            value = f'{token}.{version}'
+        else:
+            value = ANONYMOUS_SESSION_PREFIX + self.anonymous.get_signing_serializer(app).dumps(dict(session))
+        response.set_cookie(name, value, domain=domain, path=path,
+                            httponly=self.get_cookie_httponly(app), secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+app.session_interface = DatabaseSessionInterface()
+
+# ============ 密碼 / 登入限制 ============
+# pbkdf2 次數可調 (PASSWORD_HASH_ITERATIONS)：150000 次約 50ms；改咗之後，員工下次登入會自動用新次數重新 hash
+PASSWORD_HASH_ITERATIONS = int(os.environ.get('PASSWORD_HASH_ITERATIONS', 150000))
+PASSWORD_HASH_METHOD = f'pbkdf2:sha256:{PASSWORD_HASH_ITERATIONS}'
+LOGIN_MAX_FAILURES = int(os.environ.get('LOGIN_MAX_FAILURES', 5))  # 同一 IP + 用戶名
+LOGIN_MAX_FAILURES_PER_IP = int(os.environ.get('LOGIN_MAX_FAILURES_PER_IP', 20))
+LOGIN_FAILURE_WINDOW = 300  # 秒
+_login_failures = {}  # key -> deque[失敗時間]；每個 worker 各自計
+_login_lock = threading.Lock()
+_dummy_password_hash = []
+
+def hash_password(password):
+    return generate_password_hash(password, PASSWORD_HASH_METHOD)
+
+def is_password_hash(value):
+    return (value or '').startswith(('pbkdf2:', 'scrypt:'))
+
+def verify_password(employee, password):
+    """核對密碼；employee 係 None 都照計一次 hash，唔會由回應時間估到用戶名存唔存在
+    
+    成功而密碼係舊明文或者舊 work factor，會順手改做新 hash (要由 caller commit)
+    """
+    if employee is None:
+        if not _dummy_password_hash:
+            _dummy_password_hash.append(hash_password(secrets.token_hex(8)))
+        check_password_hash(_dummy_password_hash[0], password)
+        return False
+    stored = employee.password or ''
+    if is_password_hash(stored):
+        valid = check_password_hash(stored, password)
+    else:
+        valid = hmac.compare_digest(stored.encode(), password.encode())
+    if valid and not stored.startswith(PASSWORD_HASH_METHOD + '$'):
+        employee.password = hash_password(password)
+    return valid
+
+def _login_failure_keys(username):
+    ip = request.remote_addr or ''
+    return (('ip', ip), LOGIN_MAX_FAILURES_PER_IP), (('user', ip, username.lower()), LOGIN_MAX_FAILURES)
+
+def login_blocked(username):
+    """失敗太多次返回 True (喺計 hash 之前檢查，暴力破解唔會食晒 CPU)"""
+    cutoff = time.monotonic() - LOGIN_FAILURE_WINDOW
+    with _login_lock:
+        for key, limit in _login_failure_keys(username):
+            failures = _login_failures.get(key)
+            while failures and failures[0] < cutoff:
+                failures.popleft()
+            if failures is not None and not failures:
+                del _login_failures[key]
+            elif failures and len(failures) >= limit:
+                return True
+    return False
+
+def record_login_failure(username):
+    now = time.monotonic()
+    with _login_lock:
+        # 亂試唔同用戶名會不停加 key，太多就清走過期既
+        if len(_login_failures) > 10000:
+            for key in [k for k, v in _login_failures.items() if v[-1] < now - LOGIN_FAILURE_WINDOW]:
+                del _login_failures[key]
+        for key, limit in _login_failure_keys(username):
+            _login_failures.setdefault(key, deque(maxlen=limit)).append(now)
+
+def clear_login_failures(username):
+    with _login_lock:
+        _login_failures.pop(_login_failure_keys(username)[1][0], None)
+
 # ============ Context Processor for Dark Mode ============
 @app.context_processor
 def inject_dark_mode():
-    db = get_db_session()
-    settings_obj = db.query(Settings).first()
-    dark_mode = settings_obj.dark_mode if settings_obj else 0
-    restaurant_name = settings_obj.restaurant_name if settings_obj else '我的餐廳'
-    db.close()
-    return dict(dark_mode=dark_mode, restaurant_name=restaurant_name)
+    settings_data = get_settings()
+    return dict(dark_mode=settings_data['dark_mode'], restaurant_name=settings_data['restaurant_name'])
 
 # ============ Helpers ============
 def get_db_session():
     return Session()
 
+def count_reservations_by_phone(db, phone_keys):
+    """一次過計算多個電話既總預訂次數 (唔理輸入格式)，返回 {phone_key: count}"""
+    if not phone_keys:
+        return {}
+    rows = db.query(Reservation.phone_key, func.count(Reservation.id)).filter(
+        Reservation.phone_key.in_(phone_keys)
+    ).group_by(Reservation.phone_key).all()
+    return dict(rows)
+
+# ============ Analytics ============
+# 控制台 / 分析 / 營業額頁共用既 KPI：一條 SQL 每個表掃一次 (條件式聚合)，
+# 結果 cache ANALYTICS_TTL 秒；本 worker 寫入會即刻清，結帳/預訂 (live_events 序號變) 全部 worker 都會清
+ANALYTICS_TTL = int(os.environ.get('ANALYTICS_TTL', 30))  # 秒
+_ANALYTICS_MODELS = (Member, Customer, Reservation, Transaction, VisitRecord, DailyRevenue)
+_analytics_cache = {}  # name -> (到期時間, live_events 序號, 結果)
+_analytics_lock = threading.Lock()
+
+def invalidate_analytics():
+    with _analytics_lock:
+        _analytics_cache.clear()
+
+@event.listens_for(Session, 'after_flush')
+def mark_analytics_dirty(db, flush_context):
+    if any(isinstance(obj, _ANALYTICS_MODELS) for obj in list(db.new) + list(db.dirty) + list(db.deleted)):
+        db.info['analytics_dirty'] = True
+
+@event.listens_for(Session, 'after_commit')
+def clear_analytics_on_commit(db):
+    if db.info.pop('analytics_dirty', False):
+        invalidate_analytics()
+
+@event.listens_for(Session, 'after_rollback')
+def discard_analytics_dirty(db):
+    db.info.pop('analytics_dirty', None)
+
+def cached_analytics(db, name, compute):
+    # 同一個請求入面只查一次序號
+    if has_request_context() and 'analytics_version' in g:
+        version = g.analytics_version
+    else:
+        version = live_event_seq(db.connection())
+        if has_request_context():
+            g.analytics_version = version
+    now = time.time()
+    with _analytics_lock:
+        cached = _analytics_cache.get(name)
+    if cached and cached[0] > now and cached[1] == version:
+        return cached[2]
+    value = compute()
+    with _analytics_lock:
+        _analytics_cache[name] = (now + ANALYTICS_TTL, version, value)
+    return value
+
+def kpi_statement(today):
+    """today: 香港日期 00:00 (naive)"""
+    customers = select(
+        func.count(Customer.id).label('customer_count'),
+        func.coalesce(func.sum(Customer.visits), 0).label('total_visits'),
+        func.coalesce(func.sum(Customer.total_spent), 0).label('total_revenue'),
+        func.coalesce(func.avg(Customer.avg_spend), 0).label('avg_spend'),
+    ).subquery()
+    members = select(
+        func.count(Member.id).label('member_count'),
+        func.coalesce(func.sum(case((Member.expiry_date >= datetime.utcnow(), 1), else_=0)), 0).label('active_members'),
+        func.coalesce(func.sum(Member.balance), 0).label('total_balance'),
+    ).subquery()
+    reservations = select(
+        func.count(Reservation.id).label('today_reservations'),
+    ).where(Reservation.date >= today, Reservation.date < today + timedelta(days=1)).subquery()
+    revenue = select(
+        func.coalesce(func.sum(DailyRevenue.final_total), 0).label('today_revenue'),
+    ).where(DailyRevenue.day == today.strftime('%Y-%m-%d')).subquery()
+    # 每個子查詢都只得一行，直接 CROSS JOIN
+    return select(customers, members, reservations, revenue).select_from(
+        customers.join(members, true()).join(reservations, true()).join(revenue, true()))
+
+def get_kpis(db):
+    """返回 dict：customer_count, total_visits, total_revenue, avg_spend, member_count,
+    active_members, total_balance, today_reservations, today_revenue"""
+    today = now_hk().replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+    key = 'kpis:' + today.strftime('%Y-%m-%d')
+    return cached_analytics(db, key, lambda: dict(db.execute(kpi_statement(today)).one()._mapping))
+
+def get_top_customers(db, limit=10):
+    return cached_analytics(db, f'top_customers:{limit}', lambda: db.query(
+        Customer.id, Customer.name, Customer.phone, Customer.total_spent
+    ).order_by(Customer.total_spent.desc()).limit(limit).all())
+
+# ============ Metrics ============
+# 每個請求記錄延遲、SQL 數目 / 時間 / 返回行數，按 endpoint 累計，/metrics 用 Prometheus 文字格式輸出。
+# 數字係每個 worker process 各自計 (label 有 worker pid)，Prometheus 用 sum() 合併。
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 0))  # 0 = 唔記錄
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 0))
+# /metrics 預設關閉 (會露出 route 同流量)：設 METRICS_TOKEN 俾 Prometheus 用 Bearer token 攞，
+# 或者 METRICS_ENABLED=1 淨係畀已登入員工睇
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+METRICS_ENABLED = bool(METRICS_TOKEN) or os.environ.get('METRICS_ENABLED') == '1'
+
+# PROFILE_QUERIES=1 或者登入後 URL 加 ?_profile=1：回應加 Server-Timing / X-Query-Count header 同寫 log
+PROFILE_QUERIES = os.environ.get('PROFILE_QUERIES') == '1'
+
+slow_log = logging.getLogger('restaurant.slow')
+if os.environ.get('SLOW_QUERY_LOG'):
+    _slow_handler = logging.FileHandler(os.environ['SLOW_QUERY_LOG'])
+    _slow_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    slow_log.addHandler(_slow_handler)
+    slow_log.setLevel(logging.INFO)
+
+class Metrics:
+    """簡單既 in-process counter / histogram"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}  # (endpoint, method, status) -> count
+        self.latency = {}  # (endpoint, method) -> [bucket counts..., +Inf, sum]
+        self.queries = {}  # endpoint -> [count, seconds, rows]
+        self.slow_queries = 0
+    
+    def observe_request(self, endpoint, method, status, seconds, query_count, query_time, rows):
+        with self._lock:
+            key = (endpoint, method, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            buckets = self.latency.setdefault((endpoint, method), [0] * (len(LATENCY_BUCKETS) + 2))
+            buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1  # 累加留返輸出時先計
+            buckets[-1] += seconds
+            q = self.queries.setdefault(endpoint, [0, 0.0, 0])
+            q[0] += query_count
+            q[1] += query_time
+            q[2] += rows
+    
+    def observe_slow_query(self):
+        with self._lock:
+            self.slow_queries += 1
+    
+    def render(self):
+        worker = f'worker="{os.getpid()}"'
+        lines = [
+            '# HELP app_http_requests_total HTTP requests by endpoint, method and status.',
+            '# TYPE app_http_requests_total counter',
+        ]
+        with self._lock:
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append(f'app_http_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}",{worker}}} {count}')
+            
+            lines += ['# HELP app_http_request_duration_seconds Request latency until the response is returned.',
+                      '# TYPE app_http_request_duration_seconds histogram']
+            for (endpoint, method), buckets in sorted(self.latency.items()):
+                labels = f'endpoint="{endpoint}",method="{method}",{worker}'
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), buckets):
+                    cumulative += count
+                    lines.append(f'app_http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'app_http_request_duration_seconds_sum{{{labels}}} {buckets[-1]:.6f}')
+                lines.append(f'app_http_request_duration_seconds_count{{{labels}}} {cumulative}')
+            
+            for index, (name, kind, help_text) in enumerate((
+                ('app_db_queries_total', 'counter', 'SQL statements executed while handling requests.'),
+                ('app_db_query_seconds_total', 'counter', 'Time spent in SQL statements.'),
+                ('app_db_rows_total', 'counter', 'Rows fetched or affected by SQL statements.'),
+            )):
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+                for endpoint, values in sorted(self.queries.items()):
+                    value = f'{values[index]:.6f}' if index == 1 else values[index]
+                    lines.append(f'{name}{{endpoint="{endpoint}",{worker}}} {value}')
+            
+            lines += ['# HELP app_db_slow_queries_total SQL statements slower than SLOW_QUERY_MS.',
+                      '# TYPE app_db_slow_queries_total counter',
+                      f'app_db_slow_queries_total{{{worker}}} {self.slow_queries}']
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+@event.listens_for(engine, 'before_cursor_execute')
+def metrics_before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+@event.listens_for(engine, 'after_cursor_execute')
+def metrics_after_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('query_start')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    in_request = has_request_context() and 'request_start' in g
+    if in_request:
+        g.query_count += 1
+        g.query_time += elapsed
+        if cursor.rowcount > 0:  # INSERT/UPDATE/DELETE；SELECT 行數喺 fetch 時計
+            g.query_rows += cursor.rowcount
+    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+        metrics.observe_slow_query()
+        slow_log.warning('slow query %.1fms [%s] %s', elapsed * 1000,
+                         request.endpoint if in_request else '-', ' '.join(statement.split())[:500])
+
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    g.query_count = 0
+    g.query_time = 0.0
+    g.query_rows = 0
+    g.profile_queries = PROFILE_QUERIES or (request.args.get('_profile') == '1' and 'employee_id' in session)
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_start' not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_start
+    endpoint = request.endpoint or 'unknown'
+    metrics.observe_request(endpoint, request.method, response.status_code, elapsed,
+                            g.query_count, g.query_time, g.query_rows)
+    if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+        slow_log.warning('slow request %.1fms %s %s: %d queries, db %.1fms', elapsed * 1000,
+                         request.method, request.path, g.query_count, g.query_time * 1000)
+    if g.profile_queries:
+        total_ms = elapsed * 1000
+        db_ms = g.query_time * 1000
+        response.headers['X-Query-Count'] = str(g.query_count)
+        response.headers['X-Query-Rows'] = str(g.query_rows)
+        response.headers['Server-Timing'] = f'db;dur={db_ms:.1f};desc="{g.query_count} queries", total;dur={total_ms:.1f}'
+        app.logger.info('%s %s: %d queries, %d rows, db %.1fms, total %.1fms',
+                        request.method, request.path, g.query_count, g.query_rows, db_ms, total_ms)
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if not METRICS_ENABLED:
+        return Response('not found\n', status=404, mimetype='text/plain')
+    token_ok = METRICS_TOKEN and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}')
+    if not (token_ok or 'employee_id' in session):
+        return Response('unauthorized\n', status=401, mimetype='text/plain')
+    response = Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+# ============ Keyset Pagination ============
+PAGE_SIZE_DEFAULT = 50
+PAGE_SIZE_MAX = 200
+PAGE_SIZE_CHOICES = (20, 50, 100, 200)  # 分頁列既下拉選項
+COUNT_CACHE_TTL = 30  # 秒；總數只作顯示，容許少少延遲
+
+_count_cache = {}
+_count_lock = threading.Lock()
+
+def get_page_size():
+    """從 ?per_page= 讀取每頁筆數"""
+    per_page = request.args.get('per_page', PAGE_SIZE_DEFAULT, type=int)
+    return max(1, min(per_page, PAGE_SIZE_MAX))
+
+def encode_cursor(values):
+    raw = json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+# cursor 入面每個值只可以係欄位對應既 JSON 類型 (DateTime 用 ISO 字串)
+CURSOR_VALUE_TYPES = ((DateTime, str), (Integer, int), (Float, (int, float)), (String, str))
+
+def _cursor_value(col, value):
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        raise TypeError('cursor 值唔可以係 true/false')
+    for col_type, json_type in CURSOR_VALUE_TYPES:
+        if isinstance(col.type, col_type):
+            if not isinstance(value, json_type):
+                raise TypeError(f'{col.key} 類型唔啱')
+            return datetime.fromisoformat(value) if col_type is DateTime else value
+    raise TypeError(f'{col.key} 唔支援做 cursor')
+
+def decode_cursor(cursor, columns):
+    """解碼 cursor，格式或者類型唔啱就返回 None (當第一頁處理)"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+        if not isinstance(values, list) or len(values) != len(columns):
+            return None
+        return [_cursor_value(col, v) for col, v in zip(columns, values)]
+    except (ValueError, TypeError):
+        return None
+
+def keyset_paginate(query, columns, descending=False, per_page=PAGE_SIZE_DEFAULT):
+    """按 columns (最後一個要唯一，通常係 id) 做 seek 分頁，cursor 由 ?after= / ?before= 讀取
+    
+    返回 {'items', 'next_cursor', 'prev_cursor', 'per_page'}
+    """
+    after = request.args.get('after')
+    before = request.args.get('before')
+    key = tuple_(*columns)
+    backward = False
+    
+    if before and decode_cursor(before, columns):
+        values = tuple_(*decode_cursor(before, columns))
+        query = query.filter(key > values if descending else key < values)
+        backward = True
+    elif after and decode_cursor(after, columns):
+        values = tuple_(*decode_cursor(after, columns))
+        query = query.filter(key < values if descending else key > values)
+    else:
+        after = None
+    
+    # 向後翻頁時反轉排序，攞完再倒返轉
+    reverse = descending != backward
+    order = [c.desc() if reverse else c.asc() for c in columns]
+    rows = query.order_by(*order).limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    items = rows[:per_page]
+    if backward:
+        items.reverse()
+    
+    def cursor_of(item):
+        return encode_cursor([getattr(item, c.key) for c in columns])
+    
+    next_cursor = prev_cursor = None
+    if items:
+        if backward:
+            next_cursor = cursor_of(items[-1])
+            prev_cursor = cursor_of(items[0]) if has_more else None
+        else:
+            next_cursor = cursor_of(items[-1]) if has_more else None
+            prev_cursor = cursor_of(items[0]) if after else None
+    
+    return {'items': items, 'next_cursor': next_cursor, 'prev_cursor': prev_cursor, 'per_page': per_page}
+
+def page_url(**changes):
+    """保留目前既查詢參數，換走 cursor"""
+    args = {k: v for k, v in request.args.items() if k not in ('after', 'before')}
+    args.update({k: v for k, v in changes.items() if v})
+    return url_for(request.endpoint, **request.view_args, **args)
+
+def cached_count(table, query, *key):
+    """總數快取 (按表名 + 篩選條件)，資料有變時用 invalidate_counts() 清走"""
+    cache_key = (table,) + key
+    now = time.monotonic()
+    hit = _count_cache.get(cache_key)
+    if hit and now - hit[1] < COUNT_CACHE_TTL:
+        return hit[0]
+    total = query.order_by(None).count()
+    with _count_lock:
+        _count_cache[cache_key] = (total, now)
+    return total
+
+def invalidate_counts(*tables):
+    with _count_lock:
+        for cache_key in [k for k in _count_cache if k[0] in tables]:
+            del _count_cache[cache_key]
+
+def build_page(query, columns, table, *count_key, descending=False):
+    """分頁 + 總數 + 上下頁連結，畀列表頁用"""
+    page = keyset_paginate(query, columns, descending=descending, per_page=get_page_size())
+    page['total'] = cached_count(table, query, *count_key)
+    page['next_url'] = page_url(after=page['next_cursor']) if page['next_cursor'] else None
+    page['prev_url'] = page_url(before=page['prev_cursor']) if page['prev_cursor'] else None
+    page['page_sizes'] = sorted(set(PAGE_SIZE_CHOICES) | {page['per_page']})
+    return page
+
+def hk_day(utc_dt=None):
+    """UTC 時間 (naive) 轉做香港日期字串 YYYY-MM-DD"""
+    utc_dt = utc_dt or datetime.utcnow()
+    return pytz.utc.localize(utc_dt).astimezone(hk_tz).strftime('%Y-%m-%d')
+
+def _daily_revenue_upsert():
+    stmt = sqlite_insert(DailyRevenue.__table__)
+    excluded = stmt.excluded
+    table = DailyRevenue.__table__.c
+    return stmt.on_conflict_do_update(
+        index_elements=['day', 'tier', 'source'],
+        set_={
+            'count': table.count + excluded.count,
+            'original_total': table.original_total + excluded.original_total,
+            'discount_total': table.discount_total + excluded.discount_total,
+            'final_total': table.final_total + excluded.final_total,
+            'balance_total': table.balance_total + excluded.balance_total,
+            'cash_total': table.cash_total + excluded.cash_total,
+        },
+    )
+
+DAILY_REVENUE_UPSERT = _daily_revenue_upsert()
+
+def record_daily_revenue(db, day, tier, source, original=0, discount=0, final=0, balance=0, cash=0, count=1):
+    """累加一筆到 daily_revenue (同一個 transaction 內 upsert)；刪除記錄用 count=-1 同負數金額"""
+    db.execute(DAILY_REVENUE_UPSERT, dict(
+        day=day, tier=tier, source=source, count=count,
+        original_total=original, discount_total=discount, final_total=final,
+        balance_total=balance, cash_total=cash,
+    ))
+
+def rebuild_daily_revenue():
+    """全量重建 daily_revenue (歷史資料補數用)，返回行數"""
+    with engine.begin() as conn:
+        conn.execute(text('DELETE FROM daily_revenue'))
+        conn.execute(text("""
+            INSERT INTO daily_revenue (day, tier, source, count, original_total, discount_total,
+                                       final_total, balance_total, cash_total)
+            SELECT date(t.created_at, '+8 hours'), COALESCE(m.tier, '非會員'), 'checkout', COUNT(*),
+                   SUM(t.original_amount), SUM(COALESCE(t.discount_amount, 0)), SUM(t.final_amount),
+                   SUM(COALESCE(t.paid_from_balance, 0)), SUM(COALESCE(t.cash_paid, 0))
+            FROM transactions t LEFT JOIN members m ON m.id = t.member_id
+            WHERE t.created_at IS NOT NULL
+            GROUP BY 1, 2
+        """))
+        conn.execute(text("""
+            INSERT INTO daily_revenue (day, tier, source, count, original_total, discount_total,
+                                       final_total, balance_total, cash_total)
+            SELECT date(visit_date), '顧客', 'visit', COUNT(*),
+                   SUM(COALESCE(amount, 0)), 0, SUM(COALESCE(amount, 0)), 0, 0
+            FROM visit_records
+            WHERE visit_date IS NOT NULL AND transaction_id IS NULL
+            GROUP BY 1
+        """))
+        return conn.execute(text('SELECT COUNT(*) FROM daily_revenue')).scalar()
+
+def ensure_daily_revenue():
+    """舊資料庫第一次啟動時補建每日營業額"""
+    with engine.connect() as conn:
+        empty = conn.execute(text('SELECT 1 FROM daily_revenue LIMIT 1')).first() is None
+        has_history = (conn.execute(text('SELECT 1 FROM transactions LIMIT 1')).first() is not None or
+                       conn.execute(text('SELECT 1 FROM visit_records LIMIT 1')).first() is not None)
+    if empty and has_history:
+        rebuild_daily_revenue()
+
+ensure_daily_revenue()
+
+# ============ Customer Stats ============
+# visits / total_spent / avg_spend 由 SQLite trigger 跟住 visit_records 增減，
+# ORM、raw SQL、批量匯入都一樣會更新，唔使每個寫入位自己計
+CUSTOMER_STATS_TRIGGERS = {
+    'trg_visit_records_insert': """
+        AFTER INSERT ON visit_records BEGIN
+            UPDATE customers SET
+                visits = COALESCE(visits, 0) + 1,
+                total_spent = COALESCE(total_spent, 0) + COALESCE(NEW.amount, 0),
+                avg_spend = (COALESCE(total_spent, 0) + COALESCE(NEW.amount, 0)) / (COALESCE(visits, 0) + 1)
+            WHERE id = NEW.customer_id;
+        END""",
+    'trg_visit_records_delete': """
+        AFTER DELETE ON visit_records BEGIN
+            UPDATE customers SET
+                visits = MAX(COALESCE(visits, 0) - 1, 0),
+                total_spent = COALESCE(total_spent, 0) - COALESCE(OLD.amount, 0),
+                avg_spend = CASE WHEN COALESCE(visits, 0) > 1
+                    THEN (COALESCE(total_spent, 0) - COALESCE(OLD.amount, 0)) / (visits - 1) ELSE 0 END
+            WHERE id = OLD.customer_id;
+        END""",
+    # 改金額或者改顧客 = 舊記錄減走 + 新記錄加返
+    'trg_visit_records_update': """
+        AFTER UPDATE OF customer_id, amount ON visit_records BEGIN
+            UPDATE customers SET
+                visits = MAX(COALESCE(visits, 0) - 1, 0),
+                total_spent = COALESCE(total_spent, 0) - COALESCE(OLD.amount, 0),
+                avg_spend = CASE WHEN COALESCE(visits, 0) > 1
+                    THEN (COALESCE(total_spent, 0) - COALESCE(OLD.amount, 0)) / (visits - 1) ELSE 0 END
+            WHERE id = OLD.customer_id;
+            UPDATE customers SET
+                visits = COALESCE(visits, 0) + 1,
+                total_spent = COALESCE(total_spent, 0) + COALESCE(NEW.amount, 0),
+                avg_spend = (COALESCE(total_spent, 0) + COALESCE(NEW.amount, 0)) / (COALESCE(visits, 0) + 1)
+            WHERE id = NEW.customer_id;
+        END""",
+}
+CUSTOMER_STATS_BATCH = 5000
+
+def ensure_customer_stats_triggers():
+    """每次啟動重建 trigger (定義有改都會生效)"""
+    with engine.begin() as conn:
+        for name, body in CUSTOMER_STATS_TRIGGERS.items():
+            conn.execute(text(f'DROP TRIGGER IF EXISTS {name}'))
+            conn.execute(text(f'CREATE TRIGGER {name} {body}'))
+
+ensure_customer_stats_triggers()
+
+def recompute_customer_stats(dry_run=False):
+    """由 visit_records 一次過重算所有顧客統計 (分批，每批一個 transaction)
+    
+    返回 {'customers': 總數, 'drifted': 唔啱既數目, 'visits_drift': 次數差, 'spent_drift': 金額差}
+    """
+    actual = """
+        SELECT c.id, COUNT(v.id) AS visits, COALESCE(SUM(v.amount), 0) AS total_spent
+        FROM customers c LEFT JOIN visit_records v ON v.customer_id = c.id
+        WHERE c.id BETWEEN :lo AND :hi
+        GROUP BY c.id
+    """
+    drifted = """(COALESCE(customers.visits, 0) != a.visits
+        OR ABS(COALESCE(customers.total_spent, 0) - a.total_spent) > 0.005
+        OR ABS(COALESCE(customers.avg_spend, 0) - CASE WHEN a.visits > 0 THEN a.total_spent / a.visits ELSE 0 END) > 0.005)"""
+    report = {'customers': 0, 'drifted': 0, 'visits_drift': 0, 'spent_drift': 0.0}
+    
+    with engine.connect() as conn:
+        max_id = conn.execute(text('SELECT COALESCE(MAX(id), 0) FROM customers')).scalar()
+    for lo in range(1, max_id + 1, CUSTOMER_STATS_BATCH):
+        params = {'lo': lo, 'hi': lo + CUSTOMER_STATS_BATCH - 1}
+        with engine.begin() as conn:
+            row = conn.execute(text(f"""
+                SELECT COUNT(*), SUM({drifted}),
+                       SUM(a.visits - COALESCE(customers.visits, 0)),
+                       SUM(a.total_spent - COALESCE(customers.total_spent, 0))
+                FROM customers JOIN ({actual}) a ON a.id = customers.id
+            """), params).one()
+            report['customers'] += row[0]
+            report['drifted'] += row[1] or 0
+            report['visits_drift'] += row[2] or 0
+            report['spent_drift'] += row[3] or 0
+            if not dry_run and row[1]:
+                conn.execute(text(f"""
+                    UPDATE customers SET
+                        visits = a.visits,
+                        total_spent = a.total_spent,
+                        avg_spend = CASE WHEN a.visits > 0 THEN a.total_spent / a.visits ELSE 0 END
+                    FROM ({actual}) a
+                    WHERE a.id = customers.id AND {drifted}
+                """), params)
+    report['spent_drift'] = round(report['spent_drift'], 2)
+    return report
+
+# ============ Guest Profile ============
+# 每個會員都對應一個顧客 (members.customer_id，unique 索引)：訪問、消費統計、喜好、過敏放顧客嗰邊，
+# 會員只管等級、儲值同權益；合併資料用 joinedload 一條 JOIN 攞晒。舊資料按 phone_key 配對，配唔到就幫會員開顧客
+MEMBER_LINK_BATCH = 5000
+
+def link_member_customers(conn, lo, hi):
+    """將 id 喺 lo..hi 未連結既會員連去同電話既顧客 (冇就新建)，返回 (連結數, 新建顧客數)
+
+    按 phone_key 配對 (舊資料冇 key 就用原始電話)；同一批入面同一個電話只揀 id 最細既會員，
+    唔會幫佢哋開兩個顧客
+    """
+    params = {'lo': lo, 'hi': hi}
+    # 兩個 NOT EXISTS 分開寫，phone_key / phone 各自行 unique 索引 (用 OR 會變全表掃描)
+    created = conn.execute(text("""
+        INSERT INTO customers (name, phone, phone_key, visits, total_spent, avg_spend, points, created_at, updated_at)
+        SELECT m.name, m.phone, m.phone_key, 0, 0, 0, 0, datetime('now'), datetime('now')
+        FROM members m
+        WHERE m.id IN (SELECT MIN(id) FROM members
+                       WHERE id BETWEEN :lo AND :hi AND customer_id IS NULL
+                       GROUP BY COALESCE(phone_key, phone))
+          AND NOT EXISTS (SELECT 1 FROM customers c WHERE c.phone_key = m.phone_key)
+          AND NOT EXISTS (SELECT 1 FROM customers c WHERE c.phone = m.phone)
+        RETURNING id, name, phone
+    """), params).all()
+    _write_search_terms(conn, 'customer', created)
+    # 同電話既顧客已經連咗另一個會員 (會員改過電話) 就唔連，留返 NULL
+    linked = conn.execute(text("""
+        UPDATE OR IGNORE members SET customer_id = pick.customer_id
+        FROM (
+            SELECT MIN(m.id) AS member_id,
+                   COALESCE((SELECT MIN(c.id) FROM customers c WHERE c.phone_key = m.phone_key),
+                            (SELECT MIN(c.id) FROM customers c WHERE c.phone = m.phone)) AS customer_id
+            FROM members m
+            WHERE m.id BETWEEN :lo AND :hi AND m.customer_id IS NULL
+            GROUP BY COALESCE(m.phone_key, m.phone)
+        ) pick
+        WHERE members.id = pick.member_id AND pick.customer_id IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM members linked WHERE linked.customer_id = pick.customer_id)
+    """), params).rowcount
+    return linked, len(created)
+
+def link_all_member_customers():
+    """所有未連結既會員分批配對 (每批一個 transaction)，返回 {'linked': 連結數, 'created': 新建顧客數}"""
+    report = {'linked': 0, 'created': 0}
+    with engine.connect() as conn:
+        lo, hi = conn.execute(text('SELECT MIN(id), MAX(id) FROM members WHERE customer_id IS NULL')).one()
+    if lo is None:
+        return report
+    for start in range(lo, hi + 1, MEMBER_LINK_BATCH):
+        with engine.begin() as conn:
+            linked, created = link_member_customers(conn, start, start + MEMBER_LINK_BATCH - 1)
+        report['linked'] += linked
+        report['created'] += created
+    return report
+
+def ensure_member_customers():
+    """舊資料庫第一次啟動時配對會員同顧客"""
+    with engine.connect() as conn:
+        pending = conn.execute(text('SELECT 1 FROM members WHERE customer_id IS NULL LIMIT 1')).first()
+    if pending:
+        link_all_member_customers()
+
+ensure_member_customers()
+
+def guest_customer(db, name, phone):
+    """新會員要連既顧客：同電話既顧客 (未連其他會員)，冇就新建；已經連咗返回 None"""
+    phone_key = normalize_phone(phone)
+    customer = phone_key and db.query(Customer).options(joinedload(Customer.member)).filter_by(phone_key=phone_key).first()
+    if customer is None:
+        customer = Customer(name=name, phone=phone, visits=0, total_spent=0, avg_spend=0, points=0)
+        db.add(customer)
+    elif customer.member is not None:
+        return None
+    return customer
+
+def relink_member_customer(db, member):
+    """會員改咗電話之後同步顧客連結，返回錯誤訊息 (冇問題返回 None)
+
+    新電話已經有顧客就連過去；冇就當同一個人換號碼，連埋原本既顧客一齊改電話
+    """
+    customer = member.customer
+    if customer is not None and customer.phone_key == member.phone_key:
+        return None
+    other = member.phone_key and db.query(Customer).options(joinedload(Customer.member)).filter_by(
+        phone_key=member.phone_key).first()
+    if other:
+        if other.member is not None and other.member.id != member.id:
+            return '此電話既顧客資料已連結其他會員'
+        member.customer = other
+    elif customer is not None:
+        customer.phone = member.phone
+    else:
+        member.customer = Customer(name=member.name, phone=member.phone, visits=0, total_spent=0, avg_spend=0, points=0)
+    return None
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -196,25 +1672,31 @@ def index():
 # --- 員工登入 ---
 @app.route('/login', methods=['GET', 'POST'])
 def login():
-    db = get_db_session()
-    settings_obj = db.query(Settings).first()
-    dark_mode = settings_obj.dark_mode if settings_obj else 0
-    db.close()
+    dark_mode = get_settings()['dark_mode']
     
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
         
+        if login_blocked(username):
+            flash('登入失敗次數太多，請稍後再試', 'error')
+            return render_template('login.html', dark_mode=dark_mode), 429
+        
         db = get_db_session()
         employee = db.query(Employee).filter_by(username=username).first()
         
-        if employee and employee.password == password:
+        if verify_password(employee, password):
+            db.commit()  # 舊明文 / 舊 work factor 已經換做新 hash
+            clear_login_failures(username)
+            session.clear()
+            session.regenerate()
             session['employee_id'] = employee.id
             session['employee_name'] = employee.name
             db.close()
             return redirect(url_for('dashboard'))
         
         db.close()
+        record_login_failure(username)
         flash('用戶名或密碼錯誤', 'error')
     
     return render_template('login.html', dark_mode=dark_mode)
@@ -241,7 +1723,7 @@ def register_employee():
             db.close()
             return render_template('register_employee.html')
         
-        employee = Employee(username=username, password=password, name=name)
+        employee = Employee(username=username, password=hash_password(password), name=name)
         db.add(employee)
         db.commit()
         db.close()
@@ -255,15 +1737,15 @@ def register_employee():
 @app.route('/dashboard')
 @login_required
 def dashboard():
+    live_event_id = event_bus.latest_id()  # 要喺查詢之前攞，之後既變更由 SSE 補
     db = get_db_session()
-    member_count = db.query(Member).count()
-    customer_count = db.query(Customer).count()
+    kpis = get_kpis(db)
     employee_name = session.get('employee_name')
     
     # 獲取設定
-    settings_obj = db.query(Settings).first()
-    restaurant_name = settings_obj.restaurant_name if settings_obj else '我的餐廳'
-    dark_mode = settings_obj.dark_mode if settings_obj else 0
+    settings_data = get_settings()
+    restaurant_name = settings_data['restaurant_name']
+    dark_mode = settings_data['dark_mode']
     
     # 今日預訂 (香港時區 UTC+8)
     import pytz
@@ -277,35 +1759,25 @@ def dashboard():
         Reservation.status.in_(['confirmed', 'seated', 'booked'])
     ).order_by(Reservation.date).all()
     
-    # 今日營業額（從transactions表或顧客消費計算）
-    from sqlalchemy import func as sql_func
-    today_revenue = db.query(
-        sql_func.sum(Customer.total_spent)
-    ).scalar() or 0
-    
     # 最近加入的會員
     recent_members = db.query(Member).order_by(Member.effective_date.desc()).limit(5).all()
     
-    # 總會員儲值
-    total_balance = db.query(
-        sql_func.sum(Member.balance)
-    ).scalar() or 0
-    
     # 今日日期字符串
     today_str = today.strftime('%Y-%m-%d')
     
     db.close()
     return render_template('dashboard.html', 
-                         member_count=member_count, 
-                         customer_count=customer_count,
+                         member_count=kpis['member_count'], 
+                         customer_count=kpis['customer_count'],
                          employee_name=employee_name,
                          restaurant_name=restaurant_name,
                          dark_mode=dark_mode,
                          today_reservations=today_reservations,
-                         today_revenue=today_revenue,
+                         today_revenue=kpis['today_revenue'],
                          recent_members=recent_members,
-                         total_balance=total_balance,
-                         today_str=today_str)
+                         total_balance=kpis['total_balance'],
+                         today_str=today_str,
+                         live_event_id=live_event_id)
 
 # --- 會員管理 ---
 @app.route('/members')
@@ -313,15 +1785,14 @@ def dashboard():
 def members():
     db = get_db_session()
     search = request.args.get('search', '').strip()
+    sort = request.args.get('sort', 'id')
+    query = db.query(Member).options(joinedload(Member.customer))
     if search:
-        members_list = db.query(Member).filter(
-            (Member.name.like(f'%{search}%')) | 
-            (Member.phone.like(f'%{search}%'))
-        ).all()
-    else:
-        members_list = db.query(Member).all()
+        query = query.filter(Member.id.in_(search_ids_query(db, 'member', search)))
+    columns = [Member.name, Member.id] if sort == 'name' else [Member.id]
+    page = build_page(query, columns, 'members', search)
     db.close()
-    return render_template('members.html', members=members_list, search=search)
+    return render_template('members.html', members=page['items'], page=page, search=search)
 
 @app.route('/members/add', methods=['GET', 'POST'])
 @login_required
@@ -335,10 +1806,13 @@ def add_member():
         
         db = get_db_session()
         
-        # 檢查手機是否已存在
-        existing = db.query(Member).filter_by(phone=phone).first()
-        if existing:
-            flash('此手機號碼已註冊', 'error')
+        # 檢查手機是否已存在 (唔理格式)
+        try:
+            error = '此手機號碼已註冊' if find_by_phone(db, Member, phone) else None
+        except PhoneError as e:
+            error = str(e)
+        if error:
+            flash(error, 'error')
             db.close()
             return render_template('add_member.html')
         
@@ -362,10 +1836,12 @@ def add_member():
             omakase_used=0,
             effective_date=effective_date,
             expiry_date=expiry_date,
-            created_by_employee_id=session['employee_id']
+            created_by_employee_id=session['employee_id'],
+            customer=guest_customer(db, name, phone),
         )
         db.add(member)
         db.commit()
+        invalidate_counts('members', 'customers')
         db.close()
         
         flash('會員註冊成功', 'success')
@@ -373,15 +1849,128 @@ def add_member():
     
     return render_template('add_member.html')
 
+GENERAL_BENEFIT = 'general'  # 通用權益次數 (benefits_total)，唔分週期
+
+def _benefit_slots(member, benefit):
+    """返回 (每週期上限, 週期, 已用次數欄位, 週期欄位)"""
+    if benefit == GENERAL_BENEFIT:
+        return member.benefits_total or 0, '-', 'benefits_used', None
+    config = BENEFITS[benefit]
+    return (config['tiers'].get(member.tier, 0), benefit_period(benefit),
+            config['used_column'], config['period_column'])
+
+def redeem_benefit(db, member, benefit, employee_id=None):
+    """扣用一次權益，成功返回本週期已用次數，用完返回 None
+    
+    每次使用係 benefit_usage 入面一行 (member, benefit, period, slot)，unique 約束保證
+    同一個位只可以用一次，兩部機同時扣都唔會超額。Member 上面既次數只係由 ledger 計出嚟既快取。
+    """
+    limit, period, used_column, period_column = _benefit_slots(member, benefit)
+    usage = BenefitUsage.__table__
+    count_query = db.query(func.count(BenefitUsage.id)).filter(
+        BenefitUsage.member_id == member.id, BenefitUsage.benefit == benefit,
+        BenefitUsage.period == period, BenefitUsage.voided_at.is_(None))
+    
+    # ledger 只會加唔會刪，由已用次數之後既位開始試
+    for slot in range(count_query.scalar() + 1, limit + 1):
+        inserted = db.execute(sqlite_insert(usage).values(
+            member_id=member.id, benefit=benefit, period=period, slot=slot,
+            employee_id=employee_id, created_at=datetime.utcnow(),
+        ).on_conflict_do_nothing()).rowcount
+        if inserted:
+            used = count_query.scalar()
+            values = {used_column: used}
+            if period_column:
+                values[period_column] = period
+            db.execute(update(Member).where(Member.id == member.id).values(values)
+                       .execution_options(synchronize_session=False))
+            db.commit()
+            return used
+    
+    db.rollback()
+    return None
+
+def ensure_benefit_ledger():
+    """舊資料庫第一次啟動時，將原有已用次數轉做 ledger 記錄"""
+    db = Session()
+    try:
+        if db.query(BenefitUsage.id).first() is not None:
+            return
+        rows = []
+        members_used = db.query(Member.id, Member.benefits_used, Member.dessert_coffee_used,
+                                Member.dessert_coffee_period, Member.omakase_used, Member.omakase_period).filter(
+            (Member.benefits_used > 0) | (Member.dessert_coffee_used > 0) | (Member.omakase_used > 0))
+        for m in members_used:
+            for benefit, used, period in ((GENERAL_BENEFIT, m.benefits_used, '-'),
+                                          ('dessert_coffee', m.dessert_coffee_used, m.dessert_coffee_period),
+                                          ('omakase', m.omakase_used, m.omakase_period)):
+                rows.extend({'member_id': m.id, 'benefit': benefit, 'period': period or '-', 'slot': slot,
+                             'employee_id': None, 'created_at': datetime.utcnow()}
+                            for slot in range(1, (used or 0) + 1))
+        if rows:
+            db.execute(BenefitUsage.__table__.insert(), rows)
+            db.commit()
+    finally:
+        db.close()
+
+ensure_benefit_ledger()
+
+def run_benefit_resets(when=None):
+    """週期交界批量重置權益次數；每個週期只會做一次，停機後補跑都安全
+    
+    返回 {benefit: 重置咗既會員數}，已經重置過既週期唔會出現
+    """
+    results = {}
+    db = get_db_session()
+    try:
+        for benefit, config in BENEFITS.items():
+            period = benefit_period(benefit, when)
+            if db.query(BenefitReset.id).filter_by(benefit=benefit, period=period).first():
+                continue
+            member_period = getattr(Member, config['period_column'])
+            rows = db.execute(
+                update(Member)
+                .where(Member.tier.in_(list(config['tiers'])), member_period.is_distinct_from(period))
+                .values({config['used_column']: 0, config['period_column']: period})
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            db.execute(sqlite_insert(BenefitReset.__table__)
+                       .values(benefit=benefit, period=period, rows=rows, reset_at=datetime.utcnow())
+                       .on_conflict_do_nothing())
+            db.commit()
+            results[benefit] = rows
+    finally:
+        db.close()
+    return results
+
+BENEFIT_RESET_INTERVAL = int(os.environ.get('BENEFIT_RESET_INTERVAL', 300))  # 秒
+_benefit_scheduler_started = False
+
+def start_benefit_scheduler():
+    """背景 thread 定時檢查週期有冇轉，有就批量重置 (每個 worker 一個，重置本身係 idempotent)"""
+    global _benefit_scheduler_started
+    if _benefit_scheduler_started or os.environ.get('BENEFIT_SCHEDULER', '1') != '1':
+        return
+    _benefit_scheduler_started = True
+    
+    def loop():
+        while True:
+            try:
+                run_benefit_resets()
+            except Exception:
+                app.logger.exception('權益重置失敗')
+            time.sleep(BENEFIT_RESET_INTERVAL)
+    
+    threading.Thread(target=loop, name='benefit-scheduler', daemon=True).start()
+
 @app.route('/members/use_benefit/<int:member_id>', methods=['POST'])
 @login_required
 def use_benefit(member_id):
     db = get_db_session()
-    member = db.query(Member).get(member_id)
+    member = db.get(Member, member_id)
     
-    if member and member.benefits_remaining > 0:
-        member.benefits_used += 1
-        db.commit()
+    if member and redeem_benefit(db, member, GENERAL_BENEFIT, session['employee_id']):
+        db.refresh(member)
         flash(f'已扣用一次權益，剩餘 {member.benefits_remaining} 次', 'success')
     else:
         flash('權益已用完', 'error')
@@ -394,13 +1983,12 @@ def use_benefit(member_id):
 def use_dessert_coffee(member_id):
     """扣用每週甜品咖啡"""
     db = get_db_session()
-    member = db.query(Member).get(member_id)
+    member = db.get(Member, member_id)
     
-    if member and (member.tier == '普通會員' or member.tier == '黑鑽會員'):
-        if member.dessert_coffee_used < 1:
-            member.dessert_coffee_used += 1
-            db.commit()
-            flash(f'已扣用甜品咖啡，共已用 {member.dessert_coffee_used} 次', 'success')
+    if member and member.tier in BENEFITS['dessert_coffee']['tiers']:
+        used = redeem_benefit(db, member, 'dessert_coffee', session['employee_id'])
+        if used:
+            flash(f'已扣用甜品咖啡，共已用 {used} 次', 'success')
         else:
             flash('本週甜品咖啡已用完', 'error')
     else:
@@ -414,13 +2002,12 @@ def use_dessert_coffee(member_id):
 def use_omakase(member_id):
     """扣用年度廚師發辦"""
     db = get_db_session()
-    member = db.query(Member).get(member_id)
+    member = db.get(Member, member_id)
     
-    if member and member.tier == '黑鑽會員':
-        if member.omakase_used < 2:
-            member.omakase_used += 1
-            db.commit()
-            flash(f'已扣用廚師發辦套餐，共已用 {member.omakase_used}/2 次', 'success')
+    if member and member.tier in BENEFITS['omakase']['tiers']:
+        used = redeem_benefit(db, member, 'omakase', session['employee_id'])
+        if used:
+            flash(f'已扣用廚師發辦套餐，共已用 {used}/2 次', 'success')
         else:
             flash('本年度廚師發辦已用完', 'error')
     else:
@@ -434,10 +2021,16 @@ def use_omakase(member_id):
 def reset_weekly(member_id):
     """重置每週權益 (管理員手動)"""
     db = get_db_session()
-    member = db.query(Member).get(member_id)
+    member = db.get(Member, member_id)
     
     if member:
-        member.weekly_dessert_coffee = 0
+        period = benefit_period('dessert_coffee')
+        db.query(BenefitUsage).filter(
+            BenefitUsage.member_id == member.id, BenefitUsage.benefit == 'dessert_coffee',
+            BenefitUsage.period == period, BenefitUsage.voided_at.is_(None)
+        ).update({BenefitUsage.voided_at: datetime.utcnow()}, synchronize_session=False)
+        member.dessert_coffee_used = 0
+        member.dessert_coffee_period = period
         db.commit()
         flash('每週權益已重置', 'success')
     
@@ -456,11 +2049,29 @@ def edit_member(member_id):
         return redirect(url_for('members'))
     
     if request.method == 'POST':
-        member.name = request.form['name']
-        member.phone = request.form['phone']
-        member.tier = request.form.get('tier', '普通會員')
+        try:
+            error = '此手機號碼已註冊' if find_by_phone(db, Member, request.form['phone'], member.id) else None
+        except PhoneError as e:
+            error = str(e)
+        if error:
+            flash(error, 'error')
+            result = render_template('edit_member.html', member=member)
+            db.close()
+            return result
+        
+        member.name = request.form['name']
+        member.phone = request.form['phone']
+        member.tier = request.form.get('tier', '普通會員')
         member.balance = float(request.form.get('balance', 0))
         
+        error = relink_member_customer(db, member)
+        if error:
+            # 用未 commit 既資料顯示返表格，之後 close 會 rollback
+            flash(error, 'error')
+            result = render_template('edit_member.html', member=member)
+            db.close()
+            return result
+        
         effective_date_str = request.form.get('effective_date')
         if effective_date_str:
             member.effective_date = datetime.strptime(effective_date_str, '%Y-%m-%d')
@@ -470,6 +2081,7 @@ def edit_member(member_id):
             member.expiry_date = datetime.strptime(expiry_date_str, '%Y-%m-%d')
         
         db.commit()
+        invalidate_counts('members', 'customers')
         flash('會員資料已更新', 'success')
         db.close()
         return redirect(url_for('members'))
@@ -516,68 +2128,69 @@ def delete_member(member_id):
     if member:
         db.delete(member)
         db.commit()
+        invalidate_counts('members')
         flash('會員已刪除', 'success')
     db.close()
     return redirect(url_for('members'))
 
 # --- 結帳 ---
-@app.route('/checkout', methods=['GET', 'POST'])
-@login_required
-def checkout():
-    db = get_db_session()
-    search_phone = request.args.get('phone', '')
-    
-    # 如果有電話搜尋
-    members = []
-    if search_phone:
-        members = db.query(Member).filter(
-            Member.phone.like(f'%{search_phone}%')
-        ).order_by(Member.name).all()
-    # 如果有指定會員ID
-    preselected_member_id = request.args.get('member_id')
-    if preselected_member_id:
-        member = db.query(Member).get(preselected_member_id)
-        if member and member not in members:
-            members.insert(0, member)
+class CheckoutError(Exception):
+    """結帳失敗，訊息會直接顯示畀員工"""
+
+def _checkout_result(member, transaction):
+    """checkout_result.html 要用既資料"""
+    return dict(member_name=member.name if member else '',
+                member_tier=member.tier if member else '',
+                original_amount=transaction.original_amount,
+                discount_amount=transaction.discount_amount or 0,
+                final_amount=transaction.final_amount,
+                paid_from_balance=transaction.paid_from_balance or 0,
+                cash_paid=transaction.cash_paid or 0,
+                remaining_balance=member.balance if member else 0)
+
+def perform_checkout(db, member_id, original_amount, use_balance, employee_id, idempotency_key=None):
+    """原子結帳，返回結帳結果 dict
     
-    db.close()
+    用 BEGIN IMMEDIATE 攞寫鎖，儲值用條件式 UPDATE 扣減；
+    同一個 idempotency_key 重複提交只會返回第一次既結果，唔會再扣款。
+    """
+    if not member_id:
+        raise CheckoutError('請選擇會員')
+    if original_amount <= 0:
+        raise CheckoutError('金額必須大於 0')
     
-    if request.method == 'POST':
-        member_id = request.form.get('member_id')
-        original_amount = float(request.form.get('original_amount', 0))
-        use_balance = request.form.get('use_balance') == 'on'
-        
-        if not member_id:
-            flash('請選擇會員', 'error')
-            db.close()
-            return render_template('checkout.html', members=members, search_phone=search_phone)
-        
-        member = db.query(Member).get(member_id)
+    db.execute(text('BEGIN IMMEDIATE'))
+    try:
+        if idempotency_key:
+            existing = db.query(Transaction).filter_by(idempotency_key=idempotency_key).first()
+            if existing:
+                db.rollback()
+                return _checkout_result(db.get(Member, existing.member_id), existing)
         
+        member = db.get(Member, member_id)
         if not member:
-            flash('會員不存在', 'error')
-            db.close()
-            return render_template('checkout.html', members=members, search_phone=search_phone)
-        
-        # 獲取會員資料
-        member_name = member.name
-        member_tier = member.tier
-        member_balance = member.balance
+            raise CheckoutError('會員不存在')
         
         # 計算折扣
         discount_amount = 0
-        if member_tier == '黑鑽會員':
+        if member.tier == '黑鑽會員':
             discount_amount = original_amount * 0.20  # 20% 折扣
         
         final_amount = original_amount - discount_amount
         
-        # 計算扣款
+        # 計算扣款 (餘額不足就唔扣，由條件 UPDATE 保證)
         paid_from_balance = 0
-        if use_balance and member_balance > 0:
-            paid_from_balance = min(member_balance, final_amount)
-            member.balance -= paid_from_balance
+        if use_balance and member.balance > 0:
+            paid_from_balance = min(member.balance, final_amount)
+            updated = db.execute(
+                update(Member)
+                .where(Member.id == member.id, Member.balance >= paid_from_balance)
+                .values(balance=Member.balance - paid_from_balance)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            if updated != 1:
+                raise CheckoutError('儲值餘額已變更，請重新結帳')
         
-        remaining_balance = member.balance
         cash_paid = final_amount - paid_from_balance
         
         # 記錄交易
@@ -588,25 +2201,78 @@ def checkout():
             final_amount=final_amount,
             paid_from_balance=paid_from_balance,
             cash_paid=cash_paid,
-            created_by_employee_id=session['employee_id'],
-            note=f"{member_tier} - 折扣${discount_amount:.2f}"
+            created_by_employee_id=employee_id,
+            idempotency_key=idempotency_key,
+            note=f"{member.tier} - 折扣${discount_amount:.2f}"
         )
         db.add(transaction)
+        if member.customer_id:
+            # 消費由 trigger 計入顧客統計；營業額已經記喺 checkout，呢條訪問唔再計
+            db.flush()
+            db.add(VisitRecord(customer_id=member.customer_id, visit_date=now_hk().replace(tzinfo=None),
+                               amount=final_amount, transaction_id=transaction.id, note=f'結帳 #{transaction.id}'))
+        record_daily_revenue(db, hk_day(), member.tier, 'checkout',
+                             original=original_amount, discount=discount_amount, final=final_amount,
+                             balance=paid_from_balance, cash=cash_paid)
+        publish_event(db, 'checkout.completed', {
+            'member_id': member.id, 'final_amount': final_amount,
+            'paid_from_balance': paid_from_balance, 'day': hk_day(),
+        })
         db.commit()
-        db.close()
-        
-        # 顯示結果
-        return render_template('checkout_result.html', 
-                             member_name=member_name,
-                             member_tier=member_tier,
-                             original_amount=original_amount,
-                             discount_amount=discount_amount,
-                             final_amount=final_amount,
-                             paid_from_balance=paid_from_balance,
-                             cash_paid=cash_paid,
-                             remaining_balance=remaining_balance)
-    
-    return render_template('checkout.html', members=members, search_phone=search_phone)
+    except IntegrityError:
+        # 另一個請求啱啱用同一個 key 結咗帳
+        db.rollback()
+        existing = db.query(Transaction).filter_by(idempotency_key=idempotency_key).first()
+        if not existing:
+            raise
+        return _checkout_result(db.get(Member, existing.member_id), existing)
+    except Exception:
+        db.rollback()
+        raise
+    
+    db.refresh(member)
+    return _checkout_result(member, transaction)
+
+@app.route('/checkout', methods=['GET', 'POST'])
+@login_required
+def checkout():
+    db = get_db_session()
+    
+    if request.method == 'POST':
+        try:
+            result = perform_checkout(
+                db,
+                request.form.get('member_id', type=int),
+                request.form.get('original_amount', 0, type=float),
+                request.form.get('use_balance') == 'on',
+                session['employee_id'],
+                request.form.get('idempotency_key') or None,
+            )
+            db.close()
+            # 顯示結果
+            return render_template('checkout_result.html', **result)
+        except CheckoutError as e:
+            flash(str(e), 'error')
+    
+    search_phone = request.args.get('phone', '')
+    
+    # 如果有電話搜尋
+    members = []
+    if search_phone:
+        ids = search_ranked(db, 'member', search_phone)
+        by_id = {m.id: m for m in db.query(Member).options(joinedload(Member.customer)).filter(Member.id.in_(ids))}
+        members = [by_id[i] for i in ids if i in by_id]
+    # 如果有指定會員ID
+    preselected_member_id = request.args.get('member_id', type=int)
+    if preselected_member_id:
+        member = db.get(Member, preselected_member_id, options=[joinedload(Member.customer)])
+        if member and member not in members:
+            members.insert(0, member)
+    
+    result = render_template('checkout.html', members=members, search_phone=search_phone,
+                             idempotency_key=uuid.uuid4().hex)
+    db.close()
+    return result
 
 # --- 顧客管理 ---
 @app.route('/customers')
@@ -614,15 +2280,14 @@ def checkout():
 def customers():
     db = get_db_session()
     search = request.args.get('search', '').strip()
+    sort = request.args.get('sort', 'id')
+    query = db.query(Customer).options(joinedload(Customer.member))
     if search:
-        customers_list = db.query(Customer).filter(
-            (Customer.name.like(f'%{search}%')) | 
-            (Customer.phone.like(f'%{search}%'))
-        ).all()
-    else:
-        customers_list = db.query(Customer).all()
+        query = query.filter(Customer.id.in_(search_ids_query(db, 'customer', search)))
+    columns = [Customer.name, Customer.id] if sort == 'name' else [Customer.id]
+    page = build_page(query, columns, 'customers', search)
     db.close()
-    return render_template('customers.html', customers=customers_list, search=search)
+    return render_template('customers.html', customers=page['items'], page=page, search=search)
 
 @app.route('/customers/add', methods=['GET', 'POST'])
 @login_required
@@ -633,9 +2298,12 @@ def add_customer():
         
         db = get_db_session()
         
-        existing = db.query(Customer).filter_by(phone=phone).first()
-        if existing:
-            flash('此手機號碼已存在', 'error')
+        try:
+            error = '此手機號碼已存在' if find_by_phone(db, Customer, phone) else None
+        except PhoneError as e:
+            error = str(e)
+        if error:
+            flash(error, 'error')
             db.close()
             return render_template('add_customer.html')
         
@@ -660,6 +2328,7 @@ def add_customer():
         )
         db.add(customer)
         db.commit()
+        invalidate_counts('customers')
         db.close()
         
         flash('顧客新增成功', 'success')
@@ -679,6 +2348,16 @@ def edit_customer(customer_id):
         return redirect(url_for('customers'))
     
     if request.method == 'POST':
+        try:
+            error = '此手機號碼已存在' if find_by_phone(db, Customer, request.form['phone'], customer.id) else None
+        except PhoneError as e:
+            error = str(e)
+        if error:
+            flash(error, 'error')
+            result = render_template('edit_customer.html', customer=customer)
+            db.close()
+            return result
+        
         customer.name = request.form['name']
         customer.phone = request.form['phone']
         customer.email = request.form.get('email', '')
@@ -693,6 +2372,7 @@ def edit_customer(customer_id):
         customer.preferences = request.form.get('preferences', '')
         
         db.commit()
+        invalidate_counts('customers')
         flash('顧客資料已更新', 'success')
         db.close()
         return redirect(url_for('customers'))
@@ -708,12 +2388,8 @@ def add_visit(customer_id):
     customer = db.query(Customer).get(customer_id)
     
     if customer:
-        customer.visits += 1
-        # 更新人均消費
-        new_spend = float(request.form.get('spend', 0))
-        if new_spend > 0:
-            customer.avg_spend = ((customer.avg_spend * (customer.visits - 1)) + new_spend) / customer.visits
-        db.commit()
+        # 快速記錄一樣寫入訪問記錄，統計先會同記錄一致
+        create_visit_record(db, customer, {'amount': request.form.get('spend', 0)})
         flash(f'已記錄訪問，總訪問次數: {customer.visits}', 'success')
     
     db.close()
@@ -727,6 +2403,7 @@ def delete_customer(customer_id):
     if customer:
         db.delete(customer)
         db.commit()
+        invalidate_counts('customers')
         flash('顧客已刪除', 'success')
     db.close()
     return redirect(url_for('customers'))
@@ -741,6 +2418,28 @@ def customer_visits(customer_id):
     db.close()
     return render_template('customer_visits.html', customer=customer, visits=visits)
 
+def create_visit_record(db, customer, data):
+    """新增訪問記錄並更新顧客統計同每日營業額，返回 VisitRecord"""
+    # 表單填既係香港時間，冇填就用香港而家時間
+    visit_date = datetime.strptime(data.get('visit_date'), '%Y-%m-%dT%H:%M') if data.get('visit_date') else now_hk().replace(tzinfo=None)
+    amount = float(data.get('amount', 0) or 0)
+    
+    visit = VisitRecord(
+        customer_id=customer.id,
+        visit_date=visit_date,
+        amount=amount,
+        table_number=data.get('table_number', ''),
+        server=data.get('server', ''),
+        party_size=int(data.get('party_size', 1) or 1),
+        note=data.get('note', '')
+    )
+    
+    # 顧客統計由 trigger 更新
+    db.add(visit)
+    record_daily_revenue(db, visit_date.strftime('%Y-%m-%d'), '顧客', 'visit', original=amount, final=amount)
+    db.commit()
+    return visit
+
 @app.route('/customers/<int:customer_id>/visits/add', methods=['GET', 'POST'])
 @login_required
 def add_visit_record(customer_id):
@@ -753,27 +2452,7 @@ def add_visit_record(customer_id):
         return redirect(url_for('customers'))
     
     if request.method == 'POST':
-        visit_date = datetime.strptime(request.form.get('visit_date'), '%Y-%m-%dT%H:%M') if request.form.get('visit_date') else datetime.utcnow()
-        amount = float(request.form.get('amount', 0))
-        
-        visit = VisitRecord(
-            customer_id=customer_id,
-            visit_date=visit_date,
-            amount=amount,
-            table_number=request.form.get('table_number', ''),
-            server=request.form.get('server', ''),
-            party_size=int(request.form.get('party_size', 1)),
-            note=request.form.get('note', '')
-        )
-        
-        # 更新顧客統計
-        customer.visits += 1
-        customer.total_spent += amount
-        if customer.visits > 0:
-            customer.avg_spend = customer.total_spent / customer.visits
-        
-        db.add(visit)
-        db.commit()
+        create_visit_record(db, customer, request.form)
         flash('訪問記錄已添加', 'success')
         db.close()
         return redirect(url_for('customer_visits', customer_id=customer_id))
@@ -781,6 +2460,22 @@ def add_visit_record(customer_id):
     db.close()
     return render_template('add_visit_record.html', customer=customer, now=datetime.utcnow())
 
+@app.route('/customers/<int:customer_id>/visits/<int:visit_id>/delete', methods=['POST'])
+@login_required
+def delete_visit_record(customer_id, visit_id):
+    db = get_db_session()
+    visit = db.query(VisitRecord).filter_by(id=visit_id, customer_id=customer_id).first()
+    if visit:
+        # 顧客統計由 trigger 扣返，每日營業額要自己減 (結帳既訪問營業額計喺 checkout，唔使減)
+        if visit.visit_date and not visit.transaction_id:
+            record_daily_revenue(db, visit.visit_date.strftime('%Y-%m-%d'), '顧客', 'visit',
+                                 original=-(visit.amount or 0), final=-(visit.amount or 0), count=-1)
+        db.delete(visit)
+        db.commit()
+        flash('訪問記錄已刪除', 'success')
+    db.close()
+    return redirect(url_for('customer_visits', customer_id=customer_id))
+
 # --- 顧客互動記錄 ---
 @app.route('/customers/<int:customer_id>/interactions')
 @login_required
@@ -822,6 +2517,7 @@ def add_interaction(customer_id):
 @app.route('/reservations')
 @login_required
 def reservations():
+    live_event_id = event_bus.latest_id()  # 要喺查詢之前攞，之後既變更由 SSE 補
     db = get_db_session()
     date_filter = request.args.get('date')
     search = request.args.get('search', '').strip()
@@ -829,10 +2525,7 @@ def reservations():
     query = db.query(Reservation)
     
     if search:
-        query = query.filter(
-            (Reservation.name.like(f'%{search}%')) | 
-            (Reservation.phone.like(f'%{search}%'))
-        )
+        query = query.filter(Reservation.id.in_(search_ids_query(db, 'reservation', search)))
     
     if date_filter:
         try:
@@ -844,103 +2537,276 @@ def reservations():
         except:
             pass
     
-    reservations_list = query.order_by(Reservation.date.desc()).limit(50).all()
+    page = build_page(query, [Reservation.date, Reservation.id], 'reservations', search, date_filter,
+                      descending=True)
+    reservations_list = page['items']
     
-    # 計算每個電話既預訂次數
-    reservation_counts = {}
-    for res in reservations_list:
-        phone = res.phone
-        if phone:
-            if phone not in reservation_counts:
-                reservation_counts[phone] = db.query(Reservation).filter(Reservation.phone == phone).count()
+    # 計算每個電話既預訂次數 (一條 GROUP BY 搞掂)
+    reservation_counts = count_reservations_by_phone(db, {res.phone_key for res in reservations_list if res.phone_key})
     
     db.close()
-    return render_template('reservations.html', reservations=reservations_list, search=search, reservation_counts=reservation_counts)
+    return render_template('reservations.html', reservations=reservations_list, page=page, search=search,
+                           reservation_counts=reservation_counts, live_event_id=live_event_id)
 
 # --- 預訂日曆 ---
+CALENDAR_MAX_DAYS = 62
+CALENDAR_CACHE_SIZE = 32
+_calendar_cache = {}  # (start, end, live_events 序號) -> JSON 字串
+_calendar_lock = threading.Lock()
+
 @app.route('/reservations/calendar')
 @login_required
 def reservations_calendar():
+    """日曆頁面本身唔帶資料，由 calendar_feed 按月攞"""
+    month = request.args.get('month', '')
+    try:
+        datetime.strptime(month, '%Y-%m')
+    except ValueError:
+        month = now_hk().strftime('%Y-%m')
+    return render_template('reservations_calendar.html', current_month=month)
+
+def calendar_events(db, start, end):
+    """[start, end) 既預訂，只揀日曆要用既欄位"""
+    rows = db.query(
+        Reservation.id, Reservation.name, Reservation.phone, Reservation.date,
+        Reservation.party_size, Reservation.table_number, Reservation.status,
+    ).filter(Reservation.date >= start, Reservation.date < end).order_by(Reservation.date)
+    return [{
+        'id': r.id,
+        'title': f"{r.name} ({r.party_size}位)",
+        'start': r.date.strftime('%Y-%m-%dT%H:%M'),
+        'phone': r.phone,
+        'status': r.status,
+        'table': r.table_number or '-',
+    } for r in rows]
+
+@app.route('/reservations/calendar.json')
+@login_required
+def calendar_feed():
+    """?start=YYYY-MM-DD&end=YYYY-MM-DD (end 唔包)；按 (範圍, 資料版本) cache，預訂一改版本就變"""
+    try:
+        start = datetime.strptime(request.args['start'], '%Y-%m-%d')
+        end = datetime.strptime(request.args['end'], '%Y-%m-%d')
+    except (KeyError, ValueError):
+        return jsonify({'error': 'start / end 格式應為 YYYY-MM-DD'}), 400
+    if not start < end <= start + timedelta(days=CALENDAR_MAX_DAYS):
+        return jsonify({'error': f'範圍最多 {CALENDAR_MAX_DAYS} 日'}), 400
+    
     db = get_db_session()
+    try:
+        version = live_event_seq(db.connection())
+        key = (start, end, version)
+        with _calendar_lock:
+            body = _calendar_cache.get(key)
+        if body is None:
+            body = json.dumps(calendar_events(db, start, end), ensure_ascii=False)
+            with _calendar_lock:
+                if len(_calendar_cache) >= CALENDAR_CACHE_SIZE:
+                    _calendar_cache.clear()
+                _calendar_cache[key] = body
+    finally:
+        db.close()
     
-    # 獲取本月預訂
-    today = datetime.utcnow()
-    month_start = today.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    if today.month == 12:
-        month_end = today.replace(year=today.year+1, month=1, day=1)
-    else:
-        month_end = today.replace(month=today.month+1, day=1)
-    
-    reservations = db.query(Reservation).filter(
-        Reservation.date >= month_start,
-        Reservation.date < month_end
-    ).all()
-    
-    # 轉換為JSON格式
-    events = []
-    for r in reservations:
-        events.append({
-            'id': r.id,
-            'title': f"{r.name} ({r.party_size}位)",
-            'start': r.date.strftime('%Y-%m-%dT%H:%M'),
-            'phone': r.phone,
-            'status': r.status,
-            'table': r.table_number or '-'
-        })
+    response = Response(body, mimetype='application/json')
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.set_etag(f"{start:%Y%m%d}-{end:%Y%m%d}-{version}")
+    return response.make_conditional(request)
+
+# ============ Table Availability ============
+# 每日既預訂按枱整理成已排序既時段 (start 排序 + 前綴最大 end)，查某張枱某個時段得唔得
+# 只係 bisect 一次 O(log n)；預訂一有改動 live_events 序號就會變，cache 自動失效
+RESERVATION_DURATION = int(os.environ.get('RESERVATION_DURATION', 90))  # 分鐘
+RESERVATION_MAX_DURATION = 360  # 分鐘，跨日預訂最多影響前後幾耐
+BLOCKING_STATUSES = ('booked', 'confirmed', 'seated')
+AVAILABILITY_CACHE_DAYS = 14
+
+class ReservationError(Exception):
+    """預訂唔成立 (例如撞枱)，訊息會直接顯示畀員工"""
+
+def split_tables(table_number):
+    return [t.strip() for t in (table_number or '').split('+') if t.strip()]
+
+class DayAvailability:
+    """一日 (連前後跨日) 既預訂時段，按枱分開"""
     
-    db.close()
-    return render_template('reservations_calendar.html', events=events, current_month=today.strftime('%Y-%m'))
+    def __init__(self, rows):
+        by_table = {}
+        for res_id, table_number, start, duration in rows:
+            end = start + timedelta(minutes=duration or RESERVATION_DURATION)
+            for name in split_tables(table_number):
+                by_table.setdefault(name, []).append((start, end, res_id))
+        self._slots = {}
+        for name, slots in by_table.items():
+            slots.sort()
+            max_end, prefix = None, []
+            for _, end, _ in slots:
+                max_end = end if max_end is None or end > max_end else max_end
+                prefix.append(max_end)
+            self._slots[name] = ([s[0] for s in slots], prefix, slots)
+    
+    def conflicts(self, table, start, end):
+        """返回同 [start, end) 重疊既預訂 id"""
+        if table not in self._slots:
+            return []
+        starts, prefix, slots = self._slots[table]
+        i = bisect_left(starts, end) - 1
+        found = []
+        # 前綴最大 end 保證再向前都唔會重疊就可以停
+        while i >= 0 and prefix[i] > start:
+            if slots[i][1] > start:
+                found.append(slots[i][2])
+            i -= 1
+        return found
+    
+    def is_free(self, table, start, end, exclude_id=None):
+        return all(res_id == exclude_id for res_id in self.conflicts(table, start, end))
 
-@app.route('/reservations/add', methods=['GET', 'POST'])
-@login_required
-def add_reservation():
-    db = get_db_session()
+_availability_cache = {}  # day -> (live_events 序號, DayAvailability)
+_availability_lock = threading.Lock()
+
+def live_event_seq(conn):
+    """live_events 最後用過既 id (AUTOINCREMENT，清走舊事件都唔會變細)；預訂一改就會變"""
+    return conn.execute(text("SELECT seq FROM sqlite_sequence WHERE name = 'live_events'")).scalar() or 0
+
+def day_availability(db, day):
+    """day: 00:00 既 datetime"""
+    version = live_event_seq(db.connection())
+    key = day.strftime('%Y-%m-%d')
+    with _availability_lock:
+        cached = _availability_cache.get(key)
+    if cached and cached[0] == version:
+        return cached[1]
+    margin = timedelta(minutes=RESERVATION_MAX_DURATION)
+    # 唔好 autoflush：未 commit 既修改唔可以入 cache
+    with db.no_autoflush:
+        rows = db.query(Reservation.id, Reservation.table_number, Reservation.date, Reservation.duration).filter(
+            Reservation.date >= day - margin,
+            Reservation.date < day + timedelta(days=1) + margin,
+            Reservation.status.in_(BLOCKING_STATUSES),
+            Reservation.table_number.isnot(None),
+            Reservation.table_number != '',
+        ).all()
+    availability = DayAvailability(rows)
+    with _availability_lock:
+        if len(_availability_cache) >= AVAILABILITY_CACHE_DAYS:
+            _availability_cache.clear()
+        _availability_cache[key] = (version, availability)
+    return availability
+
+def available_tables(db, start, party_size, duration=None, exclude_id=None):
+    """邊啲枱 (或者同區兩張可併既枱) 坐得落 party_size 人，由最唔浪費座位排起"""
+    end = start + timedelta(minutes=duration or RESERVATION_DURATION)
+    day = start.replace(hour=0, minute=0, second=0, microsecond=0)
+    availability = day_availability(db, day)
+    free = [t for t in db.query(DiningTable).filter(DiningTable.active == True).order_by(DiningTable.name)
+            if availability.is_free(t.name, start, end, exclude_id)]
     
-    if request.method == 'POST':
-        name = request.form['name']
-        phone = request.form['phone']
-        email = request.form.get('email', '')
-        date = datetime.strptime(request.form['date'] + ' ' + request.form['time'], '%Y-%m-%d %H:%M')
-        
-        # 檢查電話是否已存在於顧客資料庫
-        customer = db.query(Customer).filter(Customer.phone == phone).first()
-        
-        if not customer:
-            # 如果唔存在，自動新增顧客
-            customer = Customer(
-                name=name,
-                phone=phone,
-                email=email,
-                visits=0,
-                total_spent=0,
-                avg_spend=0
-            )
-            db.add(customer)
-            db.commit()
-            db.refresh(customer)
-        
-        # 建立預訂並連結顧客
+    options = [{'tables': [t.name], 'capacity': t.capacity, 'area': t.area or ''}
+               for t in free if t.capacity >= party_size]
+    combinable = [t for t in free if t.combinable]
+    for i, a in enumerate(combinable):
+        for b in combinable[i + 1:]:
+            if (a.area or '') == (b.area or '') and max(a.capacity, b.capacity) < party_size <= a.capacity + b.capacity:
+                options.append({'tables': [a.name, b.name], 'capacity': a.capacity + b.capacity, 'area': a.area or ''})
+    options.sort(key=lambda o: (len(o['tables']), o['capacity']))
+    return options
+
+def check_table_booking(db, reservation):
+    """預訂既座位有冇足夠位、有冇撞時段；唔得就 raise ReservationError"""
+    names = split_tables(reservation.table_number)
+    if not names or reservation.status not in BLOCKING_STATUSES:
+        return
+    with db.no_autoflush:
+        tables = {t.name: t for t in db.query(DiningTable).filter(DiningTable.active == True)}
+    if not tables:
+        return  # 未設定座位資料，同以前一樣當自由輸入
+    
+    missing = [n for n in names if n not in tables]
+    if missing:
+        raise ReservationError(f"座位不存在: {', '.join(missing)}")
+    if len(names) > 1 and not all(tables[n].combinable for n in names):
+        raise ReservationError('呢幾張枱唔可以併枱')
+    capacity = sum(tables[n].capacity for n in names)
+    if (reservation.party_size or 1) > capacity:
+        raise ReservationError(f'座位只坐得 {capacity} 位')
+    
+    start = reservation.date
+    end = start + timedelta(minutes=reservation.duration or RESERVATION_DURATION)
+    availability = day_availability(db, start.replace(hour=0, minute=0, second=0, microsecond=0))
+    for name in names:
+        if not availability.is_free(name, start, end, reservation.id):
+            raise ReservationError(f"座位 {name} 喺 {start.strftime('%H:%M')} 已經有預訂")
+
+def create_reservation(db, data, employee_id):
+    """新增預訂；電話未有顧客記錄就自動新增顧客。返回 Reservation"""
+    name = data['name']
+    phone = data['phone']
+    email = data.get('email', '')
+    date = datetime.strptime(data['date'] + ' ' + data['time'], '%Y-%m-%d %H:%M')
+    phone_key = parse_phone(phone)
+    
+    # 攞寫鎖先檢查座位，兩部機同時訂同一張枱都唔會撞
+    db.execute(text('BEGIN IMMEDIATE'))
+    try:
         reservation = Reservation(
             name=name,
             phone=phone,
             email=email,
             date=date,
-            party_size=int(request.form.get('party_size', 1)),
-            table_number=request.form.get('table_number', ''),
-            status=request.form.get('status', 'booked'),
-            note=request.form.get('note', ''),
-            customer_id=customer.id if customer else None,
-            created_by_employee_id=session['employee_id']
+            party_size=int(data.get('party_size', 1) or 1),
+            duration=int(data['duration']) if data.get('duration') else None,
+            table_number=data.get('table_number', ''),
+            status=data.get('status', 'booked'),
+            note=data.get('note', ''),
+            created_by_employee_id=employee_id
         )
-        
-        db.add(reservation)
-        db.commit()
+        check_table_booking(db, reservation)
+    except Exception:
+        db.rollback()
+        raise
+    
+    # 檢查電話是否已存在於顧客資料庫 (唔理空格 / 國碼格式)
+    customer = phone_key and db.query(Customer).filter(Customer.phone_key == phone_key).first()
+    
+    if not customer:
+        # 如果唔存在，自動新增顧客
+        customer = Customer(
+            name=name,
+            phone=phone,
+            email=email,
+            visits=0,
+            total_spent=0,
+            avg_spend=0
+        )
+        db.add(customer)
+        db.flush()
+    
+    # 連結顧客
+    reservation.customer_id = customer.id
+    db.add(reservation)
+    publish_reservation(db, 'reservation.created', reservation)
+    db.commit()
+    invalidate_counts('reservations', 'customers')
+    return reservation
+
+@app.route('/reservations/add', methods=['GET', 'POST'])
+@login_required
+def add_reservation():
+    db = get_db_session()
+    
+    if request.method == 'POST':
+        try:
+            create_reservation(db, request.form, session['employee_id'])
+        except (ReservationError, PhoneError) as e:
+            db.close()
+            flash(str(e), 'error')
+            return render_template('add_reservation.html', form=request.form)
         flash('預訂已添加', 'success')
         db.close()
         return redirect(url_for('reservations'))
     
     db.close()
-    return render_template('add_reservation.html')
+    return render_template('add_reservation.html', form={})
 
 @app.route('/reservations/<int:res_id>/update', methods=['POST'])
 @login_required
@@ -949,10 +2815,18 @@ def update_reservation(res_id):
     reservation = db.query(Reservation).get(res_id)
     
     if reservation:
+        db.execute(text('BEGIN IMMEDIATE'))
         reservation.status = request.form.get('status')
         reservation.table_number = request.form.get('table_number', '')
-        db.commit()
-        flash('預訂狀態已更新', 'success')
+        try:
+            check_table_booking(db, reservation)
+        except ReservationError as e:
+            db.rollback()
+            flash(str(e), 'error')
+        else:
+            publish_reservation(db, 'reservation.updated', reservation)
+            db.commit()
+            flash('預訂狀態已更新', 'success')
     
     db.close()
     return redirect(url_for('reservations'))
@@ -969,6 +2843,7 @@ def edit_reservation(res_id):
         return redirect(url_for('reservations'))
     
     if request.method == 'POST':
+        db.execute(text('BEGIN IMMEDIATE'))
         reservation.name = request.form.get('name')
         reservation.phone = request.form.get('phone')
         reservation.email = request.form.get('email', '')
@@ -977,10 +2852,23 @@ def edit_reservation(res_id):
         if date_str and time_str:
             reservation.date = datetime.strptime(f'{date_str} {time_str}', '%Y-%m-%d %H:%M')
         reservation.party_size = int(request.form.get('party_size', 1))
+        reservation.duration = request.form.get('duration', type=int)
         reservation.table_number = request.form.get('table_number', '')
         reservation.status = request.form.get('status')
         reservation.note = request.form.get('note', '')
+        try:
+            parse_phone(reservation.phone)
+            check_table_booking(db, reservation)
+        except (ReservationError, PhoneError) as e:
+            # 用未 commit 既資料顯示返表格，之後 close 會 rollback
+            flash(str(e), 'error')
+            result = render_template('edit_reservation.html', reservation=reservation,
+                                     restaurant_name=session.get('restaurant_name', '餐廳'))
+            db.close()
+            return result
+        publish_reservation(db, 'reservation.updated', reservation)
         db.commit()
+        invalidate_counts('reservations')
         flash('預訂已更新', 'success')
         db.close()
         return redirect(url_for('reservations'))
@@ -995,107 +2883,692 @@ def delete_reservation(res_id):
     reservation = db.query(Reservation).get(res_id)
     
     if reservation:
+        publish_event(db, 'reservation.deleted', {'id': reservation.id})
         db.delete(reservation)
         db.commit()
+        invalidate_counts('reservations')
         flash('預訂已刪除', 'success')
     
     db.close()
     return redirect(url_for('reservations'))
 
-# --- 匯出功能 ---
-@app.route('/export/<type>')
+# --- 座位管理 ---
+@app.route('/tables', methods=['GET', 'POST'])
 @login_required
-def export_data(type):
-    import io
-    from openpyxl import Workbook
+def tables():
+    db = get_db_session()
     
+    if request.method == 'POST':
+        name = request.form.get('name', '').strip()
+        if not name or '+' in name:
+            flash('座位名稱唔可以空白或者包含 +', 'error')
+        elif db.query(DiningTable).filter_by(name=name).first():
+            flash('座位名稱已存在', 'error')
+        else:
+            db.add(DiningTable(
+                name=name,
+                capacity=request.form.get('capacity', 2, type=int),
+                area=request.form.get('area', '').strip(),
+                combinable=request.form.get('combinable') == 'on',
+            ))
+            db.commit()
+            flash('座位已新增', 'success')
+        db.close()
+        return redirect(url_for('tables'))
+    
+    tables_list = db.query(DiningTable).order_by(DiningTable.area, DiningTable.name).all()
+    db.close()
+    return render_template('tables.html', tables=tables_list)
+
+@app.route('/tables/<int:table_id>/toggle', methods=['POST'])
+@login_required
+def toggle_table(table_id):
+    db = get_db_session()
+    table = db.get(DiningTable, table_id)
+    if table:
+        table.active = not table.active
+        db.commit()
+    db.close()
+    return redirect(url_for('tables'))
+
+@app.route('/tables/<int:table_id>/delete', methods=['POST'])
+@login_required
+def delete_table(table_id):
+    db = get_db_session()
+    table = db.get(DiningTable, table_id)
+    if table:
+        db.delete(table)
+        db.commit()
+        flash('座位已刪除', 'success')
+    db.close()
+    return redirect(url_for('tables'))
+
+@app.route('/reservations/availability')
+@login_required
+def reservation_availability():
+    """新增/編輯預訂表格用：呢個時段有邊啲枱坐得落"""
+    try:
+        start = datetime.strptime(f"{request.args['date']} {request.args['time']}", '%Y-%m-%d %H:%M')
+    except (KeyError, ValueError):
+        return jsonify({'error': '請輸入日期同時間'}), 400
     db = get_db_session()
-    wb = Workbook()
-    
-    if type == 'members':
-        ws = wb.active
-        ws.title = "會員"
-        ws.append(['ID', '姓名', '電話', '等級', '儲值', '狀態', '入會日期'])
-        members = db.query(Member).all()
-        for m in members:
-            ws.append([m.id, m.name, m.phone, m.tier, m.balance, '有效' if m.is_active else '過期', m.effective_date.strftime('%Y-%m-%d') if m.effective_date else ''])
-        filename = 'members_export.xlsx'
-    
-    elif type == 'customers':
-        ws = wb.active
-        ws.title = "顧客"
-        ws.append(['ID', '姓名', '電話', '電郵', '總消費', '訪問次數'])
-        customers = db.query(Customer).all()
-        for c in customers:
-            ws.append([c.id, c.name, c.phone, c.email or '', c.total_spent, c.visits])
-        filename = 'customers_export.xlsx'
-    
-    elif type == 'reservations':
-        ws = wb.active
-        ws.title = "預訂"
-        ws.append(['ID', '姓名', '電話', '日期', '人數', '座位', '狀態'])
-        reservations = db.query(Reservation).order_by(Reservation.date.desc()).all()
-        for r in reservations:
-            ws.append([r.id, r.name, r.phone, r.date.strftime('%Y-%m-%d %H:%M'), r.party_size, r.table_number or '', r.status])
-        filename = 'reservations_export.xlsx'
+    try:
+        options = available_tables(db, start, request.args.get('party_size', 1, type=int),
+                                   request.args.get('duration', type=int), request.args.get('exclude', type=int))
+    finally:
+        db.close()
+    return jsonify({'options': options})
+
+# ============ Live Events (SSE) ============
+# 寫入時將事件記落 live_events (同一個 transaction)，每個 worker 一個 thread 讀新事件
+# 放入記憶體 ring buffer，SSE 連線由 buffer 攞差異推去前台；多 worker 都睇到同一串事件
+LIVE_EVENT_BUFFER = int(os.environ.get('LIVE_EVENT_BUFFER', 500))  # 每個 worker 記住最近幾多個事件
+LIVE_EVENT_POLL_INTERVAL = float(os.environ.get('LIVE_EVENT_POLL_INTERVAL', 1))  # 秒，睇其他 worker 既事件
+LIVE_EVENT_RETENTION = int(os.environ.get('LIVE_EVENT_RETENTION', 3600))  # 秒，更舊既事件會清走
+LIVE_HEARTBEAT = 15  # 秒，冇事件都送 comment，防 proxy 斷線
+LIVE_STREAM_MAX_SECONDS = int(os.environ.get('LIVE_STREAM_MAX_SECONDS', 300))  # 連線上限，之後由瀏覽器自動重連
+LIVE_MAX_CLIENTS = int(os.environ.get('LIVE_MAX_CLIENTS', 4))  # 每個 worker 最多幾條 SSE (每條佔一個 thread)
+
+def publish_event(db, type, data):
+    """喺目前 transaction 加一個事件，commit 之後先會推出去"""
+    db.add(LiveEvent(type=type, payload=json.dumps(data, ensure_ascii=False, default=str)))
+    db.info['live_events'] = True
+
+def publish_reservation(db, type, reservation):
+    db.flush()
+    publish_event(db, type, {
+        'id': reservation.id, 'name': reservation.name, 'phone': reservation.phone,
+        'date': _iso(reservation.date), 'party_size': reservation.party_size,
+        'table_number': reservation.table_number, 'status': reservation.status,
+    })
+
+class EventBus:
+    """每個 worker 一個：ring buffer + Condition，SSE generator 喺度等新事件"""
     
-    else:
+    def __init__(self, size):
+        self._cond = threading.Condition()
+        self._events = deque(maxlen=size)  # (id, type, payload)
+        self._last_id = None
+        self._floor = None  # buffer 有齊 _floor 之後既所有事件
+        self._wakeup = threading.Event()
+        self._started = False
+        self._last_prune = 0
+        self._clients = 0
+    
+    def start(self):
+        with self._cond:
+            if self._started:
+                return
+            self._started = True
+            self._last_id = self._floor = self.latest_id()
+        threading.Thread(target=self._loop, name='live-events', daemon=True).start()
+    
+    def connect(self):
+        with self._cond:
+            if self._clients >= LIVE_MAX_CLIENTS:
+                return False
+            self._clients += 1
+            return True
+    
+    def disconnect(self):
+        with self._cond:
+            self._clients -= 1
+    
+    def wake(self):
+        """本 worker 寫咗事件，即刻讀，唔使等下一輪"""
+        self._wakeup.set()
+    
+    def latest_id(self):
+        with engine.connect() as conn:
+            return live_event_seq(conn)
+    
+    def _loop(self):
+        while True:
+            self._wakeup.wait(LIVE_EVENT_POLL_INTERVAL)
+            self._wakeup.clear()
+            try:
+                self.poll()
+                if time.time() - self._last_prune > 600:
+                    self._last_prune = time.time()
+                    prune_live_events()
+            except Exception:
+                app.logger.exception('讀取即時事件失敗')
+    
+    def poll(self):
+        with engine.connect() as conn:
+            rows = conn.execute(
+                select(LiveEvent.id, LiveEvent.type, LiveEvent.payload)
+                .where(LiveEvent.id > self._last_id).order_by(LiveEvent.id)
+            ).all()
+        if rows:
+            with self._cond:
+                self._events.extend(tuple(r) for r in rows)
+                self._last_id = rows[-1].id
+                if len(self._events) == self._events.maxlen:
+                    self._floor = self._events[0][0] - 1
+                self._cond.notify_all()
+    
+    def since(self, last_id):
+        """返回 last_id 之後既事件；buffer 已經冇晒咁舊就返回 None"""
+        with self._cond:
+            if last_id < self._floor:
+                return None
+            return [e for e in self._events if e[0] > last_id]
+    
+    def wait(self, last_id, timeout):
+        with self._cond:
+            if self._last_id <= last_id:
+                self._cond.wait(timeout)
+        return self.since(last_id)
+
+event_bus = EventBus(LIVE_EVENT_BUFFER)
+
+@event.listens_for(Session, 'after_commit')
+def wake_event_bus(db):
+    if db.info.pop('live_events', False):
+        event_bus.wake()
+
+@event.listens_for(Session, 'after_rollback')
+def discard_live_events(db):
+    db.info.pop('live_events', None)
+
+def replay_events(last_id):
+    """buffer 冇既舊事件由資料庫補；已經清走咗就返回 None (前台要重新載入)"""
+    with engine.connect() as conn:
+        rows = conn.execute(
+            select(LiveEvent.id, LiveEvent.type, LiveEvent.payload)
+            .where(LiveEvent.id > last_id).order_by(LiveEvent.id).limit(LIVE_EVENT_BUFFER + 1)
+        ).all()
+    if not rows:
+        return []
+    if rows[0].id != last_id + 1 or len(rows) > LIVE_EVENT_BUFFER:
+        return None
+    return [tuple(r) for r in rows]
+
+def prune_live_events():
+    cutoff = datetime.utcnow() - timedelta(seconds=LIVE_EVENT_RETENTION)
+    with engine.begin() as conn:
+        conn.execute(LiveEvent.__table__.delete().where(LiveEvent.created_at < cutoff))
+
+def _sse(event_id, type, payload):
+    return f'id: {event_id}\nevent: {type}\ndata: {payload}\n\n'
+
+@app.route('/events')
+@login_required
+def live_events():
+    """SSE：前台載入頁面一次，之後只收差異；斷線重連用 Last-Event-ID 補返中間既事件"""
+    event_bus.start()
+    if not event_bus.connect():
+        # 爆滿：用 200 + retry 結束，EventSource 會 30 秒後自己重連 (非 200 佢會放棄)
+        response = Response('retry: 30000\n\n', mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    try:
+        last_id = int(request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or -1)
+    except ValueError:
+        last_id = -1
+    
+    def stream():
+        nonlocal last_id
+        yield 'retry: 3000\n\n'
+        if last_id < 0:
+            last_id = event_bus.latest_id()
+        else:
+            missed = event_bus.since(last_id)
+            if missed is None:
+                missed = replay_events(last_id)
+            if missed is None:
+                # 斷線太耐，差異已經補唔返
+                last_id = event_bus.latest_id()
+                yield _sse(last_id, 'reset', '{}')
+                return
+            for event_id, type, payload in missed:
+                yield _sse(event_id, type, payload)
+                last_id = event_id
+            
+        deadline = time.time() + LIVE_STREAM_MAX_SECONDS
+        while time.time() < deadline:
+            events = event_bus.wait(last_id, LIVE_HEARTBEAT)
+            if events is None:
+                last_id = event_bus.latest_id()
+                yield _sse(last_id, 'reset', '{}')
+                return
+            if not events:
+                yield ': ping\n\n'
+            for event_id, type, payload in events:
+                yield _sse(event_id, type, payload)
+                last_id = event_id
+    
+    response = Response(stream_with_context(stream()), mimetype='text/event-stream')
+    response.call_on_close(event_bus.disconnect)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # nginx 唔好 buffer
+    return response
+
+# --- 匯出功能 ---
+EXPORT_BATCH_SIZE = 1000
+
+def _fmt_date(value, fmt='%Y-%m-%d %H:%M'):
+    return value.strftime(fmt) if value else ''
+
+def _member_export_rows(db):
+    now = datetime.utcnow()
+    query = db.query(Member.id, Member.name, Member.phone, Member.tier, Member.balance,
+                     Member.expiry_date, Member.effective_date).order_by(Member.id)
+    for m in query.yield_per(EXPORT_BATCH_SIZE):
+        yield [m.id, m.name, m.phone, m.tier, m.balance,
+               '有效' if not m.expiry_date or now < m.expiry_date else '過期',
+               _fmt_date(m.effective_date, '%Y-%m-%d')]
+
+def _customer_export_rows(db):
+    query = db.query(Customer.id, Customer.name, Customer.phone, Customer.email,
+                     Customer.total_spent, Customer.visits).order_by(Customer.id)
+    for c in query.yield_per(EXPORT_BATCH_SIZE):
+        yield [c.id, c.name, c.phone, c.email or '', c.total_spent, c.visits]
+
+def _reservation_export_rows(db):
+    query = db.query(Reservation.id, Reservation.name, Reservation.phone, Reservation.date,
+                     Reservation.party_size, Reservation.table_number, Reservation.status
+                     ).order_by(Reservation.date.desc(), Reservation.id.desc())
+    for r in query.yield_per(EXPORT_BATCH_SIZE):
+        yield [r.id, r.name, r.phone, _fmt_date(r.date), r.party_size, r.table_number or '', r.status]
+
+def _transaction_export_rows(db):
+    query = db.query(Transaction.id, Transaction.member_id, Member.name, Transaction.original_amount,
+                     Transaction.discount_amount, Transaction.final_amount, Transaction.paid_from_balance,
+                     Transaction.cash_paid, Transaction.created_at, Transaction.note
+                     ).outerjoin(Member, Member.id == Transaction.member_id).order_by(Transaction.id)
+    for t in query.yield_per(EXPORT_BATCH_SIZE):
+        yield [t.id, t.member_id or '', t.name or '', t.original_amount, t.discount_amount or 0,
+               t.final_amount, t.paid_from_balance or 0, t.cash_paid or 0,
+               _fmt_date(t.created_at), t.note or '']
+
+def _visit_record_export_rows(db):
+    query = db.query(VisitRecord.id, VisitRecord.customer_id, Customer.name, VisitRecord.visit_date,
+                     VisitRecord.amount, VisitRecord.table_number, VisitRecord.server,
+                     VisitRecord.party_size, VisitRecord.note
+                     ).outerjoin(Customer, Customer.id == VisitRecord.customer_id).order_by(VisitRecord.id)
+    for v in query.yield_per(EXPORT_BATCH_SIZE):
+        yield [v.id, v.customer_id, v.name or '', _fmt_date(v.visit_date), v.amount or 0,
+               v.table_number or '', v.server or '', v.party_size, v.note or '']
+
+def _interaction_export_rows(db):
+    query = db.query(Interaction.id, Interaction.customer_id, Customer.name, Interaction.type,
+                     Interaction.note, Interaction.created_at
+                     ).outerjoin(Customer, Customer.id == Interaction.customer_id).order_by(Interaction.id)
+    for i in query.yield_per(EXPORT_BATCH_SIZE):
+        yield [i.id, i.customer_id, i.name or '', i.type or '', i.note or '', _fmt_date(i.created_at)]
+
+# 類型: (工作表名稱, 表頭, 逐行產生器)
+EXPORTS = {
+    'members': ('會員', ['ID', '姓名', '電話', '等級', '儲值', '狀態', '入會日期'], _member_export_rows),
+    'customers': ('顧客', ['ID', '姓名', '電話', '電郵', '總消費', '訪問次數'], _customer_export_rows),
+    'reservations': ('預訂', ['ID', '姓名', '電話', '日期', '人數', '座位', '狀態'], _reservation_export_rows),
+    'transactions': ('交易', ['ID', '會員ID', '會員', '原價', '折扣', '實收', '儲值扣款', '現金', '時間', '備註'],
+                     _transaction_export_rows),
+    'visit_records': ('訪問記錄', ['ID', '顧客ID', '顧客', '日期', '金額', '座位', '服務員', '人數', '備註'],
+                      _visit_record_export_rows),
+    'interactions': ('互動記錄', ['ID', '顧客ID', '顧客', '類型', '備註', '時間'], _interaction_export_rows),
+}
+
+def _stream_csv(headers, rows_func):
+    """逐批產生 CSV 內容，記憶體用量同總行數無關"""
+    import csv
+    import io
+    
+    db = get_db_session()
+    try:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        buffer.write('\ufeff')  # 等 Excel 識得 UTF-8
+        writer.writerow(headers)
+        for i, row in enumerate(rows_func(db), 1):
+            writer.writerow(row)
+            if i % EXPORT_BATCH_SIZE == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    finally:
         db.close()
+
+@app.route('/export/<type>')
+@login_required
+def export_data(type):
+    if type not in EXPORTS:
         flash('無效的匯出類型', 'error')
         return redirect(url_for('dashboard'))
     
-    db.close()
+    title, headers, rows_func = EXPORTS[type]
     
-    buffer = io.BytesIO()
-    wb.save(buffer)
-    buffer.seek(0)
+    if request.args.get('format') == 'csv':
+        return Response(stream_with_context(_stream_csv(headers, rows_func)),
+                        mimetype='text/csv; charset=utf-8',
+                        headers={'Content-Disposition': f'attachment; filename={type}_export.csv'})
     
-    return send_file(buffer, download_name=filename, as_attachment=True)
+    import tempfile
+    from openpyxl import Workbook
+    
+    # write-only 模式逐行寫入暫存檔，唔會將成個工作表放喺記憶體
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title)
+    ws.append(headers)
+    db = get_db_session()
+    try:
+        for row in rows_func(db):
+            ws.append(row)
+    finally:
+        db.close()
+    
+    # 暫存檔由 send_file 分塊傳送，傳完自動刪除
+    output = tempfile.TemporaryFile()
+    wb.save(output)
+    output.seek(0)
+    return send_file(output, download_name=f'{type}_export.xlsx', as_attachment=True)
+
+# --- 批量匯入 ---
+# 逐行讀檔 (CSV / XLSX)，每 IMPORT_CHUNK_SIZE 行驗證完一次過 executemany 寫入 (一個 transaction)；
+# 重複電話用開頭載入一次既 set 檢查，唔會逐行 SELECT
+IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', 5000))
+IMPORT_ERROR_DISPLAY = 200  # 網頁最多顯示幾多個錯誤 (CLI 可以用 --errors 寫晒出檔案)
+MEMBER_TIERS = ('普通會員', '黑鑽會員')
+
+# 表頭 -> 欄位；匯出既中文表頭同英文欄位名都接受，其他欄 (ID、狀態等) 略過
+IMPORT_HEADERS = {
+    '姓名': 'name', '電話': 'phone', '等級': 'tier', '儲值': 'balance',
+    '入會日期': 'effective_date', '到期日期': 'expiry_date',
+    '電郵': 'email', '生日': 'birthday', '標籤': 'tags', '地址': 'address',
+    '過敏': 'allergies', '喜好': 'preferences', '備註': 'note',
+    '顧客ID': 'customer_id', '日期': 'visit_date', '金額': 'amount', '座位': 'table_number',
+    '服務員': 'server', '人數': 'party_size',
+}
+IMPORT_LABELS = {field: header for header, field in IMPORT_HEADERS.items()}  # 錯誤訊息用
+IMPORT_DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M', '%Y-%m-%d', '%Y/%m/%d %H:%M', '%Y/%m/%d')
+
+class ImportRowError(ValueError):
+    """單行資料有問題，記入錯誤報告，其他行照樣匯入"""
+
+def _import_header(value):
+    key = str(value or '').strip()
+    return IMPORT_HEADERS.get(key, key.lower())
+
+def read_import_file(fileobj, filename):
+    """逐行產生 (行號, {欄位: 值})；XLSX 用 read-only 模式，唔會成個檔載入記憶體"""
+    if filename.lower().endswith('.xlsx'):
+        from openpyxl import load_workbook
+        wb = load_workbook(fileobj, read_only=True, data_only=True)
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+    else:
+        import csv
+        import io
+        rows = csv.reader(io.TextIOWrapper(fileobj, encoding='utf-8-sig', newline=''))
+
+    headers = [_import_header(h) for h in next(rows, [])]
+    for line, values in enumerate(rows, 2):
+        row = {h: v for h, v in zip(headers, values) if h and v is not None and str(v).strip() != ''}
+        if row:
+            yield line, row
+
+def _import_text(row, field, required=False):
+    value = row.get(field)
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)  # Excel 將電話當數字
+    value = str(value).strip() if value is not None else ''
+    if required and not value:
+        raise ImportRowError(f'缺少{IMPORT_LABELS.get(field, field)}')
+    return value
+
+def _import_number(row, field, default=0, cast=float, minimum=0):
+    value = row.get(field)
+    if value is None:
+        return default
+    try:
+        value = cast(float(value)) if cast is int else cast(value)
+    except (TypeError, ValueError):
+        raise ImportRowError(f'{IMPORT_LABELS.get(field, field)}唔係數字: {value}')
+    if value < minimum:
+        raise ImportRowError(f'{IMPORT_LABELS.get(field, field)}唔可以少過 {minimum}')
+    return value
+
+def _import_date(row, field, required=False):
+    value = row.get(field)
+    if isinstance(value, datetime):
+        return value
+    if value is None:
+        if required:
+            raise ImportRowError(f'缺少{IMPORT_LABELS.get(field, field)}')
+        return None
+    for fmt in IMPORT_DATE_FORMATS:
+        try:
+            return datetime.strptime(str(value).strip(), fmt)
+        except ValueError:
+            pass
+    raise ImportRowError(f'{IMPORT_LABELS.get(field, field)}日期格式唔啱: {value}')
+
+def _import_phone(row, ctx):
+    """返回 (phone, phone_key)；同一個 phone_key (唔理格式) 只可以出現一次"""
+    phone = _import_text(row, 'phone', required=True)
+    try:
+        phone_key = parse_phone(phone)
+    except PhoneError as e:
+        raise ImportRowError(str(e))
+    if phone_key is not None:
+        if phone_key in ctx['phones']:
+            raise ImportRowError(f'電話已存在: {phone}')
+        ctx['phones'].add(phone_key)
+    return phone, phone_key
+
+def _member_import_row(row, ctx):
+    tier = _import_text(row, 'tier') or '普通會員'
+    if tier not in MEMBER_TIERS:
+        raise ImportRowError(f'會員等級唔啱: {tier}')
+    effective_date = _import_date(row, 'effective_date') or ctx['now']
+    name = _import_text(row, 'name', required=True)
+    phone, phone_key = _import_phone(row, ctx)
+    return {
+        'name': name,
+        'phone': phone,
+        'phone_key': phone_key,
+        'tier': tier,
+        'balance': _import_number(row, 'balance'),
+        'benefits_total': 0, 'benefits_used': 0, 'dessert_coffee_used': 0, 'omakase_used': 0,
+        'effective_date': effective_date,
+        'expiry_date': _import_date(row, 'expiry_date') or effective_date + timedelta(days=365),
+        'created_by_employee_id': ctx['employee_id'],
+    }
+
+def _customer_import_row(row, ctx):
+    name = _import_text(row, 'name', required=True)
+    phone, phone_key = _import_phone(row, ctx)
+    return {
+        'name': name,
+        'phone': phone,
+        'phone_key': phone_key,
+        'email': _import_text(row, 'email'),
+        'birthday': _import_date(row, 'birthday'),
+        'tags': _import_text(row, 'tags'),
+        'address': _import_text(row, 'address'),
+        'allergies': _import_text(row, 'allergies'),
+        'preferences': _import_text(row, 'preferences'),
+        'notes': _import_text(row, 'note'),
+        'visits': 0, 'total_spent': 0, 'avg_spend': 0, 'points': 0,
+    }
+
+def _visit_import_row(row, ctx):
+    # 顧客用 顧客ID 或者 電話 對應
+    if row.get('customer_id') is not None:
+        customer_id = _import_number(row, 'customer_id', cast=int, minimum=1)
+        if customer_id not in ctx['customer_ids']:
+            raise ImportRowError(f'顧客不存在: ID {customer_id}')
+    else:
+        phone = _import_text(row, 'phone', required=True)
+        customer_id = ctx['customers_by_phone'].get(normalize_phone(phone))
+        if customer_id is None:
+            raise ImportRowError(f'顧客不存在: {phone}')
+    return {
+        'customer_id': customer_id,
+        'visit_date': _import_date(row, 'visit_date', required=True),
+        'amount': _import_number(row, 'amount'),
+        'table_number': _import_text(row, 'table_number'),
+        'server': _import_text(row, 'server'),
+        'party_size': _import_number(row, 'party_size', default=1, cast=int, minimum=1),
+        'note': _import_text(row, 'note'),
+    }
+
+def _import_context(db, kind, employee_id):
+    """匯入前一次過載入要用既資料 (現有電話 / 顧客)"""
+    ctx = {'now': datetime.utcnow(), 'employee_id': employee_id}
+    if kind == 'visit_records':
+        ctx['customers_by_phone'] = dict(db.execute(
+            select(Customer.phone_key, Customer.id).where(Customer.phone_key.isnot(None))).all())
+        ctx['customer_ids'] = set(ctx['customers_by_phone'].values())
+    else:
+        model = SEARCH_ENTITIES[IMPORTS[kind][1]]
+        ctx['phones'] = set(db.execute(select(model.phone_key).where(model.phone_key.isnot(None))).scalars())
+    return ctx
+
+def _write_entity_chunk(db, kind, rows):
+    """會員 / 顧客：批量寫入 + 搜尋索引，返回 (寫入數目, 匯入期間被其他人搶先登記既電話)"""
+    model = SEARCH_ENTITIES[IMPORTS[kind][1]]
+    last_id = db.execute(select(func.max(model.id))).scalar() or 0
+    # 唔指定 conflict target：raw phone 或者 phone_key (unique) 撞都跳過
+    db.execute(sqlite_insert(model.__table__).on_conflict_do_nothing(), rows)
+    new = db.execute(select(model.id, model.name, model.phone).where(model.id > last_id)).all()
+    if kind == 'members' and new:
+        link_member_customers(db.connection(), last_id + 1, max(r.id for r in new))
+    # 新 id 未有索引，唔使先刪；幾十萬行後綴直接用 tuple executemany，慳 SQLAlchemy 逐行處理參數
+    terms = [(t['entity'], t['entity_id'], t['field'], t['term'], t['pos'], t['length'])
+             for r in new for t in search_term_rows(IMPORTS[kind][1], r)]
+    db.connection().exec_driver_sql(
+        'INSERT INTO search_terms (entity, entity_id, field, term, pos, length) VALUES (?, ?, ?, ?, ?, ?)', terms)
+    return len(new), {r['phone'] for r in rows} - {r.phone for r in new}
+
+def _write_visit_chunk(db, kind, rows):
+    """訪問記錄：批量寫入 + 每日營業額按日累加
+
+    顧客統計照用 trigger 喺同一個 transaction 更新 (唔停用 trigger：停用會影響其他 worker 同時寫入既訪問)
+    """
+    db.execute(VisitRecord.__table__.insert(), rows)
+    days = {}
+    for row in rows:
+        key = row['visit_date'].strftime('%Y-%m-%d')
+        day = days.setdefault(key, {'day': key, 'tier': '顧客', 'source': 'visit', 'count': 0, 'original_total': 0,
+                                    'discount_total': 0, 'final_total': 0, 'balance_total': 0, 'cash_total': 0})
+        day['count'] += 1
+        day['original_total'] += row['amount']
+        day['final_total'] += row['amount']
+    db.execute(DAILY_REVENUE_UPSERT, list(days.values()))
+    return len(rows), set()
+
+# 類型: (名稱, 搜尋索引 entity / None, 驗證一行, 寫入一批)
+IMPORTS = {
+    'members': ('會員', 'member', _member_import_row, _write_entity_chunk),
+    'customers': ('顧客', 'customer', _customer_import_row, _write_entity_chunk),
+    'visit_records': ('訪問記錄', None, _visit_import_row, _write_visit_chunk),
+}
+
+def import_rows(kind, rows, employee_id=None):
+    """批量匯入 read_import_file 產生既行
+
+    返回 {'total': 行數, 'inserted': 寫入數目, 'errors': [(行號, 訊息)], 'seconds': 用咗幾耐}
+    """
+    title, entity, validate, write = IMPORTS[kind]
+    started = time.perf_counter()
+    report = {'total': 0, 'inserted': 0, 'errors': []}
+    db = get_db_session()
+    ctx = _import_context(db, kind, employee_id)
+    db.rollback()
+
+    def flush(chunk, lines):
+        db.execute(text('BEGIN IMMEDIATE'))
+        try:
+            inserted, conflicts = write(db, kind, chunk)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        report['inserted'] += inserted
+        if conflicts:
+            report['errors'].extend((line, f'電話已存在: {row["phone"]}')
+                                    for line, row in zip(lines, chunk) if row['phone'] in conflicts)
+
+    try:
+        chunk, lines = [], []
+        for line, row in rows:
+            report['total'] += 1
+            try:
+                chunk.append(validate(row, ctx))
+                lines.append(line)
+            except ImportRowError as e:
+                report['errors'].append((line, str(e)))
+            if len(chunk) >= IMPORT_CHUNK_SIZE:
+                flush(chunk, lines)
+                chunk, lines = [], []
+        if chunk:
+            flush(chunk, lines)
+    finally:
+        # 其他 worker 既 KPI / 列表總數 cache 靠 live_events 序號失效
+        if report['inserted']:
+            publish_event(db, 'import.completed', {'type': kind, 'inserted': report['inserted']})
+            db.commit()
+            invalidate_counts(kind, 'customers')
+            invalidate_analytics()
+        db.close()
+
+    report['errors'].sort()
+    report['seconds'] = round(time.perf_counter() - started, 2)
+    return report
+
+@app.route('/import', methods=['GET', 'POST'])
+@login_required
+def import_data():
+    report = None
+    kind = request.values.get('type', 'customers')
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if kind not in IMPORTS or not upload or not upload.filename:
+            flash('請揀匯入類型同檔案', 'error')
+            return redirect(url_for('import_data'))
+        try:
+            report = import_rows(kind, read_import_file(upload.stream, upload.filename), session['employee_id'])
+        except Exception as e:
+            flash(f'匯入失敗: {e}', 'error')
+            return redirect(url_for('import_data'))
+        flash(f"已匯入 {report['inserted']} / {report['total']} 行{IMPORTS[kind][0]} ({report['seconds']}s)",
+              'success' if not report['errors'] else 'error')
+    return render_template('import.html', imports=IMPORTS, kind=kind, report=report,
+                           error_limit=IMPORT_ERROR_DISPLAY)
 
 # --- 分析儀表板 ---
 @app.route('/analytics')
 @login_required
 def analytics():
-    from sqlalchemy import func as sql_func
     db = get_db_session()
     
-    # 顧客統計
-    total_customers = db.query(Customer).count()
-    total_visits = db.query(Customer).with_entities(sql_func.sum(Customer.visits)).scalar() or 0
-    total_revenue = db.query(Customer).with_entities(sql_func.sum(Customer.total_spent)).scalar() or 0
-    avg_spend = db.query(Customer).with_entities(sql_func.avg(Customer.avg_spend)).scalar() or 0
-    
-    # 會員統計
-    total_members = db.query(Member).count()
-    active_members = db.query(Member).filter(Member.expiry_date >= datetime.utcnow()).count()
-    
-    # 預訂統計
-    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-    tomorrow = today + timedelta(days=1)
-    today_reservations = db.query(Reservation).filter(
-        Reservation.date >= today,
-        Reservation.date < tomorrow
-    ).count()
+    # 顧客 / 會員 / 今日預訂數字 (一條查詢，有 cache)
+    kpis = get_kpis(db)
     
     # 最近顧客 (消費最高)
-    top_customers = db.query(Customer).order_by(Customer.total_spent.desc()).limit(10).all()
+    top_customers = get_top_customers(db)
     
     # 最近預訂
-    upcoming_reservations = db.query(Reservation).filter(
-        Reservation.date >= datetime.utcnow(),
+    upcoming_reservations = cached_analytics(db, 'upcoming_reservations', lambda: db.query(
+        Reservation.id, Reservation.name, Reservation.phone, Reservation.date, Reservation.party_size, Reservation.status
+    ).filter(
+        Reservation.date >= now_hk().replace(tzinfo=None),
         Reservation.status.in_(['confirmed', 'seated'])
-    ).order_by(Reservation.date).limit(10).all()
+    ).order_by(Reservation.date).limit(10).all())
     
     db.close()
     
     return render_template('analytics.html',
-                         total_customers=total_customers,
-                         total_visits=total_visits,
-                         total_revenue=total_revenue,
-                         avg_spend=avg_spend,
-                         total_members=total_members,
-                         active_members=active_members,
-                         today_reservations=today_reservations,
+                         total_customers=kpis['customer_count'],
+                         total_visits=kpis['total_visits'],
+                         total_revenue=kpis['total_revenue'],
+                         avg_spend=kpis['avg_spend'],
+                         total_members=kpis['member_count'],
+                         active_members=kpis['active_members'],
+                         today_reservations=kpis['today_reservations'],
                          top_customers=top_customers,
                          upcoming_reservations=upcoming_reservations)
 
@@ -1105,11 +3578,21 @@ def init_db():
     # 檢查是否已有員工
     if db.query(Employee).count() == 0:
         # 預設員工: admin / admin123
-        admin = Employee(username='admin', password='admin123', name='管理員')
+        admin = Employee(username='admin', password=hash_password('admin123'), name='管理員')
         db.add(admin)
         db.commit()
         print("✅ 已建立預設管理員: admin / admin123")
     
+    # 舊版明文密碼一次過升級做 hash
+    upgraded = 0
+    for employee in db.query(Employee).all():
+        if not is_password_hash(employee.password):
+            employee.password = hash_password(employee.password)
+            upgraded += 1
+    if upgraded:
+        db.commit()
+        print(f"✅ 已將 {upgraded} 個員工密碼升級為 hash")
+    
     # 確保設定存在
     if db.query(Settings).count() == 0:
         settings = Settings(restaurant_name='我的餐廳', dark_mode=0)
@@ -1122,20 +3605,19 @@ def init_db():
 @app.route('/settings', methods=['GET', 'POST'])
 @login_required
 def settings():
-    db = get_db_session()
-    settings_obj = db.query(Settings).first()
-    
     if request.method == 'POST':
+        db = get_db_session()
+        settings_obj = db.query(Settings).first()
         settings_obj.restaurant_name = request.form.get('restaurant_name', '我的餐廳')
         settings_obj.dark_mode = 1 if request.form.get('dark_mode') else 0
+        settings_obj.version = (settings_obj.version or 0) + 1
         db.commit()
-        flash('設定已儲存', 'success')
         db.close()
+        invalidate_settings()
+        flash('設定已儲存', 'success')
         return redirect(url_for('dashboard'))
     
-    result = render_template('settings.html', settings=settings_obj)
-    db.close()
-    return result
+    return render_template('settings.html', settings=get_settings())
 
 @app.route('/toggle_dark_mode')
 @login_required
@@ -1144,8 +3626,10 @@ def toggle_dark_mode():
     settings_obj = db.query(Settings).first()
     if settings_obj:
         settings_obj.dark_mode = 1 - settings_obj.dark_mode
+        settings_obj.version = (settings_obj.version or 0) + 1
         db.commit()
     db.close()
+    invalidate_settings()
     return redirect(request.referrer or url_for('dashboard'))
 
 # --- 顧客升級為會員 ---
@@ -1163,8 +3647,9 @@ def upgrade_to_member(customer_id):
     if request.method == 'POST':
         tier = request.form.get('tier', '普通會員')
         
-        # 檢查手機是否已註冊會員
-        existing_member = db.query(Member).filter_by(phone=customer.phone).first()
+        # 檢查顧客是否已連結會員 / 手機是否已註冊會員
+        existing_member = customer.member or (
+            customer.phone_key and db.query(Member).filter_by(phone_key=customer.phone_key).first())
         if existing_member:
             flash('此電話已存在會員', 'error')
             db.close()
@@ -1178,14 +3663,15 @@ def upgrade_to_member(customer_id):
             name=customer.name,
             phone=customer.phone,
             tier=tier,
-            email=customer.email,
             balance=0,
             effective_date=effective_date,
             expiry_date=expiry_date,
-            created_by_employee_id=session['employee_id']
+            created_by_employee_id=session['employee_id'],
+            customer=customer,
         )
         db.add(member)
         db.commit()
+        invalidate_counts('members')
         flash(f'{customer.name} 已升級為會員 ({tier})', 'success')
         db.close()
         return redirect(url_for('members'))
@@ -1193,42 +3679,152 @@ def upgrade_to_member(customer_id):
     db.close()
     return render_template('upgrade_to_member.html', customer=customer)
 
-if __name__ == '__main__':
-    init_db()
-    port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port, debug=True)
-
 # --- 數據備份 ---
-import shutil
-from datetime import datetime as dt
+BACKUP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backups')
+BACKUP_KEEP = int(os.environ.get('BACKUP_KEEP', 14))  # 保留最近幾份
+BACKUP_COMPRESS = os.environ.get('BACKUP_COMPRESS', '1') == '1'
+BACKUP_PAGES_PER_STEP = 256  # 每步複製幾多頁，步與步之間讓其他連線寫入
 
-@app.route('/backup')
-@login_required
-def backup_db():
-    import os
-    backup_dir = os.path.join(os.path.dirname(__file__), 'backups')
-    os.makedirs(backup_dir, exist_ok=True)
+_backup_lock = threading.Lock()
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _backup_files():
+    if not os.path.exists(BACKUP_DIR):
+        return []
+    return sorted((f for f in os.listdir(BACKUP_DIR)
+                   if f.startswith('restaurant_backup_') and f.endswith(('.db', '.db.gz'))), reverse=True)
+
+def _backup_meta(filename):
+    path = os.path.join(BACKUP_DIR, filename)
+    try:
+        with open(path + '.json', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'file': filename, 'size': os.path.getsize(path), 'duration': None, 'sha256': None, 'integrity': None}
+
+def run_backup():
+    """用 SQLite online backup API 逐步複製資料庫，返回備份資料 (metadata)"""
+    import gzip
+    import shutil
+    
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    started = time.monotonic()
+    stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    name = f'restaurant_backup_{stamp}.db'
+    counter = 1
+    while any(os.path.exists(os.path.join(BACKUP_DIR, name + ext)) for ext in ('', '.gz')):
+        name = f'restaurant_backup_{stamp}_{counter}.db'
+        counter += 1
+    path = os.path.join(BACKUP_DIR, name)
+    
+    src = sqlite3.connect(os.path.abspath(engine.url.database), timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
+    dst = sqlite3.connect(path)
+    try:
+        src.backup(dst, pages=BACKUP_PAGES_PER_STEP, sleep=0.005)
+        integrity = dst.execute('PRAGMA integrity_check').fetchone()[0]
+        dst.execute('PRAGMA journal_mode=DELETE')  # 備份檔唔需要 WAL，保持單一檔案
+    finally:
+        dst.close()
+        src.close()
     
-    timestamp = dt.now().strftime('%Y%m%d_%H%M%S')
-    backup_file = os.path.join(backup_dir, f'restaurant_backup_{timestamp}.db')
+    if BACKUP_COMPRESS:
+        with open(path, 'rb') as f_in, gzip.open(path + '.gz', 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(path)
+        name += '.gz'
+        path += '.gz'
     
-    db_path = os.path.join(os.path.dirname(__file__), 'restaurant.db')
-    shutil.copy2(db_path, backup_file)
+    meta = {
+        'file': name,
+        'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'size': os.path.getsize(path),
+        'duration': round(time.monotonic() - started, 2),
+        'sha256': _file_sha256(path),
+        'integrity': integrity,
+    }
+    with open(path + '.json', 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
     
-    flash(f'數據已備份: {timestamp}', 'success')
-    return redirect(url_for('dashboard'))
+    prune_backups()
+    return meta
+
+def prune_backups(keep=None):
+    """只保留最近 keep 份備份"""
+    keep = BACKUP_KEEP if keep is None else keep
+    for filename in _backup_files()[keep:]:
+        path = os.path.join(BACKUP_DIR, filename)
+        for p in (path, path + '.json'):
+            if os.path.exists(p):
+                os.remove(p)
+
+def start_backup():
+    """喺背景 thread 做備份；已經有備份進行中就返回 False"""
+    if not _backup_lock.acquire(blocking=False):
+        return False
+    
+    def worker():
+        try:
+            run_backup()
+        except Exception:
+            app.logger.exception('數據備份失敗')
+        finally:
+            _backup_lock.release()
+    
+    threading.Thread(target=worker, name='backup', daemon=True).start()
+    return True
+
+def restore_backup(filename):
+    """由備份還原到現用資料庫 (先驗證 checksum)"""
+    import gzip
+    import shutil
+    import tempfile
+    
+    path = os.path.join(BACKUP_DIR, os.path.basename(filename))
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    meta = _backup_meta(os.path.basename(filename))
+    if meta.get('sha256') and meta['sha256'] != _file_sha256(path):
+        raise ValueError('備份檔 checksum 不符，檔案可能已損壞')
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source_path = path
+        if path.endswith('.gz'):
+            source_path = os.path.join(tmp_dir, 'restore.db')
+            with gzip.open(path, 'rb') as f_in, open(source_path, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+        
+        src = sqlite3.connect(source_path)
+        dst = sqlite3.connect(os.path.abspath(engine.url.database), timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
+        try:
+            src.backup(dst, pages=BACKUP_PAGES_PER_STEP)
+        finally:
+            dst.close()
+            src.close()
+    
+    engine.dispose()
+    invalidate_settings()
+
+@app.route('/backup')
+@login_required
+def backup_db():
+    if start_backup():
+        flash('數據備份已開始，完成後會喺備份記錄顯示', 'success')
+    else:
+        flash('已有備份進行中', 'error')
+    return redirect(url_for('list_backups'))
 
 @app.route('/backups')
 @login_required
 def list_backups():
-    import os
-    backup_dir = os.path.join(os.path.dirname(__file__), 'backups')
-    files = []
-    if os.path.exists(backup_dir):
-        for f in sorted(os.listdir(backup_dir), reverse=True):
-            if f.endswith('.db'):
-                files.append(f)
-    return render_template('backups.html', backups=files, restaurant_name=session.get('restaurant_name', '餐廳'))
+    backups = [_backup_meta(f) for f in _backup_files()]
+    return render_template('backups.html', backups=backups, backup_running=_backup_lock.locked(),
+                           restaurant_name=session.get('restaurant_name', '餐廳'))
 
 # --- 每日營業額趨勢圖 ---
 @app.route('/revenue-chart')
@@ -1237,24 +3833,462 @@ def revenue_chart():
     from sqlalchemy import func as sql_func
     db = get_db_session()
     
-    # 獲取過去30日既數據
-    today = datetime.utcnow()
-    from datetime import timedelta
-    start_date = today - timedelta(days=30)
+    # 獲取過去30日既數據 (香港日期)
+    today = now_hk().replace(hour=0, minute=0, second=0, microsecond=0)
+    days = [(today - timedelta(days=i)).strftime('%Y-%m-%d') for i in range(29, -1, -1)]
     
-    # 呢度簡化處理 - 用顧客既總消費
-    total_revenue = db.query(
-        sql_func.sum(Customer.total_spent)
-    ).scalar() or 0
+    rows = db.query(
+        DailyRevenue.day, DailyRevenue.source, sql_func.sum(DailyRevenue.final_total)
+    ).filter(DailyRevenue.day >= days[0]).group_by(DailyRevenue.day, DailyRevenue.source).all()
+    
+    by_source = {'checkout': dict.fromkeys(days, 0), 'visit': dict.fromkeys(days, 0)}
+    for day, source, amount in rows:
+        if source in by_source and day in by_source[source]:
+            by_source[source][day] = round(amount or 0, 2)
+    total_revenue = sum(sum(series.values()) for series in by_source.values())
     
     # 會員同顧客數量
-    member_count = db.query(Member).count()
-    customer_count = db.query(Customer).count()
+    kpis = get_kpis(db)
     
     db.close()
     
     return render_template('revenue_chart.html', 
                          total_revenue=total_revenue,
-                         member_count=member_count,
-                         customer_count=customer_count,
+                         revenue_labels=[d[5:] for d in days],
+                         checkout_revenue=list(by_source['checkout'].values()),
+                         visit_revenue=list(by_source['visit'].values()),
+                         member_count=kpis['member_count'],
+                         customer_count=kpis['customer_count'],
                          restaurant_name=session.get('restaurant_name', '餐廳'))
+
+# ============ JSON API v1 ============
+api = Blueprint('api_v1', __name__, url_prefix='/api/v1')
+
+API_TOKEN_CACHE_TTL = 60  # 秒；撤銷 token 最多延遲咁耐生效
+API_TOKEN_CACHE_SIZE = int(os.environ.get('API_TOKEN_CACHE_SIZE', 1000))
+_api_token_cache = OrderedDict()  # token hash -> (employee_id, 快取時間)；只快取有效 token，亂試唔會塞爆
+_api_token_lock = threading.Lock()
+
+def hash_api_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def _api_token_employee(token):
+    """token -> employee_id (有效既有 LRU 快取)，無效返回 None"""
+    token_hash = hash_api_token(token)
+    now = time.monotonic()
+    with _api_token_lock:
+        hit = _api_token_cache.get(token_hash)
+        if hit and now - hit[1] < API_TOKEN_CACHE_TTL:
+            _api_token_cache.move_to_end(token_hash)
+            return hit[0]
+    db = get_db_session()
+    try:
+        employee_id = db.query(ApiToken.employee_id).filter(
+            ApiToken.token_hash == token_hash, ApiToken.revoked_at.is_(None)).scalar()
+    finally:
+        db.close()
+    with _api_token_lock:
+        if employee_id is None:
+            _api_token_cache.pop(token_hash, None)  # 撤銷咗
+            return None
+        _api_token_cache[token_hash] = (employee_id, now)
+        _api_token_cache.move_to_end(token_hash)
+        while len(_api_token_cache) > API_TOKEN_CACHE_SIZE:
+            _api_token_cache.popitem(last=False)
+    return employee_id
+
+def api_error(message, status=400):
+    return jsonify({'error': message}), status
+
+def api_auth_required(f):
+    """已登入 session 或者 Authorization: Bearer <token> 都得 (asgi.py 有對應既 async 版本)"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        employee_id = session.get('employee_id')
+        auth = request.headers.get('Authorization', '')
+        if not employee_id and auth.startswith('Bearer '):
+            employee_id = _api_token_employee(auth[7:].strip())
+        if not employee_id:
+            return api_error('未授權', 401)
+        g.employee_id = employee_id
+        return f(*args, **kwargs)
+    return decorated_function
+
+def api_response(payload, status=200):
+    """JSON 回應 + ETag；If-None-Match 相同就返回 304"""
+    response = jsonify(payload)
+    response.status_code = status
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.add_etag()
+    return response.make_conditional(request)
+
+def _iso(value):
+    return value.isoformat() if value else None
+
+def member_json(m):
+    return {'id': m.id, 'customer_id': m.customer_id, 'name': m.name, 'phone': m.phone, 'tier': m.tier, 'balance': m.balance,
+            'is_active': m.is_active, 'effective_date': _iso(m.effective_date), 'expiry_date': _iso(m.expiry_date),
+            'weekly_remaining': m.get_weekly_remaining(), 'yearly_remaining': m.get_yearly_remaining(),
+            'benefits_remaining': m.benefits_remaining}
+
+def customer_json(c):
+    return {'id': c.id, 'name': c.name, 'phone': c.phone, 'email': c.email, 'tags': c.tags,
+            'visits': c.visits, 'total_spent': c.total_spent, 'avg_spend': c.avg_spend,
+            'preferences': c.preferences, 'allergies': c.allergies, 'birthday': _iso(c.birthday)}
+
+def reservation_json(r):
+    return {'id': r.id, 'customer_id': r.customer_id, 'name': r.name, 'phone': r.phone, 'date': _iso(r.date),
+            'party_size': r.party_size, 'duration': r.duration, 'table_number': r.table_number, 'status': r.status,
+            'note': r.note}
+
+def visit_json(v):
+    return {'id': v.id, 'customer_id': v.customer_id, 'visit_date': _iso(v.visit_date), 'amount': v.amount,
+            'table_number': v.table_number, 'server': v.server, 'party_size': v.party_size, 'note': v.note}
+
+def select_fields(data):
+    """?fields=id,name 只返回指定欄位"""
+    fields = request.args.get('fields')
+    if not fields:
+        return data
+    wanted = [f.strip() for f in fields.split(',') if f.strip()]
+    return {k: data[k] for k in wanted if k in data}
+
+def api_page(query, columns, serializer, descending=False):
+    page = keyset_paginate(query, columns, descending=descending, per_page=get_page_size())
+    return api_response({
+        'data': [select_fields(serializer(item)) for item in page['items']],
+        'next_cursor': page['next_cursor'],
+        'prev_cursor': page['prev_cursor'],
+    })
+
+class ApiInputError(ValueError):
+    """請求內容唔係 {欄位: 單一值} (例如 JSON array、巢狀 object)"""
+
+@api.errorhandler(ApiInputError)
+def api_input_error(e):
+    return api_error(f'資料格式錯誤: {e}')
+
+def api_body():
+    """JSON object 或者表單；值只可以係字串 / 數字 / true/false / null"""
+    body = request.get_json(silent=True)
+    if body is None:
+        return request.form
+    if not isinstance(body, dict):
+        raise ApiInputError('要用 JSON object')
+    nested = [key for key, value in body.items() if isinstance(value, (dict, list))]
+    if nested:
+        raise ApiInputError(f"{', '.join(nested)} 唔可以係 object / array")
+    return body
+
+@api.route('/members')
+@api_auth_required
+def api_members():
+    db = get_db_session()
+    query = db.query(Member)
+    search = request.args.get('search', '').strip()
+    if search:
+        query = query.filter(Member.id.in_(search_ids_query(db, 'member', search)))
+    try:
+        return api_page(query, [Member.id], member_json)
+    finally:
+        db.close()
+
+@api.route('/members/<int:member_id>')
+@api_auth_required
+def api_member(member_id):
+    db = get_db_session()
+    try:
+        member = db.get(Member, member_id, options=[joinedload(Member.customer)])
+        if not member:
+            return api_error('會員不存在', 404)
+        payload = member_json(member)
+        payload['customer'] = customer_json(member.customer) if member.customer else None
+        return api_response(select_fields(payload))
+    finally:
+        db.close()
+
+@api.route('/customers')
+@api_auth_required
+def api_customers():
+    db = get_db_session()
+    query = db.query(Customer)
+    search = request.args.get('search', '').strip()
+    if search:
+        query = query.filter(Customer.id.in_(search_ids_query(db, 'customer', search)))
+    try:
+        return api_page(query, [Customer.id], customer_json)
+    finally:
+        db.close()
+
+@api.route('/customers/<int:customer_id>')
+@api_auth_required
+def api_customer(customer_id):
+    db = get_db_session()
+    try:
+        customer = db.get(Customer, customer_id)
+        if not customer:
+            return api_error('顧客不存在', 404)
+        return api_response(select_fields(customer_json(customer)))
+    finally:
+        db.close()
+
+@api.route('/customers/<int:customer_id>/visits', methods=['GET', 'POST'])
+@api_auth_required
+def api_customer_visits(customer_id):
+    db = get_db_session()
+    try:
+        customer = db.get(Customer, customer_id)
+        if not customer:
+            return api_error('顧客不存在', 404)
+        if request.method == 'POST':
+            try:
+                visit = create_visit_record(db, customer, api_body())
+            except (KeyError, TypeError, ValueError) as e:
+                db.rollback()
+                return api_error(f'資料格式錯誤: {e}')
+            return jsonify(visit_json(visit)), 201
+        query = db.query(VisitRecord).filter(VisitRecord.customer_id == customer_id)
+        return api_page(query, [VisitRecord.visit_date, VisitRecord.id], visit_json, descending=True)
+    finally:
+        db.close()
+
+@api.route('/reservations', methods=['GET', 'POST'])
+@api_auth_required
+def api_reservations():
+    db = get_db_session()
+    try:
+        if request.method == 'POST':
+            try:
+                reservation = create_reservation(db, api_body(), g.employee_id)
+            except ReservationError as e:
+                return api_error(str(e), 409)
+            except (KeyError, TypeError, ValueError) as e:
+                db.rollback()
+                return api_error(f'資料格式錯誤: {e}')
+            return jsonify(reservation_json(reservation)), 201
+        
+        query = db.query(Reservation)
+        search = request.args.get('search', '').strip()
+        if search:
+            query = query.filter(Reservation.id.in_(search_ids_query(db, 'reservation', search)))
+        if request.args.get('date'):
+            try:
+                day = datetime.strptime(request.args['date'], '%Y-%m-%d')
+            except ValueError:
+                return api_error('date 格式應為 YYYY-MM-DD')
+            query = query.filter(Reservation.date >= day, Reservation.date < day + timedelta(days=1))
+        if request.args.get('status'):
+            query = query.filter(Reservation.status == request.args['status'])
+        return api_page(query, [Reservation.date, Reservation.id], reservation_json, descending=True)
+    finally:
+        db.close()
+
+@api.route('/reservations/<int:res_id>', methods=['GET', 'PATCH'])
+@api_auth_required
+def api_reservation(res_id):
+    db = get_db_session()
+    try:
+        reservation = db.get(Reservation, res_id)
+        if not reservation:
+            return api_error('預訂不存在', 404)
+        if request.method == 'PATCH':
+            data = api_body()
+            try:
+                numbers = {field: int(data[field]) if data[field] is not None else None
+                           for field in ('party_size', 'duration') if field in data}
+            except (TypeError, ValueError) as e:
+                return api_error(f'資料格式錯誤: {e}')
+            if any(value is not None and value < 1 for value in numbers.values()):
+                return api_error('party_size / duration 必須大於 0')
+            db.execute(text('BEGIN IMMEDIATE'))
+            for field in ('status', 'table_number', 'note'):
+                if field in data:
+                    setattr(reservation, field, data[field])
+            for field, value in numbers.items():
+                setattr(reservation, field, value)
+            try:
+                check_table_booking(db, reservation)
+            except ReservationError as e:
+                db.rollback()
+                return api_error(str(e), 409)
+            publish_reservation(db, 'reservation.updated', reservation)
+            db.commit()
+            return jsonify(reservation_json(reservation))
+        return api_response(select_fields(reservation_json(reservation)))
+    finally:
+        db.close()
+
+def board_statements():
+    """前台畫面 (今日預訂 + 幾個數字) 要用既查詢；同步 / async (asgi.py) 共用"""
+    today = now_hk().replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+    return {
+        'reservations': select(
+            Reservation.id, Reservation.name, Reservation.phone, Reservation.date, Reservation.party_size,
+            Reservation.table_number, Reservation.status,
+        ).where(
+            Reservation.date >= today,
+            Reservation.date < today + timedelta(days=1),
+            Reservation.status.in_(['confirmed', 'seated', 'booked']),
+        ).order_by(Reservation.date),
+        'member_count': select(func.count(Member.id)),
+        'customer_count': select(func.count(Customer.id)),
+        'today_revenue': select(func.coalesce(func.sum(DailyRevenue.final_total), 0)).where(
+            DailyRevenue.day == today.strftime('%Y-%m-%d')),
+    }
+
+def board_payload(results):
+    """results: {名稱: 查詢結果 rows}"""
+    return {
+        'reservations': [{'id': r.id, 'name': r.name, 'phone': r.phone, 'date': _iso(r.date),
+                          'party_size': r.party_size, 'table_number': r.table_number, 'status': r.status}
+                         for r in results['reservations']],
+        'member_count': results['member_count'][0][0],
+        'customer_count': results['customer_count'][0][0],
+        'today_revenue': results['today_revenue'][0][0],
+    }
+
+@api.route('/board')
+@api_auth_required
+def api_board():
+    """前台輪詢用 (async 版本見 asgi.py)"""
+    db = get_db_session()
+    try:
+        results = {name: db.execute(stmt).all() for name, stmt in board_statements().items()}
+    finally:
+        db.close()
+    return api_response(board_payload(results))
+
+@api.route('/checkout', methods=['POST'])
+@api_auth_required
+def api_checkout():
+    data = api_body()
+    db = get_db_session()
+    try:
+        result = perform_checkout(
+            db,
+            int(data.get('member_id') or 0),
+            float(data.get('original_amount') or 0),
+            str(data.get('use_balance', '')).lower() in ('1', 'true', 'on'),
+            g.employee_id,
+            str(request.headers.get('Idempotency-Key') or data.get('idempotency_key') or '') or None,
+        )
+    except CheckoutError as e:
+        return api_error(str(e))
+    except (TypeError, ValueError):
+        return api_error('金額格式錯誤')
+    finally:
+        db.close()
+    return jsonify(result)
+
+app.register_blueprint(api)
+
+# ============ CLI ============
+@app.cli.command('create-api-token')
+@click.argument('username')
+@click.option('--name', default='', help='用途，例如 POS-1')
+def create_api_token_command(username, name):
+    """為員工建立 API token (只會顯示一次)"""
+    db = Session()
+    employee = db.query(Employee).filter_by(username=username).first()
+    if not employee:
+        db.close()
+        raise click.ClickException(f'找不到員工: {username}')
+    token = secrets.token_urlsafe(32)
+    db.add(ApiToken(token_hash=hash_api_token(token), employee_id=employee.id, name=name))
+    db.commit()
+    db.close()
+    print(f"✅ API token ({username}): {token}")
+
+@app.cli.command('revoke-api-token')
+@click.argument('token')
+def revoke_api_token_command(token):
+    """撤銷 API token"""
+    db = Session()
+    updated = db.query(ApiToken).filter_by(token_hash=hash_api_token(token)).update(
+        {ApiToken.revoked_at: datetime.utcnow()})
+    db.commit()
+    db.close()
+    print('✅ 已撤銷' if updated else '找不到此 token')
+
+@app.cli.command('reset-benefits')
+def reset_benefits_command():
+    """檢查並批量重置每週 / 每年權益 (可放入 cron)"""
+    results = run_benefit_resets()
+    if not results:
+        print('權益已經係最新週期，毋須重置')
+    for benefit, rows in results.items():
+        print(f"✅ {BENEFITS[benefit]['name']}: 已重置 {rows} 位會員")
+
+@app.cli.command('backup')
+def backup_command():
+    """即時備份資料庫 (可放入 cron)"""
+    meta = run_backup()
+    print(f"✅ 已備份: {meta['file']} ({meta['size']} bytes, {meta['duration']}s, {meta['integrity']})")
+
+@app.cli.command('restore-backup')
+@click.argument('filename')
+def restore_backup_command(filename):
+    """由 backups/ 入面既備份還原資料庫"""
+    restore_backup(filename)
+    print(f"✅ 已還原: {filename}")
+
+@app.cli.command('recompute-customer-stats')
+@click.option('--dry-run', is_flag=True, help='只報告偏差，唔寫入')
+def recompute_customer_stats_command(dry_run):
+    """由 visit_records 重算顧客訪問次數 / 總消費 / 人均消費"""
+    report = recompute_customer_stats(dry_run)
+    action = '需要修正' if dry_run else '已修正'
+    print(f"✅ {report['customers']} 位顧客，{action} {report['drifted']} 位 "
+          f"(訪問次數差 {report['visits_drift']}，消費差 ${report['spent_drift']})")
+
+@app.cli.command('import-data')
+@click.argument('kind', type=click.Choice(list(IMPORTS)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--errors', 'errors_path', help='錯誤報告寫入呢個 CSV (預設只印頭 20 個)')
+def import_data_command(kind, path, errors_path):
+    """由 CSV / XLSX 批量匯入會員、顧客或訪問記錄"""
+    with open(path, 'rb') as f:
+        report = import_rows(kind, read_import_file(f, path))
+    print(f"✅ 已匯入 {report['inserted']} / {report['total']} 行 ({report['seconds']}s)，"
+          f"{len(report['errors'])} 個錯誤")
+    if errors_path:
+        import csv
+        with open(errors_path, 'w', newline='', encoding='utf-8-sig') as f:
+            writer = csv.writer(f)
+            writer.writerow(['行', '錯誤'])
+            writer.writerows(report['errors'])
+    else:
+        for line, message in report['errors'][:20]:
+            print(f'  第 {line} 行: {message}')
+
+@app.cli.command('backfill-phone-keys')
+@click.option('--force', is_flag=True, help='連已有既 phone_key 都重算 (改咗 PHONE_DEFAULT_COUNTRY 之後用)')
+def backfill_phone_keys_command(force):
+    """計算會員 / 顧客 / 預訂既 canonical 電話 (phone_key)，並列出要人手處理既電話"""
+    for table, rows in backfill_phone_keys(force).items():
+        print(f"✅ {table}: 已更新 {rows} 行")
+    for table in PHONE_KEY_TABLES:
+        for row_id, phone, phone_key in unresolved_phone_keys(table):
+            if phone_key:
+                print(f"  ⚠️ {table} #{row_id} 電話 {phone} 同另一行重複 ({phone_key})，請合併")
+            else:
+                print(f"  ⚠️ {table} #{row_id} 電話 {phone} 判斷唔到國碼，請改成 +國碼 格式")
+
+@app.cli.command('backfill-revenue')
+def backfill_revenue_command():
+    """由 transactions 同 visit_records 重建 daily_revenue"""
+    days = rebuild_daily_revenue()
+    print(f"✅ 每日營業額已重建: {days} 行")
+
+@app.cli.command('rebuild-search')
+def rebuild_search_command():
+    """重建姓名/電話搜尋索引"""
+    total = rebuild_search_index()
+    print(f"✅ 搜尋索引已重建: {total} 行")
+
+if __name__ == '__main__':
+    # 開發用；正式環境用 gunicorn -c gunicorn.conf.py wsgi:app
+    init_db()
+    start_benefit_scheduler()
+    port = int(os.environ.get('PORT', 5000))
+    app.run(host='0.0.0.0', port=port, debug=os.environ.get('FLASK_DEBUG') == '1', threaded=True)
@@ -0,0 +1,97 @@
+# ASGI 入口: uvicorn asgi:app --workers 4
+#
+# 前台畫面不停輪詢既讀取端點用 async 處理 (aiosqlite)，等 I/O 時唔會佔住 worker thread；
+# 其他請求照舊交畀 Flask (經 asgiref 嘅 WsgiToAsgi 喺 thread pool 行)。
+# 需要額外安裝: uvicorn, aiosqlite, asgiref
+import asyncio
+import hashlib
+import json
+import os
+from http.cookies import SimpleCookie
+
+from asgiref.wsgi import WsgiToAsgi
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from app import (app as flask_app, engine, init_db, start_benefit_scheduler, board_statements, board_payload, load_session,
+                 _api_token_employee, set_sqlite_pragmas, register_sqlite_functions)
+
+async_engine = create_async_engine(
+    f'sqlite+aiosqlite:///{os.path.abspath(engine.url.database)}',
+    poolclass=AsyncAdaptedQueuePool,  # aiosqlite 預設 NullPool，每次都開新連線
+    pool_size=int(os.environ.get('DB_POOL_SIZE', 10)),
+    max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+)
+# 同步 engine 既 connect listener 一樣要裝：PRAGMA 同 SQL 函數 (normalize_phone)
+event.listen(async_engine.sync_engine, 'connect', set_sqlite_pragmas)
+event.listen(async_engine.sync_engine, 'connect', register_sqlite_functions)
+
+wsgi_app = WsgiToAsgi(flask_app)
+
+
+def _headers(scope):
+    return {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope.get('headers', [])}
+
+
+async def _employee_id(headers):
+    """同 app.api_auth_required 一樣: Flask session cookie 或 Bearer token"""
+    cookie = SimpleCookie(headers.get('cookie', ''))
+    session_cookie = cookie.get(flask_app.config['SESSION_COOKIE_NAME'])
+    if session_cookie:
+        # 快取命中只係查字典，miss 先會查資料庫，所以放 thread 行
+        loaded = await asyncio.to_thread(load_session, session_cookie.value)
+        if loaded and loaded[2].get('employee_id'):
+            return loaded[2]['employee_id']
+    auth = headers.get('authorization', '')
+    if auth.startswith('Bearer '):
+        return await asyncio.to_thread(_api_token_employee, auth[7:].strip())
+    return None
+
+
+async def _send_json(send, status, payload, headers=None, etag=None):
+    body = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode()
+    response_headers = [(b'content-type', b'application/json')]
+    if etag:
+        response_headers += [(b'etag', etag.encode()), (b'cache-control', b'private, no-cache')]
+        if headers and headers.get('if-none-match') == etag:
+            status, body = 304, b''
+    response_headers.append((b'content-length', str(len(body)).encode()))
+    await send({'type': 'http.response.start', 'status': status, 'headers': response_headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def board(scope, receive, send):
+    headers = _headers(scope)
+    if not await _employee_id(headers):
+        return await _send_json(send, 401, {'error': '未授權'})
+    async with async_engine.connect() as conn:
+        results = {name: (await conn.execute(stmt)).all() for name, stmt in board_statements().items()}
+    payload = board_payload(results)
+    etag = '"%s"' % hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+    await _send_json(send, 200, payload, headers, etag)
+
+
+# 用 async 處理既 GET 端點，其餘交畀 Flask
+ASYNC_ROUTES = {
+    '/api/v1/board': board,
+}
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await asyncio.to_thread(init_db)
+                start_benefit_scheduler()  # 每個 uvicorn worker 一個，同 gunicorn post_fork 一樣
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await async_engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    
+    handler = ASYNC_ROUTES.get(scope.get('path')) if scope['type'] == 'http' else None
+    if handler and scope['method'] == 'GET':
+        return await handler(scope, receive, send)
+    await wsgi_app(scope, receive, send)
@@ -0,0 +1,145 @@
+"""比較 WSGI (gunicorn) 同 ASGI (uvicorn + asgi.py) 處理前台輪詢端點既表現
+
+用法: python benchmarks/asgi_vs_wsgi.py --concurrency 32 --duration 10
+會將 app 複製去暫存目錄 (唔會改到真正既 restaurant.db)，分別啟動兩種 server，
+用同一條 token 打 /api/v1/board，輸出 JSON: requests/sec、p50/p95/p99 延遲 (ms)。
+"""
+import argparse
+import http.client
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_FILES = ['app.py', 'wsgi.py', 'asgi.py', 'gunicorn.conf.py', 'restaurant.db', 'templates', 'static']
+
+
+def prepare_workdir():
+    workdir = tempfile.mkdtemp(prefix='restaurant-bench-')
+    for name in APP_FILES:
+        src = os.path.join(ROOT, name)
+        if os.path.isdir(src):
+            shutil.copytree(src, os.path.join(workdir, name))
+        elif os.path.exists(src):
+            shutil.copy2(src, workdir)
+    return workdir
+
+
+def create_token(workdir):
+    out = subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'create-api-token', 'admin',
+                          '--name', 'benchmark'], cwd=workdir, capture_output=True, text=True, check=True)
+    return out.stdout.strip().split(': ')[-1]
+
+
+def start_server(mode, workdir, port, workers):
+    env = dict(os.environ, PORT=str(port), WEB_CONCURRENCY=str(workers), BENEFIT_SCHEDULER='0')
+    if mode == 'wsgi':
+        cmd = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--access-logfile', '/dev/null', 'wsgi:app']
+    else:
+        cmd = [sys.executable, '-m', 'uvicorn', 'asgi:app', '--port', str(port), '--workers', str(workers),
+               '--no-access-log', '--log-level', 'warning']
+    proc = subprocess.Popen(cmd, cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/login')
+            conn.getresponse().read()
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError(f'{mode} server 啟動失敗')
+
+
+def run_load(port, path, token, concurrency, duration):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + duration
+    
+    def worker():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        local = []
+        while time.perf_counter() < stop_at:
+            started = time.perf_counter()
+            try:
+                conn.request('GET', path, headers={'Authorization': f'Bearer {token}'})
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    raise http.client.HTTPException(response.status)
+                local.append(time.perf_counter() - started)
+            except (OSError, http.client.HTTPException):
+                with lock:
+                    errors[0] += 1
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        with lock:
+            latencies.extend(local)
+    
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    return summarize(latencies, errors[0], elapsed)
+
+
+def summarize(latencies, errors, elapsed):
+    if not latencies:
+        return {'requests': 0, 'errors': errors}
+    ordered = sorted(latencies)
+    
+    def pct(p):
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000, 2)
+    
+    return {
+        'requests': len(ordered),
+        'errors': errors,
+        'rps': round(len(ordered) / elapsed, 1),
+        'mean_ms': round(statistics.mean(ordered) * 1000, 2),
+        'p50_ms': pct(0.50),
+        'p95_ms': pct(0.95),
+        'p99_ms': pct(0.99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--path', default='/api/v1/board')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--modes', default='wsgi,asgi')
+    args = parser.parse_args()
+    
+    workdir = prepare_workdir()
+    results = {'path': args.path, 'concurrency': args.concurrency, 'duration': args.duration,
+               'workers': args.workers}
+    try:
+        token = create_token(workdir)
+        for i, mode in enumerate(args.modes.split(',')):
+            port = 5600 + i
+            proc = start_server(mode, workdir, port, args.workers)
+            try:
+                run_load(port, args.path, token, 4, 1)  # 熱身
+                results[mode] = run_load(port, args.path, token, args.concurrency, args.duration)
+            finally:
+                proc.terminate()
+                proc.wait(timeout=10)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""主要頁面既壓力測試：先產生測試資料，再逐條 route 用 Flask test client 打
+
+用法: python benchmarks/load_test.py --requests 200 --customers 50000 --output result.json
+每條 route 喺獨立 process 跑，所以 peak RSS 係嗰條 route 自己既數字。
+輸出 JSON: 每條 route 既 requests/sec、p50/p95/p99 延遲 (ms)、每個請求既 SQL 數目同返回行數、peak RSS (MB)。
+SQL 數目由 app 既 ?_profile=1 header 攞 (X-Query-Count / X-Query-Rows)。
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+from asgi_vs_wsgi import prepare_workdir, summarize
+from seed_data import DEFAULT_VOLUMES, add_volume_arguments, seed
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_ROUTES = [
+    'GET /dashboard',
+    'GET /members',
+    'GET /members?search=9000',
+    'GET /customers',
+    'GET /customers?search=陳',
+    'GET /reservations',
+    'GET /checkout',
+    'GET /checkout?phone=90001',
+    'POST /checkout',
+    'GET /analytics',
+    'GET /revenue-chart',
+    'GET /export/members',
+    'GET /export/customers',
+    'GET /export/reservations',
+    'GET /export/transactions',
+]
+
+
+def peak_rss_mb():
+    # Linux 係 KB，macOS 係 bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def run_route(workdir, route, requests, concurrency, members):
+    """喺呢個 process 入面 import app，打 route 若干次，返回結果 dict"""
+    os.chdir(workdir)
+    sys.path.insert(0, workdir)
+    import app
+
+    method, path = route.split(' ', 1)
+    profiled = path + ('&' if '?' in path else '?') + '_profile=1'
+    rng = random.Random(0)
+
+    def client():
+        c = app.app.test_client()
+        c.post('/login', data={'username': 'admin', 'password': 'admin123'})
+        return c
+
+    def call(c):
+        if method == 'POST':
+            # 結帳：隨機會員，每次新 idempotency key
+            return c.post(profiled, data={'member_id': rng.randint(1, members), 'original_amount': '388',
+                                          'idempotency_key': os.urandom(8).hex()})
+        return c.get(profiled)
+
+    warm = client()
+    for _ in range(3):
+        call(warm)
+    baseline_rss = peak_rss_mb()
+
+    latencies, queries, rows = [], [], []
+    errors = [0]
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def worker():
+        c = client()
+        for _ in counter:
+            started = time.perf_counter()
+            response = call(c)
+            response.get_data()
+            elapsed = time.perf_counter() - started
+            with lock:
+                if response.status_code >= 400:
+                    errors[0] += 1
+                    continue
+                latencies.append(elapsed)
+                queries.append(int(response.headers.get('X-Query-Count', 0)))
+                rows.append(int(response.headers.get('X-Query-Rows', 0)))
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    result = summarize(latencies, errors[0], time.perf_counter() - started)
+    if queries:
+        result['sql_per_request'] = round(sum(queries) / len(queries), 1)
+        result['rows_per_request'] = round(sum(rows) / len(rows), 1)
+    result['baseline_rss_mb'] = baseline_rss
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200, help='每條 route 打幾多次')
+    parser.add_argument('--concurrency', type=int, default=1, help='同時幾多個 thread')
+    parser.add_argument('--routes', default=','.join(DEFAULT_ROUTES), help='逗號分隔，例如 "GET /members,POST /checkout"')
+    parser.add_argument('--output', help='結果寫入檔案 (預設只印出)')
+    parser.add_argument('--keep', action='store_true', help='保留暫存目錄 (測試資料庫)')
+    parser.add_argument('--run-route', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    add_volume_arguments(parser)
+    args = parser.parse_args()
+    volumes = {table: getattr(args, table) for table in DEFAULT_VOLUMES}
+
+    if args.run_route:
+        # 子 process：只跑一條 route
+        result = run_route(args.workdir, args.run_route, args.requests, args.concurrency, args.members)
+        print(json.dumps(result))
+        return
+
+    workdir = prepare_workdir()
+    results = {'commit': git_commit(), 'requests': args.requests, 'concurrency': args.concurrency, 'routes': {}}
+    try:
+        results['seed'] = seed(workdir, volumes, args.seed)
+        env = dict(os.environ, BENEFIT_SCHEDULER='0')
+        for route in args.routes.split(','):
+            out = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--run-route', route, '--workdir', workdir,
+                 '--requests', str(args.requests), '--concurrency', str(args.concurrency),
+                 '--members', str(args.members)],
+                capture_output=True, text=True, env=env)
+            if out.returncode != 0:
+                results['routes'][route] = {'error': out.stderr.strip().splitlines()[-1:]}
+                continue
+            results['routes'][route] = json.loads(out.stdout.strip().splitlines()[-1])
+    finally:
+        if args.keep:
+            results['workdir'] = workdir
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""產生測試用資料庫 (會員、顧客、訪問、互動、預訂、交易)
+
+用法: python benchmarks/seed_data.py --workdir /tmp/bench --members 5000 --customers 20000
+workdir 入面要有 app.py (通常由 load_test.py 複製)；會喺嗰度建立全新既 restaurant.db。
+同一個 --seed 產生既資料完全一樣，方便唔同 commit 之間比較。
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+
+DEFAULT_VOLUMES = {
+    'members': 5000,
+    'customers': 20000,
+    'visits': 100000,
+    'interactions': 20000,
+    'reservations': 30000,
+    'transactions': 50000,
+}
+BATCH_SIZE = 5000
+TIERS = ['普通會員', '黑鑽會員']
+STATUSES = ['booked', 'confirmed', 'seated', 'completed', 'no_show', 'cancelled']
+INTERACTION_TYPES = ['call', 'complaint', 'compliment', 'request', 'marketing']
+SURNAMES = '陳李張黃何林吳劉蔡楊梁鄭謝郭曾羅'
+GIVEN = '嘉偉志明文俊家豪詠詩美玲子健國強麗芳婉儀'
+
+
+def _name(rng):
+    return rng.choice(SURNAMES) + ''.join(rng.choice(GIVEN) for _ in range(2))
+
+
+def _batches(rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _insert(conn, sql, rows):
+    for batch in _batches(rows):
+        conn.executemany(sql, batch)
+
+
+def create_schema(workdir):
+    """import app 一次：建表、migration、trigger、預設管理員"""
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    sys.path.insert(0, workdir)
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            import app
+            app.init_db()
+        app.engine.dispose()
+        return app
+    finally:
+        os.chdir(cwd)
+
+
+def seed(workdir, volumes, seed=42):
+    """返回 {表: 行數, 'seconds': 用咗幾耐}"""
+    db_path = os.path.join(workdir, 'restaurant.db')
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    started = time.perf_counter()
+    app = create_schema(workdir)
+    rng = random.Random(seed)
+    now = datetime(2026, 10, 1, 12, 0)
+
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA synchronous=OFF')
+    with conn:
+        _insert(conn, """INSERT INTO members (id, name, phone, tier, balance, benefits_total, benefits_used,
+                           weekly_dessert_coffee, yearly_omakase, effective_date, expiry_date,
+                           dessert_coffee_used, omakase_used, created_at)
+                         VALUES (?, ?, ?, ?, ?, ?, 0, 0, 0, ?, ?, 0, 0, ?)""", (
+            (i, _name(rng), f'9{i:07d}', rng.choice(TIERS), round(rng.uniform(0, 5000), 1), rng.choice([0, 5, 10]),
+             now - timedelta(days=rng.randint(0, 720)), now + timedelta(days=rng.randint(-60, 365)), now)
+            for i in range(1, volumes['members'] + 1)))
+
+        # 顧客統計由 visit_records trigger 累加，所以由 0 開始
+        _insert(conn, """INSERT INTO customers (id, name, phone, email, tags, avg_spend, visits, total_spent,
+                           points, created_at, updated_at)
+                         VALUES (?, ?, ?, ?, ?, 0, 0, 0, 0, ?, ?)""", (
+            (i, _name(rng), f'6{i:07d}', f'c{i}@example.com', rng.choice(['', 'VIP', '常客', '素食']), now, now)
+            for i in range(1, volumes['customers'] + 1)))
+
+        customers = volumes['customers']
+        _insert(conn, """INSERT INTO visit_records (customer_id, visit_date, amount, table_number, server,
+                           party_size, note, created_at)
+                         VALUES (?, ?, ?, ?, '', ?, '', ?)""", (
+            (rng.randint(1, customers), now - timedelta(days=rng.randint(0, 365), minutes=rng.randint(0, 600)),
+             round(rng.uniform(100, 3000), 1), f'A{rng.randint(1, 30)}', rng.randint(1, 8), now)
+            for _ in range(volumes['visits'])))
+
+        _insert(conn, """INSERT INTO interactions (customer_id, type, note, created_at) VALUES (?, ?, '', ?)""", (
+            (rng.randint(1, customers), rng.choice(INTERACTION_TYPES), now - timedelta(days=rng.randint(0, 365)))
+            for _ in range(volumes['interactions'])))
+
+        _insert(conn, """INSERT INTO reservations (customer_id, name, phone, email, date, party_size, table_number,
+                           status, note, created_at)
+                         VALUES (?, ?, ?, '', ?, ?, '', ?, '', ?)""", (
+            (cid, _name(rng), f'6{cid:07d}', now + timedelta(days=rng.randint(-180, 60), hours=rng.randint(0, 10)),
+             rng.randint(1, 8), rng.choice(STATUSES), now)
+            for cid in (rng.randint(1, customers) for _ in range(volumes['reservations']))))
+
+        members = volumes['members']
+        _insert(conn, """INSERT INTO transactions (member_id, original_amount, discount_amount, final_amount,
+                           paid_from_balance, cash_paid, created_at, note)
+                         VALUES (?, ?, 0, ?, 0, ?, ?, '')""", (
+            (rng.randint(1, members), amount, amount, amount, now - timedelta(days=rng.randint(0, 365)))
+            for amount in (round(rng.uniform(100, 3000), 1) for _ in range(volumes['transactions']))))
+    conn.execute('ANALYZE')
+    conn.close()
+
+    # 電話 key、會員配對顧客、匯總表同搜尋索引用 app 自己既函數
+    app.backfill_phone_keys()
+    app.link_all_member_customers()
+    app.rebuild_daily_revenue()
+    app.rebuild_search_index()
+    app.engine.dispose()
+
+    return dict(volumes, seconds=round(time.perf_counter() - started, 2))
+
+
+def add_volume_arguments(parser):
+    for table, default in DEFAULT_VOLUMES.items():
+        parser.add_argument(f'--{table}', type=int, default=default)
+    parser.add_argument('--seed', type=int, default=42)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workdir', required=True)
+    add_volume_arguments(parser)
+    args = parser.parse_args()
+    volumes = {table: getattr(args, table) for table in DEFAULT_VOLUMES}
+    print(json.dumps(seed(args.workdir, volumes, args.seed), indent=2))
+
+
+if __name__ == '__main__':
+    main()
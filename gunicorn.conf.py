@@ -0,0 +1,31 @@
+# Gunicorn 設定 (正式環境)
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# SQLite 同一時間只可以有一個寫入者，worker 太多只會喺寫鎖度排隊，
+# 所以用少量 process + 多 thread 處理讀取為主既請求
+workers = int(os.environ.get('WEB_CONCURRENCY', min(multiprocessing.cpu_count() * 2, 4)))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+
+# 定期重啟 worker，避免長時間運行累積記憶體
+max_requests = 2000
+max_requests_jitter = 200
+
+accesslog = '-'
+errorlog = '-'
+
+# 喺 master 載入一次 app (建表、migration 只跑一次)，fork 之後每個 worker 重新開連線
+preload_app = True
+
+
+def post_fork(server, worker):
+    from app import engine, start_benefit_scheduler
+    engine.dispose(close=False)
+    start_benefit_scheduler()
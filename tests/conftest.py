@@ -0,0 +1,29 @@
+"""測試共用：喺暫存目錄建一個全新資料庫 (restaurant.db 跟 cwd)，成個 session import app 一次"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    workdir = tmp_path_factory.mktemp('restaurant')
+    os.environ['BENEFIT_SCHEDULER'] = '0'
+    cwd = os.getcwd()
+    os.chdir(workdir)  # SQLite 相對路徑每次開連線都跟 cwd，測試期間唔可以轉走
+    sys.path.insert(0, ROOT)
+    import app
+    app.init_db()
+    yield app
+    app.engine.dispose()
+    os.chdir(cwd)
+
+
+@pytest.fixture
+def client(app_module):
+    c = app_module.app.test_client()
+    response = c.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    assert response.status_code == 302
+    return c
@@ -0,0 +1,67 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import func
+
+INITIAL_BALANCE = 1000.0
+AMOUNT = 30.0
+KEYS = 50
+REPEATS = 3  # 每個 idempotency key 重複提交幾多次
+THREADS = 8
+
+
+def test_concurrent_checkout_same_member(app_module):
+    A = app_module
+    db = A.Session()
+    member = A.Member(name='壓力測試', phone='5999 0001', tier='普通會員', balance=INITIAL_BALANCE)
+    db.add(member)
+    db.commit()
+    member_id = member.id
+    db.close()
+
+    # 監察線程：成個過程餘額都唔可以變負數
+    lowest = [INITIAL_BALANCE]
+    done = threading.Event()
+
+    def monitor():
+        while not done.is_set():
+            watch = A.Session()
+            lowest[0] = min(lowest[0], watch.get(A.Member, member_id).balance)
+            watch.close()
+
+    def checkout(key):
+        session = A.Session()
+        try:
+            return A.perform_checkout(session, member_id, AMOUNT, True, None, idempotency_key=key)
+        finally:
+            session.close()
+
+    keys = [f'stress-{i}' for i in range(KEYS) for _ in range(REPEATS)]
+    watcher = threading.Thread(target=monitor)
+    watcher.start()
+    try:
+        with ThreadPoolExecutor(THREADS) as pool:
+            results = list(pool.map(checkout, keys))
+    finally:
+        done.set()
+        watcher.join()
+
+    db = A.Session()
+    try:
+        count, paid = db.query(func.count(A.Transaction.id), func.sum(A.Transaction.paid_from_balance)).filter(
+            A.Transaction.member_id == member_id).one()
+        balance = db.get(A.Member, member_id).balance
+    finally:
+        db.close()
+
+    # 每個 key 只結一次帳；儲值啱啱扣晒 (最後一單部分用儲值)，其餘收現金
+    assert count == KEYS
+    assert paid == INITIAL_BALANCE
+    assert balance == 0
+    assert lowest[0] >= 0
+    assert all(r['paid_from_balance'] + r['cash_paid'] == AMOUNT for r in results)
+    # 重複提交返回第一次既結果
+    by_key = {}
+    for key, result in zip(keys, results):
+        by_key.setdefault(key, []).append(result['paid_from_balance'])
+    assert all(len(set(paid_values)) == 1 for paid_values in by_key.values())
@@ -0,0 +1,36 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+
+def count_statements(app_module, client, url):
+    """打一次 url，返回 (HTTP status, 執行咗幾多條 SQL)"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(app_module.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        response = client.get(url)
+    finally:
+        event.remove(app_module.engine, 'before_cursor_execute', before_cursor_execute)
+    return response.status_code, len(statements)
+
+
+def test_reservation_list_statement_count_independent_of_page_size(app_module, client):
+    # 每個預訂一個唔同電話，逐個電話 count 既話 SQL 數目會跟頁數增加
+    start = datetime(2030, 1, 1, 18, 0)
+    with app_module.engine.begin() as conn:
+        conn.exec_driver_sql(
+            'INSERT INTO reservations (name, phone, phone_key, email, date, party_size, status, note, created_at) '
+            "VALUES (?, ?, ?, '', ?, 2, 'booked', '', ?)",
+            [(f'客{i}', f'6{i:07d}', f'+8526{i:07d}', start + timedelta(minutes=i), start) for i in range(250)])
+    app_module.invalidate_counts('reservations')
+
+    client.get('/reservations?per_page=10')  # 暖身：session cache、總數 cache
+    status_small, small = count_statements(app_module, client, '/reservations?per_page=10')
+    status_large, large = count_statements(app_module, client, '/reservations?per_page=200')
+
+    assert status_small == status_large == 200
+    assert small == large